@@ -0,0 +1,436 @@
+import io
+import zmq
+import asyncio
+import logging
+import zmq.asyncio
+import tinyrpc.exc
+from PIL import Image
+from typing import Dict, Optional, Tuple
+from utils import configure_logger
+from drawing import Canvas
+from collections import OrderedDict
+from tinyrpc.protocols import RPCErrorResponse
+from tinyrpc.protocols.msgpackrpc import MSGPACKRPCProtocol
+from rpc import ONE_WAY_METHODS, TAKE_ERRORS_METHOD, TEXT_CACHE_SIZE
+from resilience import RPC_TIMEOUT_S, METRICS, CallTimeoutError, \
+    CircuitOpenError, get_breaker
+
+
+LOG = logging.getLogger('pluggramd.aiorpc')
+configure_logger(LOG)
+
+
+class AsyncClient:
+    """
+    msgpack-rpc client for asyncio on one DEALER socket, shared by every
+    coroutine of a process. Requests go out as they are made and a reader
+    task hands each reply to the call waiting for its id, so the waits of
+    different coroutines overlap instead of queueing. Calls named in
+    one_way_methods go out as notifications, like PipelinedClient's, and
+    their errors are logged as they come back with the next other call.
+
+    Calls that get no reply in time raise CallTimeoutError and count
+    against the endpoint's circuit breaker. Nothing is retried: a lost
+    reply does not wedge a DEALER socket and the next tick redraws anyway.
+    """
+
+    def __init__(self,
+                 context: zmq.asyncio.Context,
+                 endpoint: str,
+                 one_way_methods=ONE_WAY_METHODS,
+                 timeout: Optional[float] = RPC_TIMEOUT_S):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self._socket = context.socket(zmq.DEALER)
+        self._socket.connect(endpoint)
+        self._protocol = MSGPACKRPCProtocol()
+        self._one_way_methods = one_way_methods
+        self._waiting: Dict[int, asyncio.Future] = {}
+        self._reader: Optional[asyncio.Task] = None
+        # notifications went out since the server's errors were last taken
+        self._unsynced = False
+
+    async def _read(self):
+        while True:
+            frames = await self._socket.recv_multipart()
+
+            try:
+                response = self._protocol.parse_reply(frames[-1])
+            except tinyrpc.exc.RPCError as e:
+                LOG.warning(f'dropping unreadable reply from '
+                            f'{self.endpoint}: {str(e)}')
+                continue
+
+            # replies to calls that timed out have nobody waiting
+            future = self._waiting.pop(response.unique_id, None)
+
+            if future is not None and not future.done():
+                future.set_result(response)
+
+    async def call(self, method: str, *args):
+        breaker = get_breaker(self.endpoint)
+
+        if not breaker.allow():
+            METRICS.increment(self.endpoint, 'rejected')
+            raise CircuitOpenError(f'{self.endpoint} is not answering, '
+                                   f'{method}() was not sent')
+
+        if self._reader is None:
+            self._reader = asyncio.ensure_future(self._read())
+
+        one_way = method in self._one_way_methods
+        request = self._protocol.create_request(method, args, None, one_way)
+        METRICS.increment(self.endpoint, 'calls')
+
+        if one_way:
+            # empty delimiter frame makes this look like a REQ envelope
+            await self._socket.send_multipart([b'', request.serialize()])
+            self._unsynced = True
+            return None
+
+        # see PipelinedClient.call()
+        requests = [request]
+
+        if self._unsynced and method != TAKE_ERRORS_METHOD:
+            requests.append(self._protocol.create_request(TAKE_ERRORS_METHOD,
+                                                          [],
+                                                          None,
+                                                          False))
+            self._unsynced = False
+
+        loop = asyncio.get_running_loop()
+        futures = []
+
+        for r in requests:
+            futures.append(loop.create_future())
+            self._waiting[r.unique_id] = futures[-1]
+
+        try:
+            for r in requests:
+                await self._socket.send_multipart([b'', r.serialize()])
+
+            response = await asyncio.wait_for(futures[0], self.timeout)
+
+            if len(futures) > 1:
+                taken = await asyncio.wait_for(futures[1], self.timeout)
+
+                for error in taken.result:
+                    LOG.warning(f'screen call {error}')
+        except asyncio.TimeoutError:
+            breaker.record_failure()
+            METRICS.increment(self.endpoint, 'timeouts')
+            raise CallTimeoutError(f'{method}() on {self.endpoint} got no '
+                                   f'reply in {self.timeout}s')
+        finally:
+            for r in requests:
+                self._waiting.pop(r.unique_id, None)
+
+        breaker.record_success()
+
+        if isinstance(response, RPCErrorResponse):
+            METRICS.increment(self.endpoint, 'errors')
+            self._protocol.raise_error(response)
+
+        return response.result
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+
+        self._socket.close(linger=0)
+
+
+class AsyncScreen:
+    """
+    rpc.Screen for async pluggrams: the same calls, as coroutines. connect()
+    must have been awaited before the properties are read.
+    """
+
+    @property
+    def width(self) -> int:
+        return self._description['width']
+
+    @property
+    def height(self) -> int:
+        return self._description['height']
+
+    @property
+    def pixel_count(self) -> int:
+        return self._description['pixel_count']
+
+    @property
+    def center(self) -> Tuple[int, int]:
+        return self._description['center']
+
+    @property
+    def max_brightness(self) -> int:
+        return self._description['max_brightness']
+
+    def __init__(self, client: AsyncClient, text_cache_size=TEXT_CACHE_SIZE):
+        self._client = client
+        self._description: Optional[dict] = None
+        self._font_key = None
+        self._text_cache = OrderedDict()
+        self._text_cache_size = text_cache_size
+
+    async def connect(self):
+        description = await self._client.call('describe')
+        description['center'] = tuple(description['center'])
+        self._description = description
+
+    async def _check_epoch(self, epoch: Optional[int]):
+        # see Screen._check_epoch()
+        if epoch != self._description['epoch']:
+            self._font_key = None
+            self._text_cache.clear()
+            await self.connect()
+
+    async def paste(self, img, box=None, fmt='png'):
+        output = io.BytesIO()
+        img.save(output, format=fmt)
+        await self._client.call('paste', output.getvalue(), box)
+
+    async def render(self):
+        await self._check_epoch(await self._client.call('render'))
+
+    async def render_frame(self, frame: bytes):
+        await self._check_epoch(await self._client.call('render_frame', frame))
+
+    async def begin_offscreen(self):
+        await self._check_epoch(await self._client.call('begin_offscreen'))
+        # see Screen.begin_offscreen()
+        self._font_key = None
+
+    async def end_offscreen(self):
+        await self._client.call('end_offscreen')
+        self._font_key = None
+
+    async def present(self, fade_ms=None):
+        await self._check_epoch(await self._client.call('present', fade_ms))
+
+    async def set_pixel(self, x: int, y: int, color: int):
+        await self._client.call('set_pixel', x, y, color)
+
+    async def set_brightness(self, v: int):
+        await self._client.call('set_brightness', v)
+
+    async def set_font(self, name: str, size=None, font_face=None) -> bool:
+        loaded = await self._client.call('set_font', name, size, font_face)
+
+        if loaded:
+            self._font_key = (name.lower().strip(), size, font_face)
+
+        return loaded
+
+    async def font_names(self) -> list:
+        return await self._client.call('font_names')
+
+    async def text_dimensions(self,
+                              message: str,
+                              spacing=None,
+                              features=None,
+                              stroke_width=None) -> Tuple[int, int]:
+        key = (self._font_key,
+               message,
+               spacing,
+               tuple(features) if features else None,
+               stroke_width)
+
+        # screend's font is only known once set_font() succeeded
+        cacheable = self._font_key is not None
+
+        if cacheable and key in self._text_cache:
+            self._text_cache.move_to_end(key)
+            return self._text_cache[key]
+
+        dimensions = tuple(await self._client.call('text_dimensions',
+                                                   message,
+                                                   spacing,
+                                                   features,
+                                                   stroke_width))
+
+        if cacheable:
+            self._text_cache[key] = dimensions
+
+            if len(self._text_cache) > self._text_cache_size:
+                self._text_cache.popitem(last=False)
+
+        return dimensions
+
+    async def draw_text(self,
+                        x: int,
+                        y: int,
+                        color: int,
+                        message: str,
+                        anchor=None,
+                        spacing=None,
+                        alignment=None,
+                        stroke_width=None,
+                        stroke_fill=None):
+        await self._client.call('draw_text',
+                                x,
+                                y,
+                                color,
+                                message,
+                                anchor,
+                                spacing,
+                                alignment,
+                                stroke_width,
+                                stroke_fill)
+
+    async def fill(self, color: int, box=None):
+        await self._client.call('fill', color, box)
+
+    async def draw_ellipse(self,
+                           x: int,
+                           y: int,
+                           width=None,
+                           color=None,
+                           outline=None):
+        await self._client.call('draw_ellipse', x, y, width, color, outline)
+
+    async def draw_line(self,
+                        x: int,
+                        y: int,
+                        color=None,
+                        width=None,
+                        rounded=False):
+        await self._client.call('draw_line', x, y, color, width, rounded)
+
+    async def clear(self):
+        await self._client.call('clear')
+
+
+class Compositor:
+    """
+    One frame made of the zones of several pluggrams. Each zone's render()
+    pastes it into the frame and ships the frame with render_frame; zones
+    that render while a frame is on its way ride along with the next one
+    instead of sending one each.
+    """
+
+    def __init__(self, screen: AsyncScreen):
+        self._screen = screen
+        self._frame = Image.new('RGB', (screen.width, screen.height), 0)
+        self._lock = asyncio.Lock()
+        self._version = 0
+        self._sent = 0
+
+    async def render(self, canvas: Canvas, origin: Tuple[int, int]):
+        self._frame.paste(canvas.image, origin)
+        self._version += 1
+        version = self._version
+
+        async with self._lock:
+            if self._sent >= version:
+                return
+
+            self._sent = self._version
+            await self._screen.render_frame(self._frame.tobytes())
+
+
+class ZoneScreen(AsyncScreen):
+    """
+    AsyncScreen for one rectangle of the screen. Drawing happens on a local
+    canvas the size of the zone, with the zone's top left corner at 0, 0,
+    and render() puts it on the screen through the compositor. Brightness
+    is the whole screen's.
+    """
+
+    @property
+    def width(self) -> int:
+        return self._canvas.width
+
+    @property
+    def height(self) -> int:
+        return self._canvas.height
+
+    @property
+    def pixel_count(self) -> int:
+        return self.width * self.height
+
+    @property
+    def center(self) -> Tuple[int, int]:
+        return self.width // 2, self.height // 2
+
+    def __init__(self,
+                 screen: AsyncScreen,
+                 compositor: Compositor,
+                 box: Tuple[int, int, int, int],
+                 fonts_dir: str):
+        super().__init__(screen._client)
+        self._description = screen._description
+        self._compositor = compositor
+        self._origin = (box[0], box[1])
+        self._canvas = Canvas(box[2] - box[0], box[3] - box[1], fonts_dir)
+
+    async def connect(self):
+        pass
+
+    async def paste(self, img, box=None, fmt='png'):
+        self._canvas.paste(img, box)
+
+    async def render(self):
+        await self._compositor.render(self._canvas, self._origin)
+
+    async def set_pixel(self, x: int, y: int, color: int):
+        self._canvas.set_pixel(x, y, color)
+
+    async def set_font(self, name: str, size=None, font_face=None) -> bool:
+        return self._canvas.set_font(name, size, font_face)
+
+    async def font_names(self) -> list:
+        return self._canvas.font_names()
+
+    async def text_dimensions(self,
+                              message: str,
+                              spacing=None,
+                              features=None,
+                              stroke_width=None) -> Tuple[int, int]:
+        return self._canvas.text_dimensions(message,
+                                            spacing,
+                                            features,
+                                            stroke_width)
+
+    async def draw_text(self,
+                        x: int,
+                        y: int,
+                        color: int,
+                        message: str,
+                        anchor=None,
+                        spacing=None,
+                        alignment=None,
+                        stroke_width=None,
+                        stroke_fill=None):
+        self._canvas.draw_text(x,
+                               y,
+                               color,
+                               message,
+                               anchor,
+                               spacing,
+                               alignment,
+                               stroke_width,
+                               stroke_fill)
+
+    async def fill(self, color: int, box=None):
+        self._canvas.fill(color, box)
+
+    async def draw_ellipse(self,
+                           x: int,
+                           y: int,
+                           width=None,
+                           color=None,
+                           outline=None):
+        self._canvas.draw_ellipse(x, y, width, color, outline)
+
+    async def draw_line(self,
+                        x: int,
+                        y: int,
+                        color=None,
+                        width=None,
+                        rounded=False):
+        self._canvas.draw_line(x, y, color, width, rounded)
+
+    async def clear(self):
+        self._canvas.clear()
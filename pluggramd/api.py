@@ -1,16 +1,95 @@
+import os
+import rpc
+import time
+import tempfile
 from typing import List, Tuple, Union, Optional
-from pluggram import PluggramRunner, PluggramMetadata
+from threading import Lock
+from collections import OrderedDict
+from events import EventPublisher
+from policy import RunnerPolicy, Violation, Watchdog
+from profiler import PROFILE_FORMATS, ProfileRequest
+from playlist import Playlist
+from pluggram import DiscoveryResult, PluggramRunner, PluggramMetadata
 from tinyrpc.dispatch import public
 
 
+# profiles older than the latest this many are deleted
+PROFILES_KEPT = 8
+
+
 class PluggramManager:
 
     def __init__(self,
                  metadata: List[PluggramMetadata],
-                 screen_url: str):
+                 screen_url: str,
+                 screen_options: Optional[dict] = None,
+                 events: Optional[EventPublisher] = None,
+                 zygote=True,
+                 handover=True,
+                 fade_ms: Optional[int] = None,
+                 discovery: Optional[List[DiscoveryResult]] = None,
+                 policy: Optional[RunnerPolicy] = None):
         self._metadata = metadata
+        self._discovery = discovery or []
         self._screen_url = screen_url
-        self._runner = PluggramRunner()
+        self._screen_options = screen_options or {}
+        self._runner = PluggramRunner(policy)
+        self._watchdog: Optional[Watchdog] = None
+        self._handover = handover
+        self._fade_ms = fade_ms
+        self._playlist: Optional[Playlist] = None
+
+        if zygote:
+            self._runner.use_zygote([m.module_path for m in metadata],
+                                    screen_url,
+                                    self._screen_options)
+        # starts at the clock so versions keep increasing across restarts
+        self._catalog_version = int(time.time() * 1000)
+        self._events = events
+        self._announced_running: Optional[str] = None
+        # the heartbeat thread announces too, each announcement reads the
+        # runner and publishes what it read before the next one may
+        self._announce_lock = Lock()
+        self._profiles_dir: Optional[str] = None
+        # id: pluggram name and result file of requested profiles
+        self._profiles = OrderedDict()
+        self._last_profile_id = 0
+
+        if policy is not None and policy.watched:
+            self._watchdog = Watchdog(policy,
+                                      self._runner.workers,
+                                      self._on_violation)
+            self._watchdog.start()
+
+    def _publish(self, topic: str, **fields):
+        if self._events is not None:
+            self._events.publish(topic, **fields)
+
+    def _announce_running(self):
+        with self._announce_lock:
+            self._announced_running = self.get_running()
+            self._publish('running', running=self._announced_running)
+
+    def _on_violation(self, violation: Violation):
+        self._publish('violation',
+                      name=violation.name,
+                      kind=violation.kind,
+                      detail=violation.detail,
+                      terminated=violation.terminated)
+
+    def event_state(self) -> dict:
+        """
+        Current state repeated in every heartbeat.
+        """
+        with self._announce_lock:
+            running = self.get_running()
+
+            # a runner that died on its own never went through stop()
+            if running != self._announced_running:
+                self._announced_running = running
+                self._publish('running', running=running)
+
+        return {'running': running, 'catalog_version': self._catalog_version}
 
     def _find_by_name(self, name: str) -> PluggramMetadata:
         for m in self._metadata:
@@ -19,6 +98,23 @@ class PluggramManager:
         else:
             raise KeyError('Program not found')
 
+    @staticmethod
+    def _flat_options(metadata: PluggramMetadata) -> List[Tuple]:
+        data = []
+
+        for opt in metadata.options:
+            data.append((opt.key,
+                         opt.type_name,
+                         opt.choices,
+                         opt.min,
+                         opt.max,
+                         opt.default,
+                         opt.value,
+                         opt.help_text,
+                         opt.input_method))
+
+        return data
+
     @public
     def get_names(self) -> List[str]:
         return [m.name for m in self._metadata]
@@ -42,44 +138,321 @@ class PluggramManager:
                                                                   bool, str]],
                                                    Optional[str],
                                                    int]]:
-        metadata = self._find_by_name(name)
-        data = []
+        return self._flat_options(self._find_by_name(name))
 
-        for opt in metadata.options:
-            data.append((opt.key,
-                         opt.type_name,
-                         opt.choices,
-                         opt.min,
-                         opt.max,
-                         opt.default,
-                         opt.value,
-                         opt.help_text,
-                         opt.input_method))
+    @public
+    def get_catalog(self, since_version: Optional[int] = None) -> \
+            Tuple[int, Optional[List[Tuple]]]:
+        """
+        Info and options of every pluggram in one reply, as tuples shaped
+        like get_info() and get_options() results, behind the name. The
+        list is None if since_version is still the current version.
+        """
+        if since_version == self._catalog_version:
+            return self._catalog_version, None
 
-        return data
+        programs = []
+        for m in self._metadata:
+            programs.append((m.name,
+                             m.display_name,
+                             m.description,
+                             m.version,
+                             m.tick_rate,
+                             self._flat_options(m)))
+
+        return self._catalog_version, programs
 
     @public
     def save_options(self, name: str, options: dict) -> Tuple[List[str],
                                                               List[str]]:
+        """
+        Validate and store options of a pluggram. If it runs, the values
+        that changed are applied to it without restarting its worker.
+        """
         m = self._find_by_name(name)
-        return m.save_options(options)
+        before = m.get_filled_options()
+        rv = m.save_options(options)
+        changes = {key: value
+                   for key, value in m.get_filled_options().items()
+                   if value != before[key]}
+
+        if changes:
+            self._runner.update_options(m, changes)
+
+        self._catalog_version += 1
+        self._publish('options',
+                      name=name,
+                      catalog_version=self._catalog_version)
+        return rv
 
     @public
     def get_running(self) -> Optional[str]:
-        if self._runner.is_running:
-            return self._runner.running.name
+        # read once, stop() may clear it from another thread meanwhile
+        meta = self._runner.running
+
+        if meta is not None and self._runner.is_running:
+            return meta.name
         return None
 
+    def _cancel_playlist(self):
+        if self._playlist is not None:
+            self._playlist.cancel()
+            self._playlist = None
+
     @public
     def start(self, name: str) -> bool:
+        """
+        Run a pluggram. With handover on, the running one keeps the screen
+        until the new one has its first frame ready. Returns False if the
+        pluggram already runs or failed before taking over.
+        """
         metadata = self._find_by_name(name)
+        self._cancel_playlist()
         running_name = self.get_running()
-        if running_name is None or metadata.name != running_name:
-            self._runner.start(metadata, self._screen_url)
-            return True
+        if running_name is None or metadata.name != running_name or \
+                self._runner.group is not None:
+            started = self._runner.start(metadata,
+                                         self._screen_url,
+                                         self._screen_options,
+                                         self._handover,
+                                         self._fade_ms)
+            self._announce_running()
+            return started
         else:
             return False
 
+    @public
+    def start_group(self, members: List[Tuple[str, List[int]]]) -> bool:
+        """
+        Run async pluggrams side by side in one process over one screen
+        connection, each drawing in its (x1, y1, x2, y2) box of the screen.
+        Returns False if they failed before taking over.
+        """
+        if not members:
+            raise ValueError('Group is empty')
+
+        if not self._screen_options.get('fonts_dir'):
+            raise ValueError('Groups draw locally, start pluggramd with '
+                             '--fonts to use them')
+
+        group = []
+
+        for name, box in members:
+            metadata = self._find_by_name(name)
+
+            if not metadata.is_async:
+                raise ValueError(f'"{name}" is not async, only async '
+                                 f'pluggrams can share a process')
+
+            if len(box) != 4 or box[0] >= box[2] or box[1] >= box[3]:
+                raise ValueError(f'Box of "{name}" must be (x1, y1, x2, y2) '
+                                 f'with x1 < x2 and y1 < y2')
+
+            group.append((metadata, tuple(int(v) for v in box)))
+
+        self._cancel_playlist()
+        started = self._runner.start(group[0][0],
+                                     self._screen_url,
+                                     self._screen_options,
+                                     self._handover,
+                                     self._fade_ms,
+                                     group)
+        self._announce_running()
+        return started
+
+    @public
+    def get_group(self) -> Optional[List[Tuple[str, List[int]]]]:
+        """
+        Names and boxes of the running group, None unless one runs.
+        get_running() names its first pluggram.
+        """
+        group = self._runner.group
+
+        if group is None or not self._runner.is_running:
+            return None
+
+        return [(m.name, list(box)) for m, box in group]
+
+    @public
+    def play(self,
+             entries: List[Tuple[str, float]],
+             fade_ms: Optional[int] = None) -> bool:
+        """
+        Rotate through (name, seconds) entries until start() or stop() is
+        called, preparing each pluggram ahead of its turn so it takes over
+        without a gap. fade_ms overrides the default crossfade.
+        """
+        playlist = []
+
+        for name, seconds in entries:
+            if seconds <= 0:
+                raise ValueError('Playlist entries need a positive duration')
+
+            playlist.append((self._find_by_name(name), float(seconds)))
+
+        if not playlist:
+            raise ValueError('Playlist is empty')
+
+        self._cancel_playlist()
+        self._playlist = Playlist(self._runner,
+                                  playlist,
+                                  self._screen_url,
+                                  self._screen_options,
+                                  self._fade_ms if fade_ms is None
+                                  else fade_ms,
+                                  self._announce_running)
+        self._playlist.start()
+        return True
+
+    @public
+    def get_playlist(self) -> Optional[List[Tuple[str, float]]]:
+        if self._playlist is None:
+            return None
+
+        return [(m.name, seconds) for m, seconds in self._playlist.entries]
+
     @public
     def stop(self, clear: bool) -> bool:
-        return self._runner.stop(clear)
+        self._cancel_playlist()
+        stopped = self._runner.stop(clear)
+
+        if stopped:
+            self._announce_running()
+
+        return stopped
+
+    @public
+    def get_rpc_metrics(self) -> dict:
+        """
+        Screen call counters of this daemon and, summed over every runner
+        started so far, of its runners.
+        """
+        return {'pluggramd': rpc.get_rpc_metrics(),
+                'runners': {self._screen_url: self._runner.rpc_counters}}
+
+    @public
+    def get_discovery(self) -> List[Tuple[str,
+                                          bool,
+                                          Optional[str],
+                                          float,
+                                          bool]]:
+        """
+        How each module in the programs directory fared at startup: its
+        name, whether it is a pluggram, why it failed to load if it did,
+        how long importing it took and whether the manifest spared that.
+        """
+        return [(r.name, r.meta is not None, r.error, r.elapsed_ms, r.cached)
+                for r in self._discovery]
+
+    @public
+    def get_violations(self) -> List[Tuple[float, str, int, str, str, bool]]:
+        """
+        Workers the watchdog caught over their resource limits, oldest
+        first: when, which pluggram, its pid, which limit, what happened
+        and whether the watchdog terminated it.
+        """
+        if self._watchdog is None:
+            return []
+
+        return [(v.time, v.name, v.pid, v.kind, v.detail, v.terminated)
+                for v in self._watchdog.violations]
+
+    @public
+    def get_runner_stats(self) -> List[Tuple[str, int, bool, dict]]:
+        """
+        What the running worker, and one waiting to take over, report of
+        themselves through shared memory: pluggram name, pid, whether it
+        has the screen, and tick count, tick durations, overruns, RPC calls
+        per tick and resident size among the rest of its tick stats.
+        """
+        return self._runner.runner_stats()
+
+    @public
+    def profile(self,
+                ticks: Optional[int] = None,
+                seconds: Optional[float] = None,
+                sampling=False) -> Optional[int]:
+        """
+        Profile the running pluggram's next ticks, or its ticks over the
+        next seconds, with cProfile or, with sampling, a sampling profiler
+        that adds less overhead. Returns the id to fetch the result with
+        from get_profile(), None if no pluggram runs.
+        """
+        if ticks is None and seconds is None:
+            raise ValueError('Profiling needs a number of ticks or seconds')
+
+        if (ticks is not None and ticks <= 0) or \
+                (seconds is not None and seconds <= 0):
+            raise ValueError('Profiling needs a positive duration')
+
+        running = self.get_running()
+
+        if running is None:
+            return None
+
+        if self._profiles_dir is None:
+            self._profiles_dir = tempfile.mkdtemp(prefix='pluggramd-profiles-')
+
+        mode = 'sampling' if sampling else 'cprofile'
+        profile_id = self._last_profile_id + 1
+        path = os.path.join(self._profiles_dir,
+                            f'{profile_id}.{PROFILE_FORMATS[mode]}')
+
+        if not self._runner.profile(ProfileRequest(mode,
+                                                   path,
+                                                   ticks,
+                                                   seconds)):
+            return None
+
+        self._last_profile_id = profile_id
+        self._profiles[profile_id] = (running, path)
+
+        while len(self._profiles) > PROFILES_KEPT:
+            _, (_, old_path) = self._profiles.popitem(last=False)
+
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+        return profile_id
+
+    @public
+    def get_profiles(self) -> List[Tuple[int, str, str, bool]]:
+        """
+        Requested profiles, oldest first: id, pluggram, file format
+        ("pstats" or "collapsed") and whether the profile is done.
+        """
+        return [(profile_id,
+                 name,
+                 os.path.splitext(path)[1][1:],
+                 os.path.exists(path))
+                for profile_id, (name, path) in self._profiles.items()]
+
+    @public
+    def get_profile(self,
+                    profile_id: int) -> Optional[Tuple[str, Optional[bytes]]]:
+        """
+        File format and contents of a profile, None if there is no such
+        profile. The contents are None until it is done. pstats files load
+        with pstats.Stats, collapsed stacks feed flame graph tools.
+        """
+        if profile_id not in self._profiles:
+            return None
+
+        _, path = self._profiles[profile_id]
+        fmt = os.path.splitext(path)[1][1:]
+
+        try:
+            with open(path, 'rb') as f:
+                return fmt, f.read()
+        except FileNotFoundError:
+            return fmt, None
+
+    @public
+    def get_tick_stats(self) -> Tuple[Optional[str], dict]:
+        """
+        Name of the running pluggram and its tick timing so far, or None
+        and the timing of the last one to run.
+        """
+        return self.get_running(), self._runner.tick_stats
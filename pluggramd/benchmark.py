@@ -0,0 +1,730 @@
+import os
+import sys
+import rpc
+import zmq
+import json
+import time
+import random
+import logging
+import argparse
+import importlib
+import tempfile
+import traceback
+import subprocess
+from PIL import Image
+from utils import timing_counter
+from tinyrpc import RPCClient
+from tinyrpc.dispatch import RPCDispatcher
+from tinyrpc.transports import ClientTransport
+from pluggram import call_tick, load, load_type, PluggramRunner
+from collections import defaultdict
+from typing import Dict, List, Optional
+from tinyrpc.transports.zmq import ZmqClientTransport
+from tinyrpc.protocols.msgpackrpc import MSGPACKRPCProtocol
+
+
+BUILTIN_PROGRAMS = ['scroll', 'wallclock', 'timer', 'backsoon', 'rickroll']
+DEFAULT_PAYLOAD_SIZES = [0, 1024, 16384, 65536]
+# screend modules named like pluggramd's, imported apart by in_process_proxy()
+SCREEND_MODULES = ('utils', 'api', 'dummy_ws281x')
+SCREEND_CONFIG = """width = {width}
+height = {height}
+max_brightness = 190
+frequency = 800000
+dma_channel = 10
+gpio_pin = 18
+gpio_channel = 0
+inverted = false
+antialiasing = false
+fonts_dir = "{fonts_dir}"
+iface = "lo"
+"""
+
+
+def percentile(ordered: List[float], pct: float) -> float:
+    if not ordered:
+        return 0.0
+
+    index = int(round((pct / 100) * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def summarize(timings: List[float]) -> dict:
+    ordered = sorted(timings)
+    return {
+        'count': len(ordered),
+        'mean_ms': sum(ordered) / len(ordered) if ordered else 0.0,
+        'p50_ms': percentile(ordered, 50),
+        'p95_ms': percentile(ordered, 95),
+        'p99_ms': percentile(ordered, 99),
+        'max_ms': ordered[-1] if ordered else 0.0
+    }
+
+
+def process_cpu_seconds(pid: int) -> Optional[float]:
+    """
+    User plus system CPU time of a process from procfs. Linux only,
+    None elsewhere.
+    """
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as sf:
+            fields = sf.read().rpartition(')')[2].split()
+    except OSError:
+        return None
+
+    # fields 14 and 15 of stat, offset by the two fields before ")"
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class TimedProxy:
+    """
+    Wraps an RPC proxy to record the round trip time of every call.
+    """
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+
+    @property
+    def call_count(self):
+        return sum(len(t) for t in self.latencies.values())
+
+    def reset(self):
+        self.latencies.clear()
+
+    def __getattr__(self, name):
+        func = getattr(self._proxy, name)
+
+        def timed(*args):
+            marker = timing_counter()
+            rv = func(*args)
+            self.latencies[name].append(timing_counter() - marker)
+            return rv
+
+        return timed
+
+
+def transport_url(transport: str, port: int) -> str:
+    if transport == 'ipc':
+        return f'ipc://{tempfile.gettempdir()}/ledscreen-bench-{os.getpid()}'
+    return f'tcp://127.0.0.1:{port}'
+
+
+def start_screend(screend_dir: str,
+                  url: str,
+                  fonts_dir: str,
+                  width: int,
+                  height: int,
+                  wire_time: bool) -> subprocess.Popen:
+    fd, config_path = tempfile.mkstemp(suffix='.toml')
+    with os.fdopen(fd, 'w') as cf:
+        cf.write(SCREEND_CONFIG.format(width=width,
+                                       height=height,
+                                       fonts_dir=os.path.abspath(fonts_dir)))
+
+    args = [sys.executable, '-O', 'main.py', '--dummy', '-c', config_path]
+
+    if wire_time:
+        args.append('--wire-time')
+
+    proc = subprocess.Popen(args + [url],
+                            cwd=screend_dir,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    proc.config_path = config_path
+    return proc
+
+
+def stop_screend(proc: subprocess.Popen):
+    proc.terminate()
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+    os.remove(proc.config_path)
+
+
+def connect(context,
+            url: str,
+            timeout: Optional[float] = None,
+            pipelined=False):
+    if pipelined:
+        return rpc.PipelinedClient.create(context, url).get_proxy()
+
+    client = RPCClient(
+        MSGPACKRPCProtocol(),
+        ZmqClientTransport.create(context, url, timeout=timeout)
+    )
+    return client.get_proxy()
+
+
+class LoopbackTransport(ClientTransport):
+    """
+    Client transport that hands each request to a dispatcher in this
+    process, serialized as it would cross the wire.
+    """
+
+    def __init__(self, dispatcher: RPCDispatcher):
+        self._protocol = MSGPACKRPCProtocol()
+        self._dispatcher = dispatcher
+
+    def send_message(self, message: bytes, expect_reply: bool = True):
+        request = self._protocol.parse_request(message)
+        response = self._dispatcher.dispatch(request)
+
+        if expect_reply:
+            return response.serialize()
+
+
+def in_process_proxy(screend_dir: str, fonts_dir: str, w: int, h: int):
+    """
+    Proxy of screend's Screen on an emulated strip in this process, so
+    drawing can be checked without spawning the daemon.
+    """
+    saved = {name: sys.modules.pop(name, None) for name in SCREEND_MODULES}
+    sys.path.insert(0, os.path.abspath(screend_dir))
+
+    try:
+        api = importlib.import_module('api')
+        strip_class = importlib.import_module('dummy_ws281x').DummyStrip
+    finally:
+        sys.path.pop(0)
+
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    screen = api.Screen(w,
+                        h,
+                        18,
+                        800000,
+                        10,
+                        255,
+                        False,
+                        0,
+                        fonts_dir,
+                        strip_class=strip_class)
+    # every clear() is logged at INFO
+    screen.LOG.setLevel(logging.WARNING)
+    dispatcher = RPCDispatcher()
+    dispatcher.register_instance(screen)
+    return RPCClient(MSGPACKRPCProtocol(),
+                     LoopbackTransport(dispatcher)).get_proxy()
+
+
+def wait_for_screend(context, url: str, deadline_s: float):
+    started = time.monotonic()
+
+    while time.monotonic() - started < deadline_s:
+        probe = connect(context, url, timeout=0.5)
+        try:
+            probe.ping()
+            return True
+        except Exception:
+            pass
+        finally:
+            probe.client.transport.socket.close(linger=0)
+    return False
+
+
+def create_screen(proxy, fonts_dir: Optional[str]):
+    if fonts_dir is not None:
+        return rpc.LocalScreen(proxy, fonts_dir)
+    return rpc.Screen(proxy)
+
+
+def replay_program(meta,
+                   timed: TimedProxy,
+                   screend_pid: int,
+                   duration_s: float,
+                   paced: bool,
+                   local_fonts_dir: Optional[str] = None) -> dict:
+    klass_name, klass = load_type(meta.module_path)
+    instance = klass(create_screen(timed, local_fonts_dir),
+                     **meta.get_filled_options())
+    timed.reset()
+
+    rate = meta.tick_rate if paced else None
+    ticks = 0
+    server_cpu = process_cpu_seconds(screend_pid)
+    client_cpu = time.process_time()
+    started = timing_counter()
+    deadline = started + duration_s * 1000
+    next_tick = started
+
+    while True:
+        now = timing_counter()
+
+        if now >= deadline:
+            break
+
+        if rate is not None and now < next_tick:
+            time.sleep((next_tick - now) / 1000)
+            continue
+
+        # the nominal step keeps the work per tick the same at any pace
+        call_tick(instance, meta.tick_rate or 0)
+        ticks += 1
+
+        if rate is not None:
+            next_tick += rate
+
+    elapsed_s = (timing_counter() - started) / 1000
+    client_cpu = time.process_time() - client_cpu
+    server_end = process_cpu_seconds(screend_pid)
+    frames = len(timed.latencies.get('render', [])) + \
+        len(timed.latencies.get('render_frame', []))
+    calls = timed.call_count
+    all_timings = [t for ts in timed.latencies.values() for t in ts]
+
+    result = {
+        'paced': paced,
+        'local': local_fonts_dir is not None,
+        'tick_rate_ms': meta.tick_rate,
+        'elapsed_s': elapsed_s,
+        'ticks': ticks,
+        'frames': frames,
+        'fps': frames / elapsed_s if elapsed_s > 0 else 0.0,
+        'rpc_calls': calls,
+        'rpc_per_frame': calls / frames if frames else None,
+        'latency': summarize(all_timings),
+        'latency_by_method': {m: summarize(t)
+                              for m, t in timed.latencies.items()},
+        'cpu_percent': {
+            'client': client_cpu / elapsed_s * 100,
+            'screend': ((server_end - server_cpu) / elapsed_s * 100)
+            if server_cpu is not None and server_end is not None else None
+        }
+    }
+    return result
+
+
+def payload_sweep(timed: TimedProxy, sizes: List[int], count: int) -> dict:
+    results = {}
+
+    for size in sizes:
+        payload = bytes(random.getrandbits(8) for _ in range(size))
+        timed.reset()
+
+        for _ in range(count):
+            timed.ping(payload)
+
+        stats = summarize(timed.latencies['ping'])
+        mean_s = stats['mean_ms'] / 1000
+        stats['mb_per_sec'] = (size / mean_s) / 1e6 if mean_s > 0 else 0.0
+        results[str(size)] = stats
+        print(f'payload {size:>8} bytes: p50 {stats["p50_ms"]:.3f}ms '
+              f'p95 {stats["p95_ms"]:.3f}ms {stats["mb_per_sec"]:.2f} MB/s')
+
+    return results
+
+
+def primitive_scenarios(fonts: List[str], width: int, height: int) -> list:
+    """
+    Drawing sequences that exercise every primitive LocalScreen rasterizes
+    itself. Each takes a screen and leaves a frame on it.
+    """
+    cx, cy = width // 2, height // 2
+    rgb = Image.new('RGB', (cx, cy), 0x3366CC)
+    rgba = Image.new('RGBA', (cx, cy), (200, 40, 90, 128))
+    palette = Image.new('P', (cx, cy), 7)
+    palette.putpalette([(i * 37) % 256 for i in range(768)])
+
+    def fill(s):
+        s.fill(0x112233)
+
+    def pixels(s):
+        s.clear()
+        for i in range(0, width, 3):
+            s.set_pixel(i, (i * 7) % height, 0xFF00FF - i)
+
+    def lines(s):
+        s.clear()
+        s.draw_line(0, 0, 0x00FF00, 1, False)
+        s.draw_line(cx, cy, 0xFFFF00, 3, True)
+
+    def pastes(s):
+        s.clear()
+        s.paste(rgb)
+        s.paste(rgba, (cx, 0))
+        s.paste(palette, (0, cy))
+
+    scenarios = [('fill', fill),
+                 ('set_pixel', pixels),
+                 ('draw_line', lines),
+                 ('paste', pastes)]
+
+    for name in fonts:
+        def text(s, n=name):
+            s.clear()
+            s.set_font(n, 9)
+            s.draw_text(1, 1, 0xFFFFFF, 'Ag 12:34', 'lt', None, 'left',
+                        None, None)
+            s.draw_text(cx, cy, 0xFF8800, 'mid', 'mm', None, 'center',
+                        1, 0x0000FF)
+            s.draw_text(width - 1, height - 1, 0x00FFAA, 'two\nlines', 'rd',
+                        2, 'right', None, None)
+
+        scenarios.append((f'draw_text:{name}', text))
+
+    return scenarios
+
+
+def verify_local(proxy,
+                 fonts_dir: str,
+                 metas: dict,
+                 programs: List[str],
+                 ticks: int) -> int:
+    """
+    Draw the same calls through rpc.Screen and rpc.LocalScreen against one
+    screen daemon and compare the frames it ends up holding. Returns the
+    number of mismatches.
+    """
+    remote = rpc.Screen(proxy)
+    local = rpc.LocalScreen(proxy, fonts_dir)
+    fonts = sorted(n for n in os.listdir(fonts_dir) if n.endswith('.ttf'))
+    mismatches = 0
+
+    for name, scenario in primitive_scenarios(fonts,
+                                              remote.width,
+                                              remote.height):
+        scenario(remote)
+        remote.render()
+        expected = proxy.get_frame()
+        scenario(local)
+        local.render()
+        same = proxy.get_frame() == expected
+        mismatches += 0 if same else 1
+        print(f'{"ok" if same else "MISMATCH":<8} {name}')
+
+    for program_name in programs:
+        pgm = metas.get(program_name)
+
+        if pgm is None:
+            print(f'"{program_name}" not found or was disqualified')
+            continue
+
+        klass_name, klass = load_type(pgm.module_path)
+        pair = (klass(remote, **pgm.get_filled_options()),
+                klass(local, **pgm.get_filled_options()))
+        compared = 0
+        differing = 0
+
+        for tick in range(ticks):
+            second = int(time.time())
+            frames = []
+
+            for instance in pair:
+                random.seed(tick)
+                call_tick(instance, pgm.tick_rate or 0)
+                frames.append(proxy.get_frame())
+
+            # time driven programs may straddle a second between the two
+            if int(time.time()) != second:
+                continue
+
+            compared += 1
+            differing += 0 if frames[0] == frames[1] else 1
+
+        mismatches += differing
+        print(f'{"ok" if not differing else "MISMATCH":<8} {program_name}: '
+              f'{compared - differing}/{compared} ticks identical')
+
+    return mismatches
+
+
+def start_latency(metas: dict,
+                  names: List[str],
+                  url: str,
+                  screen_options: dict,
+                  count: int,
+                  zygote: bool) -> dict:
+    """
+    Milliseconds from PluggramRunner.start() until the first tick of each
+    program has finished, including its first render().
+    """
+    runner = PluggramRunner()
+
+    if zygote:
+        runner.use_zygote([m.module_path for m in metas.values()],
+                          url,
+                          screen_options)
+
+    results = {}
+
+    for name in names:
+        timings = []
+
+        for _ in range(count):
+            # let the zygote warm its next spare, as between user clicks
+            time.sleep(0.5)
+            marker = time.perf_counter()
+            runner.start(metas[name], url, screen_options)
+
+            while runner.tick_stats['ticks'] < 1 and runner.is_running:
+                time.sleep(0.0005)
+
+            timings.append((time.perf_counter() - marker) * 1000)
+            runner.stop()
+
+        results[name] = summarize(timings)
+
+    return results
+
+
+def print_program(name: str, result: dict):
+    cpu = result['cpu_percent']
+    screend_cpu = cpu['screend']
+    rpf = result['rpc_per_frame']
+    print(f'{name:<10} {"local" if result["local"] else "rpc":<5} '
+          f'{"paced" if result["paced"] else "fast":<5} '
+          f'{result["fps"]:>8.1f} fps '
+          f'{(rpf if rpf is not None else 0):>5.1f} rpc/frame '
+          f'p50 {result["latency"]["p50_ms"]:.3f}ms '
+          f'p99 {result["latency"]["p99_ms"]:.3f}ms '
+          f'cpu client {cpu["client"]:.0f}% '
+          f'screend {screend_cpu if screend_cpu is not None else -1:.0f}%')
+
+
+def get_cla():
+    ap = argparse.ArgumentParser(description='End-to-end RPC throughput and '
+                                             'latency benchmark against an '
+                                             'emulated screen daemon')
+    ap.add_argument('-F', '--fonts-dir',
+                    type=str,
+                    metavar='DIRECTORY',
+                    dest='fonts_dir',
+                    default='../screend/fonts',
+                    help='Fonts directory for the spawned screen daemon.')
+    ap.add_argument('-s', '--screend',
+                    type=str,
+                    metavar='DIRECTORY',
+                    dest='screend_dir',
+                    default='../screend',
+                    help='Location of the screend module.')
+    ap.add_argument('-u', '--url',
+                    type=str,
+                    metavar='URL',
+                    dest='url',
+                    default=None,
+                    help='Benchmark an already running screen daemon instead '
+                         'of spawning one. CPU usage is not reported for it.')
+    ap.add_argument('-x', '--transport',
+                    type=str,
+                    choices=['tcp', 'ipc'],
+                    dest='transport',
+                    default='tcp',
+                    help='ZeroMQ transport for the spawned screen daemon.')
+    ap.add_argument('--wire-time',
+                    action='store_true',
+                    dest='wire_time',
+                    help='Make the spawned screen daemon emulate WS2812 '
+                         'frame transfer time.')
+    ap.add_argument('--pipelined',
+                    action='store_true',
+                    dest='pipelined',
+                    help='Send drawing calls one-way over a DEALER socket '
+                         'instead of waiting for each reply.')
+    ap.add_argument('--local',
+                    action='store_true',
+                    dest='local',
+                    help='Draw on a local canvas with the fonts directory and '
+                         'send one raw frame per render.')
+    ap.add_argument('--verify-local',
+                    type=int,
+                    metavar='TICKS',
+                    dest='verify_ticks',
+                    default=None,
+                    help='Instead of benchmarking, check that local canvas '
+                         'frames match screen daemon drawing for the '
+                         'primitives and TICKS ticks of each program. Exits '
+                         'with 3 on any mismatch.')
+    ap.add_argument('--in-process',
+                    action='store_true',
+                    dest='in_process',
+                    help='With --verify-local, draw on screend\'s Screen in '
+                         'this process instead of a screen daemon.')
+    ap.add_argument('--start-latency',
+                    type=int,
+                    metavar='COUNT',
+                    dest='start_count',
+                    default=None,
+                    help='Instead of benchmarking, start each program COUNT '
+                         'times with freshly spawned workers and with the '
+                         'zygote, and report the time to its first frame.')
+    ap.add_argument('--port',
+                    type=int,
+                    dest='port',
+                    default=9990,
+                    help='TCP port for the spawned screen daemon.')
+    ap.add_argument('-p', '--program',
+                    type=str,
+                    metavar='NAME',
+                    dest='programs',
+                    action='append',
+                    default=None,
+                    help='Pluggram to replay. May be given more than once. '
+                         'Default is every built-in program.')
+    ap.add_argument('--pace',
+                    type=str,
+                    choices=['fast', 'real', 'both'],
+                    dest='pace',
+                    default='both',
+                    help='Tick as fast as possible, at each program\'s '
+                         'TICK_RATE or both.')
+    ap.add_argument('-t', '--duration',
+                    type=float,
+                    metavar='SECONDS',
+                    dest='duration',
+                    default=5.0,
+                    help='How long to replay each program.')
+    ap.add_argument('--payload-sizes',
+                    type=lambda t: [int(s) for s in t.split(',') if s],
+                    metavar='N,N,...',
+                    dest='payload_sizes',
+                    default=DEFAULT_PAYLOAD_SIZES,
+                    help='Byte sizes for the msgpack payload sweep. Pass an '
+                         'empty string to skip it.')
+    ap.add_argument('--payload-count',
+                    type=int,
+                    metavar='COUNT',
+                    dest='payload_count',
+                    default=200,
+                    help='Round trips per payload size.')
+    ap.add_argument('-W', '--width', type=int, dest='width', default=54)
+    ap.add_argument('-H', '--height', type=int, dest='height', default=36)
+    ap.add_argument('-o', '--output',
+                    type=str,
+                    metavar='PATH',
+                    dest='output',
+                    default=None,
+                    help='Write results JSON to this file.')
+    cla = ap.parse_args()
+
+    if cla.in_process and cla.verify_ticks is None:
+        ap.error('--in-process only applies to --verify-local')
+
+    return cla
+
+
+if __name__ == '__main__':
+    cla = get_cla()
+
+    if cla.in_process:
+        failed = verify_local(in_process_proxy(cla.screend_dir,
+                                               cla.fonts_dir,
+                                               cla.width,
+                                               cla.height),
+                              cla.fonts_dir,
+                              {m.name: m for m in load('programs', 1)
+                               if m is not None},
+                              cla.programs or BUILTIN_PROGRAMS,
+                              cla.verify_ticks)
+        print(f'{failed} mismatches')
+        exit(3 if failed else 0)
+
+    context = zmq.Context()
+    screend_proc = None
+    url = cla.url
+
+    if url is None:
+        url = transport_url(cla.transport, cla.port)
+        screend_proc = start_screend(cla.screend_dir,
+                                     url,
+                                     cla.fonts_dir,
+                                     cla.width,
+                                     cla.height,
+                                     cla.wire_time)
+        print(f'started screend ({screend_proc.pid}) at {url}')
+
+    paces = {'fast': [False], 'real': [True], 'both': [False, True]}[cla.pace]
+    report = {'url': url,
+              'pipelined': cla.pipelined,
+              'programs': {},
+              'payloads': None}
+
+    try:
+        if not wait_for_screend(context, url, 10):
+            print('screend did not answer in time')
+            exit(2)
+
+        timed_proxy = TimedProxy(connect(context,
+                                         url,
+                                         pipelined=cla.pipelined))
+        metas = {m.name: m for m in load('programs', 1) if m is not None}
+
+        if cla.verify_ticks is not None:
+            failed = verify_local(connect(context, url),
+                                  cla.fonts_dir,
+                                  metas,
+                                  cla.programs or BUILTIN_PROGRAMS,
+                                  cla.verify_ticks)
+            print(f'{failed} mismatches')
+            exit(3 if failed else 0)
+
+        if cla.start_count is not None:
+            report['start_latency'] = {}
+            screen_options = {'pipelined': cla.pipelined,
+                              'fonts_dir': cla.fonts_dir if cla.local
+                              else None}
+
+            for mode in ('spawn', 'zygote'):
+                results = start_latency(metas,
+                                        cla.programs or BUILTIN_PROGRAMS,
+                                        url,
+                                        screen_options,
+                                        cla.start_count,
+                                        mode == 'zygote')
+                report['start_latency'][mode] = results
+
+                for name, result in results.items():
+                    print(f'{name:<10} {mode:<6} first frame '
+                          f'p50 {result["p50_ms"]:.1f}ms '
+                          f'max {result["max_ms"]:.1f}ms')
+
+            if cla.output is not None:
+                with open(cla.output, 'w') as rf:
+                    json.dump(report, rf, indent=2)
+                print(f'wrote results to "{cla.output}"')
+            exit(0)
+
+        for program_name in cla.programs or BUILTIN_PROGRAMS:
+            pgm = metas.get(program_name)
+
+            if pgm is None:
+                print(f'"{program_name}" not found or was disqualified')
+                continue
+
+            report['programs'][program_name] = []
+            for pace in paces:
+                try:
+                    res = replay_program(pgm,
+                                         timed_proxy,
+                                         screend_proc.pid
+                                         if screend_proc else -1,
+                                         cla.duration,
+                                         pace,
+                                         cla.fonts_dir if cla.local else None)
+                except Exception as e:
+                    print(f'exception {e.__class__.__name__} replaying '
+                          f'"{program_name}": {str(e)}')
+                    print(traceback.format_exc())
+                    continue
+
+                report['programs'][program_name].append(res)
+                print_program(program_name, res)
+
+        if cla.payload_sizes:
+            report['payloads'] = payload_sweep(timed_proxy,
+                                               cla.payload_sizes,
+                                               cla.payload_count)
+    finally:
+        if screend_proc is not None:
+            stop_screend(screend_proc)
+
+    if cla.output is not None:
+        with open(cla.output, 'w') as rf:
+            json.dump(report, rf, indent=2)
+        print(f'wrote results to "{cla.output}"')
@@ -4,9 +4,10 @@ import zmq
 import json
 import argparse
 import traceback
-from utils import timing_counter
+from threading import Event
 from tinyrpc import RPCClient
-from pluggram import load, load_type
+from pluggram import call_tick, load, load_type
+from scheduler import TickScheduler
 from tinyrpc.transports.zmq import ZmqClientTransport
 from tinyrpc.protocols.msgpackrpc import MSGPACKRPCProtocol
 
@@ -65,7 +66,7 @@ if __name__ == '__main__':
             print('Frame output path does not exist or is not a directory')
             exit(2)
 
-    metas = load('programs', 1)
+    metas = load(cla.programs_dir, 1)
     print(f'loaded {len(metas)} pluggrams')
 
     if len(metas) > 0:
@@ -101,34 +102,29 @@ if __name__ == '__main__':
             print(traceback.format_exc())
             exit(100)
 
-        output_dir = 'frames'
         frame_count = 1
-        rate = pgm.tick_rate
-        marker = -rate if rate is not None else timing_counter()
+        scheduler = TickScheduler(pgm.tick_rate, Event(), pgm.tick_align)
         try:
-            while True:
-                if (rate is not None and timing_counter() - marker > rate) or \
-                        rate is None:
-                    marker = timing_counter()
-                    try:
-                        instance.tick()
-                    except Exception as e:
-                        print(f'exception {e.__class__.__name__} updating '
-                              f'pluggram "{pgm.name}": {str(e)}')
-                        print(traceback.format_exc())
-                        exit(101)
-
-                    if frames_dir is not None:
-                        filename = f'{frame_count}.png'
-                        path = os.path.join(output_dir, filename)
-                        screen.write_file(path)
-
-                    print(f'frame #{frame_count}')
-                    frame_count += 1
-
-                    if end_frame > 0:
-                        if frame_count > end_frame:
-                            break
+            while scheduler.wait():
+                try:
+                    call_tick(instance, scheduler.delta_ms)
+                except Exception as e:
+                    print(f'exception {e.__class__.__name__} updating '
+                          f'pluggram "{pgm.name}": {str(e)}')
+                    print(traceback.format_exc())
+                    exit(101)
+
+                if frames_dir is not None:
+                    filename = f'{frame_count}.png'
+                    path = os.path.join(frames_dir, filename)
+                    screen.write_file(path)
+
+                print(f'frame #{frame_count}')
+                frame_count += 1
+
+                if end_frame > 0:
+                    if frame_count > end_frame:
+                        break
         except KeyboardInterrupt:
             print('interrupted')
             exit(0)
@@ -0,0 +1,71 @@
+import zmq
+import time
+import msgpack
+import logging
+from utils import configure_logger
+from typing import Callable, Optional
+from threading import Event, Lock, Thread
+
+
+LOG = logging.getLogger('pluggramd.events')
+configure_logger(LOG)
+HEARTBEAT_S = 2.0
+
+
+class EventPublisher:
+    """
+    PUB socket announcing changes to the running pluggram and the catalog.
+
+    Messages are a topic frame and a msgpack map. Every map carries the
+    publisher's epoch and a sequence number shared by all topics, so a
+    subscriber can tell when it missed something. Heartbeats repeat the
+    current state for subscribers that joined late or lost messages.
+    """
+
+    def __init__(self,
+                 context: zmq.Context,
+                 url: str,
+                 heartbeat_s=HEARTBEAT_S):
+        self._socket = context.socket(zmq.PUB)
+        self._socket.bind(url)
+        self._state: Optional[Callable[[], dict]] = None
+        self._heartbeat_s = heartbeat_s
+        self._epoch = int(time.time() * 1000)
+        self._seq = 0
+        # the heartbeat thread publishes too and sockets are not thread safe
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread: Optional[Thread] = None
+        LOG.info(f'publishing events on {url}')
+
+    def publish(self, topic: str, **fields):
+        with self._lock:
+            self._seq += 1
+            fields.update({'epoch': self._epoch,
+                           'seq': self._seq,
+                           'time': time.time()})
+            self._socket.send_multipart([topic.encode(),
+                                         msgpack.packb(fields,
+                                                       use_bin_type=True)])
+
+    def _heartbeat(self):
+        while not self._stop.wait(self._heartbeat_s):
+            try:
+                self.publish('heartbeat', **self._state())
+            except Exception as e:
+                LOG.warning(f'heartbeat failed: {str(e)}')
+
+    def start_heartbeat(self, state: Callable[[], dict]):
+        self._state = state
+        self._thread = Thread(target=self._heartbeat,
+                              name='event-heartbeat',
+                              daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        self._socket.close(linger=0)
@@ -0,0 +1,375 @@
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import datetime
+import traceback
+from PIL import Image
+from rpc import LocalScreen
+from typing import List, Optional
+from benchmark import BUILTIN_PROGRAMS
+from aiorpc import AsyncScreen, Compositor, ZoneScreen
+from pluggram import PluggramMetadata, call_tick, load, load_type
+
+
+DEFAULT_START = '2000-01-01T12:00:00'
+# the clock moves this far per tick for pluggrams without a tick rate
+DEFAULT_STEP_MS = 20
+# the harness's own timing, kept before the clock replaces perf_counter
+real_perf_counter = time.perf_counter
+
+
+class VirtualClock:
+    """
+    Time as pluggrams under test see it. It reads start until advance()
+    moves it, however long ticks really take. install() makes
+    datetime.now(), datetime.utcnow(), time.time(), time.perf_counter() and
+    with it utils.timing_counter() read this clock; local time and UTC are
+    both the clock's time. time.monotonic() keeps real time for asyncio.
+    """
+
+    @property
+    def now(self) -> datetime.datetime:
+        return self._start + datetime.timedelta(milliseconds=self.elapsed_ms)
+
+    def __init__(self, start: datetime.datetime):
+        self._start = start
+        self._epoch = start.replace(tzinfo=datetime.timezone.utc).timestamp()
+        self.elapsed_ms = 0.0
+
+    def advance(self, ms: float):
+        self.elapsed_ms += ms
+
+    def install(self):
+        """
+        Patch the clock in. Pluggram modules must be loaded afterwards,
+        so that names they import from datetime are the patched ones.
+        """
+        clock = self
+
+        class VirtualDatetime(datetime.datetime):
+
+            @classmethod
+            def now(cls, tz=None):
+                now = clock.now
+                return cls.combine(now.date(), now.time(), tz)
+
+            @classmethod
+            def utcnow(cls):
+                return cls.now()
+
+            @classmethod
+            def today(cls):
+                return cls.now()
+
+        datetime.datetime = VirtualDatetime
+        time.time = lambda: clock._epoch + clock.elapsed_ms / 1000
+        time.perf_counter = lambda: clock.elapsed_ms / 1000
+
+
+class OfflineScreen:
+    """
+    screend's half of the calls rpc.LocalScreen and aiorpc.ZoneScreen
+    make, in this process: describes a screen and keeps the last frame
+    rendered. Stands in for both the sync RPC proxy and the async client.
+    """
+
+    def __init__(self, width: int, height: int, max_brightness=190):
+        self._width = width
+        self._height = height
+        self._max_brightness = max_brightness
+        self.frame = bytes(width * height * 3)
+        self.frames_rendered = 0
+        self.brightness = max_brightness
+
+    def describe(self) -> dict:
+        return {'epoch': 0,
+                'width': self._width,
+                'height': self._height,
+                'pixel_count': self._width * self._height,
+                'center': (int(round(self._width / 2)),
+                           int(round(self._height / 2))),
+                'max_brightness': self._max_brightness}
+
+    def render_frame(self, frame: bytes) -> int:
+        self.frame = bytes(frame)
+        self.frames_rendered += 1
+        return 0
+
+    def set_brightness(self, v: int):
+        self.brightness = v
+
+    async def call(self, method: str, *args):
+        return getattr(self, method)(*args)
+
+
+def render_sync(live_type: type,
+                meta: PluggramMetadata,
+                backend: OfflineScreen,
+                clock: VirtualClock,
+                fonts_dir: str,
+                ticks: int) -> List[bytes]:
+    instance = live_type(LocalScreen(backend, fonts_dir),
+                         **meta.get_filled_options())
+    step_ms = meta.tick_rate or DEFAULT_STEP_MS
+    frames = []
+
+    for _ in range(ticks):
+        call_tick(instance, step_ms)
+        frames.append(backend.frame)
+        clock.advance(step_ms)
+
+    return frames
+
+
+async def render_async(live_type: type,
+                       meta: PluggramMetadata,
+                       backend: OfflineScreen,
+                       clock: VirtualClock,
+                       fonts_dir: str,
+                       ticks: int) -> List[bytes]:
+    screen = AsyncScreen(backend)
+    await screen.connect()
+    zone = ZoneScreen(screen,
+                      Compositor(screen),
+                      (0, 0, screen.width, screen.height),
+                      fonts_dir)
+    instance = live_type(zone, **meta.get_filled_options())
+    setup = getattr(instance, 'setup', None)
+
+    if setup is not None:
+        await setup()
+
+    step_ms = meta.tick_rate or DEFAULT_STEP_MS
+    frames = []
+
+    for _ in range(ticks):
+        await call_tick(instance, step_ms)
+        # background tasks of the pluggram get their turn between ticks
+        await asyncio.sleep(0)
+        frames.append(backend.frame)
+        clock.advance(step_ms)
+
+    teardown = getattr(instance, 'teardown', None)
+
+    if teardown is not None:
+        await teardown()
+
+    return frames
+
+
+def render_program(meta: PluggramMetadata,
+                   clock: VirtualClock,
+                   fonts_dir: str,
+                   ticks: int,
+                   width: int,
+                   height: int) -> List[bytes]:
+    """
+    The frame on screen after each of the first ticks ticks of meta's
+    pluggram, ticked back to back on the virtual clock.
+    """
+    klass_name, live_type = load_type(meta.module_path)
+    backend = OfflineScreen(width, height)
+
+    if meta.is_async:
+        return asyncio.run(render_async(live_type,
+                                        meta,
+                                        backend,
+                                        clock,
+                                        fonts_dir,
+                                        ticks))
+
+    return render_sync(live_type, meta, backend, clock, fonts_dir, ticks)
+
+
+def frame_hash(frame: bytes) -> str:
+    return hashlib.sha1(frame).hexdigest()
+
+
+def compare_golden(name: str,
+                   hashes: List[str],
+                   golden: Optional[List[str]]) -> bool:
+    if golden is None:
+        print(f'{name:<10} has no golden frames')
+        return False
+
+    for tick, (actual, expected) in enumerate(zip(hashes, golden)):
+        if actual != expected:
+            print(f'{name:<10} differs from golden frames at tick {tick}')
+            return False
+
+    if len(hashes) != len(golden):
+        print(f'{name:<10} has {len(golden)} golden frames, rendered '
+              f'{len(hashes)}')
+        return False
+
+    print(f'{name:<10} matches golden frames')
+    return True
+
+
+def get_cla():
+    ap = argparse.ArgumentParser(description='Render pluggrams offline on a '
+                                             'virtual clock, as fast as '
+                                             'they draw, and check frames '
+                                             'against golden hashes')
+    ap.add_argument('-F', '--fonts-dir',
+                    type=str,
+                    metavar='DIRECTORY',
+                    dest='fonts_dir',
+                    default='../screend/fonts',
+                    help='Fonts directory to draw text with.')
+    ap.add_argument('-p',
+                    type=str,
+                    metavar='DIRECTORY',
+                    dest='programs_dir',
+                    default='programs',
+                    help='Location of pluggram modules. Default is "programs"')
+    ap.add_argument('-n', '--ticks',
+                    type=int,
+                    metavar='COUNT',
+                    dest='ticks',
+                    default=100,
+                    help='How many ticks to render of each program.')
+    ap.add_argument('-f',
+                    type=str,
+                    metavar='DIRECTORY',
+                    dest='frames_dir',
+                    default=None,
+                    help='Directory to write the frame after each tick to, '
+                         'as <program>-<tick>.png.')
+    ap.add_argument('--start',
+                    type=datetime.datetime.fromisoformat,
+                    metavar='ISO_TIME',
+                    dest='start',
+                    default=DEFAULT_START,
+                    help=f'Time the virtual clock starts at. Default is '
+                         f'{DEFAULT_START}.')
+    ap.add_argument('--seed',
+                    type=int,
+                    dest='seed',
+                    default=0,
+                    help='Seed for random, set before each program.')
+    ap.add_argument('--user-options',
+                    action='store_true',
+                    dest='user_options',
+                    help='Use saved user options instead of defaults.')
+    ap.add_argument('--golden',
+                    type=str,
+                    metavar='PATH',
+                    dest='golden',
+                    default=None,
+                    help='Check frames against the golden hashes in this '
+                         'file. Exits with 3 on any mismatch.')
+    ap.add_argument('--update-golden',
+                    action='store_true',
+                    dest='update_golden',
+                    help='Write the rendered frame hashes to the --golden '
+                         'file instead of checking them.')
+    ap.add_argument('-W', '--width', type=int, dest='width', default=54)
+    ap.add_argument('-H', '--height', type=int, dest='height', default=36)
+    ap.add_argument(type=str,
+                    metavar='PROGRAM',
+                    dest='programs',
+                    nargs='*',
+                    help='Pluggrams to render. Default is every built-in '
+                         'program.')
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    cla = get_cla()
+
+    if cla.update_golden and cla.golden is None:
+        print('--update-golden needs --golden')
+        exit(2)
+
+    if cla.frames_dir is not None and not os.path.isdir(cla.frames_dir):
+        print('Frame output path does not exist or is not a directory')
+        exit(2)
+
+    metas = {m.name: m for m in load(cla.programs_dir, 1) if m is not None}
+    clock = VirtualClock(cla.start)
+    # pluggram modules are loaded again from here on, seeing the clock
+    clock.install()
+    settings = {'ticks': cla.ticks,
+                'width': cla.width,
+                'height': cla.height,
+                'start': cla.start.isoformat(),
+                'seed': cla.seed}
+    golden = None
+
+    if cla.golden is not None and not cla.update_golden:
+        with open(cla.golden, 'r') as gf:
+            golden = json.load(gf)
+
+        if golden['settings'] != settings:
+            print(f'golden frames were rendered with {golden["settings"]}, '
+                  f'not {settings}')
+            exit(2)
+
+    hashes = {}
+    failed = 0
+
+    for program_name in cla.programs or BUILTIN_PROGRAMS:
+        pgm = metas.get(program_name)
+
+        if pgm is None:
+            print(f'"{program_name}" not found or was disqualified')
+            failed += 1
+            continue
+
+        if cla.user_options and pgm.has_user_options:
+            pgm.load_options()
+
+        random.seed(cla.seed)
+        clock.elapsed_ms = 0.0
+        started = real_perf_counter()
+
+        try:
+            frames = render_program(pgm,
+                                    clock,
+                                    cla.fonts_dir,
+                                    cla.ticks,
+                                    cla.width,
+                                    cla.height)
+        except Exception as e:
+            print(f'exception {e.__class__.__name__} rendering '
+                  f'"{program_name}": {str(e)}')
+            print(traceback.format_exc())
+            failed += 1
+            continue
+
+        elapsed_s = real_perf_counter() - started
+        print(f'{program_name:<10} {len(frames)} ticks in {elapsed_s:.2f}s '
+              f'({len(frames) / elapsed_s:.0f} ticks/s), '
+              f'{clock.elapsed_ms / 1000:.1f}s of virtual time')
+        hashes[program_name] = [frame_hash(f) for f in frames]
+
+        if cla.frames_dir is not None:
+            for tick, frame in enumerate(frames):
+                path = os.path.join(cla.frames_dir,
+                                    f'{program_name}-{tick:05d}.png')
+                Image.frombytes('RGB', (cla.width, cla.height), frame) \
+                    .save(path)
+
+        if golden is not None and \
+                not compare_golden(program_name,
+                                   hashes[program_name],
+                                   golden['programs'].get(program_name)):
+            failed += 1
+
+    if cla.update_golden:
+        with open(cla.golden, 'w') as gf:
+            json.dump({'settings': settings, 'programs': hashes}, gf, indent=1)
+        print(f'wrote golden frames of {len(hashes)} programs to '
+              f'"{cla.golden}"')
+
+    if failed:
+        print(f'{failed} programs failed')
+        exit(3)
+else:
+    print('This script must be ran directly.')
+    exit(1)
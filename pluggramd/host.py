@@ -0,0 +1,349 @@
+import rpc
+import asyncio
+import logging
+import traceback
+import zmq.asyncio
+from utils import configure_logger
+from scheduler import TickScheduler
+from typing import List, Optional, Tuple
+from aiorpc import AsyncClient, AsyncScreen, Compositor, ZoneScreen
+from policy import MEMORY_EXIT_CODE
+from profiler import ProfileRequest, TickProfiler
+from pluggram import HANDOVER_POLL_S, RunnerSlot, call_tick
+from tinyrpc.protocols.msgpackrpc import MSGPACKRPCError
+
+
+LOG = logging.getLogger('pluggramd.host')
+configure_logger(LOG)
+
+
+class HostedPluggram:
+    """
+    One async pluggram of a host: what to construct and, for pluggrams
+    sharing the screen, which rectangle (x1, y1, x2, y2) of it to draw in.
+    """
+
+    def __init__(self,
+                 live_type: type,
+                 module_name: str,
+                 tick_rate: Optional[int],
+                 filled_options: dict,
+                 tick_align: Optional[int] = None,
+                 box: Optional[Tuple[int, int, int, int]] = None):
+        self.live_type = live_type
+        self.module_name = module_name
+        self.tick_rate = tick_rate
+        self.filled_options = filled_options
+        self.tick_align = tick_align
+        self.box = box
+        self.instance = None
+        # option changes to apply before the next tick
+        self.changes = {}
+        # profiles the whole event loop, counting this pluggram's ticks
+        self.profiler: Optional[TickProfiler] = None
+
+
+async def exception_screen(screen: AsyncScreen, message: str):
+    try:
+        await screen.clear()
+        x, y = screen.center
+        await screen.draw_text(x, y, 0x0000FF, message, anchor='mm',
+                               spacing=1, alignment='center')
+        await screen.render()
+    except rpc.RPCUnavailableError as e:
+        LOG.warning(f'could not show exception on screen: {str(e)}')
+
+
+def _start_profile(hosted: HostedPluggram, request: ProfileRequest):
+    _finish_profile(hosted)
+    hosted.profiler = TickProfiler(request)
+    hosted.profiler.start()
+
+
+def _finish_profile(hosted: HostedPluggram):
+    if hosted.profiler is not None:
+        hosted.profiler.stop()
+        hosted.profiler.save()
+        hosted.profiler = None
+
+
+async def _watch(slot: RunnerSlot,
+                 hosted: List[HostedPluggram],
+                 stopped: asyncio.Event):
+    # multiprocessing events and pipes cannot be awaited
+    while not slot.stop.is_set():
+        while slot.control.poll():
+            message = slot.control.recv()
+
+            if message[0] == 'profile':
+                _start_profile(hosted[0], message[1])
+                continue
+
+            for h in hosted:
+                if h.module_name == message[1]:
+                    h.changes.update(message[2])
+
+        await asyncio.sleep(HANDOVER_POLL_S)
+
+    stopped.set()
+
+
+async def _construct(screen: AsyncScreen, hosted: HostedPluggram) -> bool:
+    try:
+        hosted.instance = hosted.live_type(screen, **hosted.filled_options)
+        setup = getattr(hosted.instance, 'setup', None)
+
+        if setup is not None:
+            await setup()
+
+        return True
+    except Exception as e:
+        LOG.error(f'exception {e.__class__.__name__} initializing pluggram '
+                  f'"{hosted.module_name}": {str(e)}')
+        LOG.error(traceback.format_exc())
+        return False
+
+
+async def _teardown(hosted: HostedPluggram):
+    """
+    Await the optional teardown() of a pluggram that is done ticking, once
+    per constructed instance.
+    """
+    instance = hosted.instance
+    hosted.instance = None
+    teardown = getattr(instance, 'teardown', None)
+
+    if teardown is None:
+        return
+
+    try:
+        await teardown()
+    except Exception as e:
+        LOG.error(f'exception {e.__class__.__name__} tearing down pluggram '
+                  f'"{hosted.module_name}": {str(e)}')
+        LOG.error(traceback.format_exc())
+
+
+async def _change_options(screen: AsyncScreen, hosted: HostedPluggram):
+    """
+    pluggram.change_options() for an async pluggram.
+    """
+    changes = hosted.changes
+    hosted.changes = {}
+    hosted.filled_options.update(changes)
+    on_options_changed = getattr(hosted.instance, 'on_options_changed', None)
+
+    if on_options_changed is not None:
+        await on_options_changed(changes)
+        LOG.info(f'applied options {", ".join(changes)} to pluggram '
+                 f'"{hosted.module_name}"')
+        return
+
+    LOG.info(f'pluggram "{hosted.module_name}" has no on_options_changed(), '
+             f'constructing it again with the new options')
+    await _teardown(hosted)
+
+    if not await _construct(screen, hosted):
+        raise RuntimeError('constructing with the new options failed')
+
+
+async def _hand_over(screen: AsyncScreen,
+                     hosted: List[HostedPluggram],
+                     slot: RunnerSlot,
+                     stopped: asyncio.Event,
+                     offscreen: bool,
+                     fade_ms: Optional[int]) -> bool:
+    """
+    pluggram.hand_over() for every hosted pluggram at once.
+    """
+    loop = asyncio.get_running_loop()
+
+    if offscreen:
+        await asyncio.gather(*[call_tick(h.instance, h.tick_rate or 0)
+                               for h in hosted])
+
+    drawn = loop.time()
+    slot.ready.set()
+
+    while not slot.go.is_set():
+        if stopped.is_set():
+            if offscreen:
+                await screen.end_offscreen()
+            return False
+
+        await asyncio.sleep(HANDOVER_POLL_S)
+
+    if offscreen:
+        # a frame drawn ahead of time may be a tick out of date by now
+        since_drawn = loop.time() - drawn
+        await asyncio.gather(*[call_tick(h.instance, since_drawn * 1000)
+                               for h in hosted
+                               if h.tick_rate and
+                               since_drawn >= h.tick_rate / 1000])
+        await screen.present(fade_ms)
+
+    return True
+
+
+async def _tick_loop(screen: AsyncScreen,
+                     hosted: HostedPluggram,
+                     stopped: asyncio.Event,
+                     tick_stats=None) -> int:
+    exit_code = 0
+    scheduler = TickScheduler(hosted.tick_rate,
+                              stopped,
+                              hosted.tick_align,
+                              tick_stats,
+                              rpc.METRICS.calls)
+    unavailable = False
+
+    while await scheduler.wait_async():
+        try:
+            if hosted.changes:
+                await _change_options(screen, hosted)
+
+            await call_tick(hosted.instance, scheduler.delta_ms)
+
+            if hosted.profiler is not None and hosted.profiler.tick_done():
+                _finish_profile(hosted)
+
+            if unavailable:
+                LOG.info('screen is answering again')
+                unavailable = False
+        except rpc.RPCUnavailableError as e:
+            if not unavailable:
+                LOG.warning(f'screen unavailable while ticking '
+                            f'pluggram "{hosted.module_name}": {str(e)}')
+                unavailable = True
+
+            try:
+                await asyncio.wait_for(stopped.wait(), rpc.RPC_BACKOFF_MAX_S)
+            except asyncio.TimeoutError:
+                pass
+        except Exception as e:
+            # only this pluggram stops, the others keep their zones
+            LOG.error(f'exception while ticking pluggram '
+                      f'"{hosted.module_name}": {str(e)}')
+            LOG.error(traceback.format_exc())
+            await exception_screen(screen, 'TICK\nEXP')
+
+            # the others share the exhausted address space, stop them too
+            if isinstance(e, MemoryError):
+                exit_code = MEMORY_EXIT_CODE
+                stopped.set()
+
+            break
+
+    await _teardown(hosted)
+    _finish_profile(hosted)
+    LOG.info(f'pluggram "{hosted.module_name}" stopped after '
+             f'{scheduler.summary()}')
+    return exit_code
+
+
+async def run_host(screen_url: str,
+                   screen_options: dict,
+                   hosted: List[HostedPluggram],
+                   slot: RunnerSlot,
+                   handover=False,
+                   fade_ms: Optional[int] = None) -> int:
+    """
+    Run async pluggrams on this event loop until the slot's stop event is
+    set, all over one screen connection. Each draws on a ZoneScreen of its
+    box, or of the whole screen, and the zones are shipped as whole frames
+    using fonts_dir of screen_options. Without fonts_dir, a single
+    pluggram without a box talks to screend call by call instead, like
+    rpc.Screen. The first pluggram's tick timing goes to the slot, with
+    the RPC calls of every pluggram counted against its ticks. Returns the
+    exit code for the worker, see run_pluggram().
+    """
+    context = zmq.asyncio.Context()
+    client = AsyncClient(context,
+                         screen_url,
+                         timeout=screen_options.get('timeout',
+                                                    rpc.RPC_TIMEOUT_S))
+    screen = AsyncScreen(client)
+    stopped = asyncio.Event()
+    watcher = asyncio.ensure_future(_watch(slot, hosted, stopped))
+    names = ', '.join(h.module_name for h in hosted)
+
+    try:
+        try:
+            await screen.connect()
+            offscreen = False
+
+            if handover:
+                try:
+                    await screen.begin_offscreen()
+                    offscreen = True
+                except rpc.RPCUnavailableError:
+                    raise
+                except MSGPACKRPCError as e:
+                    LOG.warning(f'screen cannot draw offscreen: {str(e)}')
+        except rpc.RPCUnavailableError as e:
+            LOG.error(f'screen unavailable, not starting pluggrams '
+                      f'{names}: {str(e)}')
+            return 0
+
+        if len(hosted) == 1 and hosted[0].box is None and \
+                not screen_options.get('fonts_dir'):
+            screens = [screen]
+        else:
+            compositor = Compositor(screen)
+            screens = [ZoneScreen(screen,
+                                  compositor,
+                                  h.box or (0, 0, screen.width, screen.height),
+                                  screen_options['fonts_dir'])
+                       for h in hosted]
+
+        for zone, h in zip(screens, hosted):
+            if not await _construct(zone, h):
+                # the running pluggram keeps the screen instead
+                if not handover:
+                    await exception_screen(zone, 'INIT\nEXC')
+                return 0
+
+        if handover:
+            try:
+                if not await _hand_over(screen,
+                                        hosted,
+                                        slot,
+                                        stopped,
+                                        offscreen,
+                                        fade_ms):
+                    return 0
+            except Exception as e:
+                LOG.error(f'exception {e.__class__.__name__} preparing '
+                          f'pluggrams {names}: {str(e)}')
+                LOG.error(traceback.format_exc())
+                return 0
+
+        exit_codes = await asyncio.gather(
+            *[_tick_loop(zone,
+                         h,
+                         stopped,
+                         slot.tick_stats if i == 0 else None)
+              for i, (zone, h) in enumerate(zip(screens, hosted))])
+        return max(exit_codes)
+    finally:
+        # pluggrams that never got to tick
+        for h in hosted:
+            await _teardown(h)
+
+        watcher.cancel()
+        client.close()
+        context.term()
+
+
+def host_process(screen_url: str,
+                 screen_options: dict,
+                 hosted: List[HostedPluggram],
+                 slot: RunnerSlot,
+                 handover=False,
+                 fade_ms: Optional[int] = None) -> int:
+    return asyncio.run(run_host(screen_url,
+                                screen_options,
+                                hosted,
+                                slot,
+                                handover,
+                                fade_ms))
@@ -1,10 +1,14 @@
+import os
+import rpc
 import zmq
 import json
 import logging
 import argparse
 from api import PluggramManager
+from events import EventPublisher
+from policy import IONICE_CLASSES, RunnerPolicy
 from utils import configure_logger
-from pluggram import load
+from pluggram import discover, DISCOVERY_TIMEOUT_S, MANIFEST_FILE
 from tinyrpc.server import RPCServer
 from tinyrpc.dispatch import RPCDispatcher
 from tinyrpc.transports.zmq import ZmqServerTransport
@@ -29,13 +33,148 @@ if __name__ == '__main__':
                     metavar='URL',
                     dest='rpc_url',
                     help='A URL for the RPC subsystem to bind to.')
+    ap.add_argument('--pipelined',
+                    action='store_true',
+                    dest='pipelined',
+                    help='Send drawing calls to the screen without waiting '
+                         'for replies.')
+    ap.add_argument('--fonts',
+                    type=str,
+                    metavar='DIRECTORY',
+                    dest='fonts_dir',
+                    default=None,
+                    help='Draw on a local canvas using fonts from this '
+                         'directory and send the screen one frame per render.')
+    ap.add_argument('--rpc-timeout',
+                    type=float,
+                    metavar='SECONDS',
+                    dest='rpc_timeout',
+                    default=rpc.RPC_TIMEOUT_S,
+                    help='Give up on a screen call after this long without '
+                         'a reply.')
+    ap.add_argument('--events',
+                    type=str,
+                    metavar='URL',
+                    dest='events_url',
+                    default=None,
+                    help='Publish running program and option changes on a '
+                         'PUB socket bound to this URL.')
+    ap.add_argument('--no-zygote',
+                    action='store_false',
+                    dest='zygote',
+                    help='Spawn a fresh worker process for every pluggram '
+                         'start instead of forking a preloaded, connected '
+                         'spare.')
+    ap.add_argument('--manifest',
+                    type=str,
+                    metavar='PATH',
+                    dest='manifest_path',
+                    default=None,
+                    help='Cache pluggram metadata in this file and only '
+                         'import pluggrams that changed since. Defaults to '
+                         f'"{MANIFEST_FILE}" in the programs directory.')
+    ap.add_argument('--no-manifest',
+                    action='store_false',
+                    dest='use_manifest',
+                    help='Import every pluggram to read its metadata.')
+    ap.add_argument('--discovery-timeout',
+                    type=float,
+                    metavar='SECONDS',
+                    dest='discovery_timeout',
+                    default=DISCOVERY_TIMEOUT_S,
+                    help='Give up on a pluggram that takes longer than this '
+                         'to import at startup.')
+    ap.add_argument('--discovery-workers',
+                    type=int,
+                    metavar='COUNT',
+                    dest='discovery_workers',
+                    default=None,
+                    help='Import at most this many pluggrams at once at '
+                         'startup. Defaults to the number of CPUs.')
+    ap.add_argument('--no-handover',
+                    action='store_false',
+                    dest='handover',
+                    help='Stop the running pluggram before starting the '
+                         'next instead of letting it keep the screen until '
+                         'the next has drawn its first frame.')
+    ap.add_argument('--fade',
+                    type=int,
+                    metavar='MILLISECONDS',
+                    dest='fade_ms',
+                    default=None,
+                    help='Crossfade between pluggrams for this long when '
+                         'handing over.')
+    ap.add_argument('--reserve-cpu',
+                    type=int,
+                    metavar='CPU',
+                    action='append',
+                    dest='reserved_cpus',
+                    default=[],
+                    help='Keep pluggram workers off this CPU core, for '
+                         'example the one screend runs on with --cpu. May be '
+                         'given more than once.')
+    ap.add_argument('--runner-nice',
+                    type=int,
+                    metavar='NICENESS',
+                    dest='runner_nice',
+                    default=None,
+                    help='Run pluggram workers at this niceness.')
+    ap.add_argument('--runner-ionice',
+                    type=str,
+                    choices=list(IONICE_CLASSES),
+                    dest='runner_ionice',
+                    default=None,
+                    help='Run pluggram workers in this I/O scheduling '
+                         'class.')
+    ap.add_argument('--runner-memory',
+                    type=int,
+                    metavar='MEGABYTES',
+                    dest='runner_memory',
+                    default=None,
+                    help='Limit the address space of each pluggram worker '
+                         'to this size and terminate workers whose resident '
+                         'memory grows past it.')
+    ap.add_argument('--runner-cpu-time',
+                    type=int,
+                    metavar='SECONDS',
+                    dest='runner_cpu_time',
+                    default=None,
+                    help='Let the kernel stop pluggram workers that used '
+                         'this much CPU time over their life.')
+    ap.add_argument('--runner-cpu-percent',
+                    type=float,
+                    metavar='PERCENT',
+                    dest='runner_cpu_percent',
+                    default=None,
+                    help='Terminate pluggram workers that use more than this '
+                         'share of a core for several seconds.')
     cla = ap.parse_args()
 
     programs_dir = cla.programs_dir
     screen_rpc_url = cla.screen_rpc_url
     rpc_url = cla.rpc_url
+    screen_options = {'pipelined': cla.pipelined,
+                      'fonts_dir': cla.fonts_dir,
+                      'timeout': cla.rpc_timeout}
+
+    policy = RunnerPolicy(tuple(cla.reserved_cpus),
+                          cla.runner_nice,
+                          cla.runner_ionice,
+                          cla.runner_memory,
+                          cla.runner_cpu_time,
+                          cla.runner_cpu_percent)
+    manifest_path = None
+
+    if cla.use_manifest:
+        manifest_path = cla.manifest_path or os.path.join(programs_dir,
+                                                          MANIFEST_FILE)
 
-    metadata = load(programs_dir, 1)
+    discovery = discover(programs_dir,
+                         1,
+                         manifest_path,
+                         cla.discovery_timeout,
+                         cla.discovery_workers)
+    metadata = [r.meta for r in discovery if r.meta is not None]
 
     for md in metadata:
         try:
@@ -45,11 +184,29 @@ if __name__ == '__main__':
         except json.JSONDecodeError as e:
             LOG.warning(f'failed to parse user options store for "{md.name}"')
 
-    manager = PluggramManager(metadata, screen_rpc_url)
+    context = zmq.Context()
+    events = None
+
+    if cla.events_url is not None:
+        events = EventPublisher(context, cla.events_url)
+
+    manager = PluggramManager(metadata,
+                              screen_rpc_url,
+                              screen_options,
+                              events,
+                              cla.zygote,
+                              cla.handover,
+                              cla.fade_ms,
+                              discovery,
+                              policy)
+
+    if events is not None:
+        events.start_heartbeat(manager.event_state)
+        events.publish('catalog', **manager.event_state())
 
     dispatcher = RPCDispatcher()
     dispatcher.register_instance(manager)
-    transport = ZmqServerTransport.create(zmq.Context(), rpc_url)
+    transport = ZmqServerTransport.create(context, rpc_url)
 
     rpc_server = RPCServer(
         transport,
@@ -0,0 +1,104 @@
+import time
+import logging
+from utils import configure_logger
+from typing import Callable, List, Optional, Tuple
+from threading import Event, Thread
+from pluggram import PluggramMetadata, PluggramRunner
+
+
+LOG = logging.getLogger('pluggramd.playlist')
+configure_logger(LOG)
+# how long before its turn the next pluggram starts drawing offscreen
+PREWARM_S = 2.0
+
+
+class Playlist:
+    """
+    Rotates the screen through pluggrams on a thread of its own, each for
+    a number of seconds, until cancelled.
+
+    The next pluggram is prepared PREWARM_S ahead of its turn, so it is
+    constructed and has its first frame drawn offscreen by the time it
+    takes over. Turns are timed from when the playlist started, not from
+    when each handover finished, so they do not drift.
+    """
+
+    @property
+    def entries(self) -> List[Tuple[PluggramMetadata, float]]:
+        return self._entries
+
+    def __init__(self,
+                 runner: PluggramRunner,
+                 entries: List[Tuple[PluggramMetadata, float]],
+                 screen_url: str,
+                 screen_options: dict,
+                 fade_ms: Optional[int] = None,
+                 on_change: Optional[Callable[[], None]] = None,
+                 prewarm_s=PREWARM_S):
+        self._runner = runner
+        self._entries = entries
+        self._screen_url = screen_url
+        self._screen_options = screen_options
+        self._fade_ms = fade_ms
+        self._on_change = on_change
+        self._prewarm_s = prewarm_s
+        self._cancel = Event()
+        self._thread = Thread(target=self._run,
+                              name='playlist',
+                              daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def cancel(self):
+        self._cancel.set()
+
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _wait_until(self, deadline: float) -> bool:
+        """
+        Sleep until deadline. Returns False instead once cancelled.
+        """
+        return not self._cancel.wait(max(deadline - time.monotonic(), 0))
+
+    def _changed(self):
+        if self._on_change is not None:
+            self._on_change()
+
+    def _run(self):
+        meta, seconds = self._entries[0]
+        self._runner.start(meta,
+                           self._screen_url,
+                           self._screen_options,
+                           True,
+                           self._fade_ms)
+        self._changed()
+
+        if len(self._entries) < 2:
+            return
+
+        turn_end = time.monotonic() + seconds
+        index = 0
+
+        while True:
+            index = (index + 1) % len(self._entries)
+            meta, seconds = self._entries[index]
+
+            if not self._wait_until(turn_end - self._prewarm_s):
+                return
+
+            self._runner.prepare(meta,
+                                 self._screen_url,
+                                 self._screen_options,
+                                 self._fade_ms)
+
+            if not self._wait_until(turn_end):
+                return
+
+            if self._runner.commit():
+                self._changed()
+            else:
+                LOG.warning(f'skipping {meta.name}, it failed to start')
+
+            turn_end += seconds
@@ -1,18 +1,29 @@
 import os
 import re
 import rpc
+import sys
 import zmq
 import json
+import time
+import hashlib
 import inspect
 import logging
 import traceback
 import traceback as tb
 import importlib.util
 from rpc import InputMethod
-from utils import timing_counter, configure_logger
-from typing import List, Tuple, Optional
+from utils import configure_logger
+from policy import MEMORY_EXIT_CODE, RunnerPolicy, apply_policy
+from profiler import ProfileRequest, TickProfiler
+from scheduler import TickScheduler, TICK_STAT_NAMES, stats_dict
+from typing import Dict, List, Tuple, Optional
+from functools import lru_cache
 from inspect import Parameter
-from multiprocessing import Event, Process
+from threading import RLock
+from dataclasses import dataclass
+from multiprocessing import Array, Event, Pipe, Process
+from multiprocessing.connection import wait
+from tinyrpc.protocols.msgpackrpc import MSGPACKRPCError
 
 
 LOG = logging.getLogger('pluggramd.internal')
@@ -20,6 +31,20 @@ configure_logger(LOG)
 INTERVAL_PATTERN = re.compile(r'(\d+)(ms|s|m)')
 OPT_KEY_PATTERN = re.compile(r'(^a-z0-9_)')
 USER_OPTIONS_FILE = 'options.json'
+MANIFEST_FILE = '.manifest.json'
+# bump when load_one() extracts metadata differently
+MANIFEST_VERSION = 2
+# longest one pluggram module may take to import during discovery
+DISCOVERY_TIMEOUT_S = 10.0
+# how long a discovery process that closed its pipe may take to be reaped
+DISCOVERY_EXIT_S = 1.0
+# longest an outgoing pluggram keeps the screen waiting for the next
+HANDOVER_TIMEOUT_S = 10.0
+HANDOVER_POLL_S = 0.05
+# how long a stopped worker may take to exit before it is terminated, and
+# how long it may ignore that before it is killed
+STOP_TIMEOUT_S = 5.0
+STOP_KILL_S = 1.0
 
 
 def parse_interval_text(raw_value):
@@ -201,6 +226,24 @@ class Option:
                 else:
                     raise TypeError('max value must be an integral')
 
+    def manifest_entry(self) -> dict:
+        """
+        The definition of this option, without its value, as JSON-friendly
+        keyword arguments for the constructor.
+        """
+        return {'key': self._key,
+                'default': self._default,
+                'min': self._min,
+                'max': self._max,
+                'choices': self._choices,
+                'help': self._help_text,
+                'color_picker':
+                    self._input_method == InputMethod.COLOR_PICKER}
+
+    @classmethod
+    def from_manifest(cls, entry: dict) -> 'Option':
+        return cls(**entry)
+
     def __repr__(self):
         return f'<Option "{self._key}" {self.type_name}' \
                f'default = {self._default} value = {self._value}>'
@@ -273,6 +316,14 @@ class PluggramMetadata:
     def tick_rate(self):
         return self._tick_rate
 
+    @property
+    def tick_align(self):
+        return self._tick_align
+
+    @property
+    def is_async(self) -> bool:
+        return self._is_async
+
     @property
     def has_user_options(self):
         return os.path.exists(self._store_path)
@@ -284,9 +335,13 @@ class PluggramMetadata:
                  display_name: str,
                  description: Optional[str],
                  version: Optional[str],
-                 options=None):
+                 options=None,
+                 tick_align: Optional[int] = None,
+                 is_async=False):
         self._path = module_path
         self._tick_rate = tick_rate
+        self._tick_align = tick_align
+        self._is_async = is_async
         self._name = name
         self._display_name = display_name
         self._description = description
@@ -294,6 +349,23 @@ class PluggramMetadata:
         self._options = options or []
         self._store_path = os.path.join(self.module_path, USER_OPTIONS_FILE)
 
+    def manifest_entry(self) -> dict:
+        return {'module_path': self._path,
+                'name': self._name,
+                'tick_rate': self._tick_rate,
+                'display_name': self._display_name,
+                'description': self._description,
+                'version': self._version,
+                'options': [o.manifest_entry() for o in self._options],
+                'tick_align': self._tick_align,
+                'is_async': self._is_async}
+
+    @classmethod
+    def from_manifest(cls, entry: dict) -> 'PluggramMetadata':
+        entry = dict(entry)
+        entry['options'] = [Option.from_manifest(o) for o in entry['options']]
+        return cls(**entry)
+
     def save_options(self, options: dict) -> Tuple[List[str], List[str]]:
         LOG.info(f'saving user options for {self.name}')
 
@@ -357,6 +429,26 @@ class PluggramMetadata:
 
 
 class Pluggram:
+    """
+    Base of every pluggram. The constructor gets the screen and the filled
+    options, tick() is called at TICK_RATE.
+
+    A pluggram whose tick() is a coroutine function is async: it is run on
+    an event loop, gets an aiorpc.AsyncScreen whose calls are awaited and
+    can share its process and screen connection with other async
+    pluggrams. Its constructor must not draw; an optional async setup()
+    is awaited once before the first tick instead, and an optional async
+    teardown() once it stops ticking, to cancel tasks setup() started.
+
+    tick() may take one argument, the milliseconds since the last tick
+    started. Moving things by that much instead of by a fixed step per
+    tick keeps animations at the same speed when ticks fall behind.
+
+    Options saved while a pluggram runs reach it before its next tick, as
+    a dict of the changed values given to on_options_changed(), a
+    coroutine for async pluggrams. A pluggram without one is constructed
+    again with the new options, in the same process.
+    """
 
     def tick(self):
         raise NotImplementedError('tick() was never overridden')
@@ -387,7 +479,8 @@ def load_type(module_path: str) -> Tuple[str, type]:
                 message += ''.join(
                     tb.format_exception(None, e, e.__traceback__))
                 LOG.warning(message)
-                continue
+                raise TypeError(f'importing "{module_path}" raised '
+                                f'{e.__class__.__name__}: {str(e)}') from e
 
             # 1. get class definitions in module to find entrypoint
             class_members = inspect.getmembers(loaded_module, inspect.isclass)
@@ -401,7 +494,7 @@ def load_type(module_path: str) -> Tuple[str, type]:
                     break
 
             return class_name, module_class
-    raise TypeError()
+    raise TypeError(f'no importable __init__.py in "{module_path}"')
 
 
 def load_one(module_path: str, argument_count: int) -> \
@@ -492,6 +585,16 @@ def load_one(module_path: str, argument_count: int) -> \
                          f'"TICK_RATE" property required')
                 continue
 
+            tick_align = None
+            if hasattr(module_class, 'TICK_ALIGN'):
+                tick_align = parse_interval_text(module_class.TICK_ALIGN)
+
+                if tick_align is not None and tick_align < 0:
+                    LOG.info(f'load_one("{module_path}", {argument_count}): '
+                             f'tick alignment must be an interval like '
+                             f'TICK_RATE or None')
+                    continue
+
             option_definitions = []
             if hasattr(module_class, 'OPTIONS'):
                 if isinstance(module_class.OPTIONS, list):
@@ -507,7 +610,10 @@ def load_one(module_path: str, argument_count: int) -> \
                                     display_name,
                                     description,
                                     version_text,
-                                    options=option_definitions)
+                                    options=option_definitions,
+                                    tick_align=tick_align,
+                                    is_async=inspect.iscoroutinefunction(
+                                        tick_func))
 
             LOG.debug(f'load_one("{module_path}", {argument_count}): '
                       f'loaded pluggram {class_name}')
@@ -516,12 +622,187 @@ def load_one(module_path: str, argument_count: int) -> \
     return meta
 
 
-def load(programs_dir: str, argument_count):
+def module_fingerprint(module_path: str) -> str:
+    """
+    Hash of the size and modification time of every file in a module's
+    directory and of its Python sources, ignoring saved user options.
+    """
+    digest = hashlib.sha1()
+
+    for root, dirs, files in os.walk(module_path):
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+
+        for file in sorted(files):
+            path = os.path.join(root, file)
+
+            if path == os.path.join(module_path, USER_OPTIONS_FILE):
+                continue
+
+            stat = os.stat(path)
+            digest.update(f'{os.path.relpath(path, module_path)}:'
+                          f'{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+
+            if file.endswith('.py'):
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+def read_manifest(manifest_path: str, argument_count) -> dict:
+    """
+    Cached metadata by module name, empty if the manifest is missing or
+    was written by a different version or for other arguments.
+    """
+    try:
+        with open(manifest_path, 'r') as mf:
+            manifest = json.load(mf)
+    except OSError:
+        return {}
+    except json.JSONDecodeError:
+        LOG.warning(f'ignoring unreadable manifest "{manifest_path}"')
+        return {}
+
+    if manifest.get('version') != MANIFEST_VERSION or \
+            manifest.get('argument_count') != argument_count:
+        return {}
+
+    return manifest.get('modules', {})
+
+
+def write_manifest(manifest_path: str, argument_count, modules: dict):
+    partial_path = f'{manifest_path}.tmp'
+
+    try:
+        with open(partial_path, 'w') as mf:
+            json.dump({'version': MANIFEST_VERSION,
+                       'argument_count': argument_count,
+                       'modules': modules}, mf, indent=1)
+        os.replace(partial_path, manifest_path)
+    except OSError as e:
+        LOG.warning(f'could not write manifest "{manifest_path}": {str(e)}')
+
+
+@dataclass(frozen=True)
+class DiscoveryResult:
+    module_path: str
+    meta: Optional[PluggramMetadata]
+    # why the module did not load, None if it loaded or did not qualify
+    error: Optional[str]
+    elapsed_ms: float
+    cached: bool
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.module_path)
+
+
+def _discovery_process(conn, module_path: str, argument_count: int):
+    try:
+        meta = load_one(module_path, argument_count)
+        conn.send(('ok', meta.manifest_entry() if meta else None))
+    except Exception as e:
+        conn.send(('error', f'{e.__class__.__name__}: {str(e)}'))
+
+
+def import_isolated(module_paths: List[str],
+                    argument_count: int,
+                    timeout_s=DISCOVERY_TIMEOUT_S,
+                    workers: Optional[int] = None) -> \
+        Dict[str, DiscoveryResult]:
+    """
+    Run load_one() for each module in a process of its own, up to workers
+    (by default one per CPU) at a time. A module that raises, crashes its
+    process or takes longer than timeout_s to load fails alone and leaves
+    nothing behind in this process.
+    """
+    workers = workers or os.cpu_count() or 1
+    pending = list(module_paths)
+    running = {}
+    results = {}
+
+    def finish(conn, meta, error):
+        proc, module_path, started = running.pop(conn)
+        conn.close()
+        proc.join()
+        results[module_path] = DiscoveryResult(
+            module_path,
+            meta,
+            error,
+            (time.monotonic() - started) * 1000,
+            False)
+
+    while pending or running:
+        while pending and len(running) < workers:
+            module_path = pending.pop(0)
+            parent_end, child_end = Pipe(duplex=False)
+            proc = Process(target=_discovery_process,
+                           name=f'discover-{os.path.basename(module_path)}',
+                           args=(child_end, module_path, argument_count),
+                           daemon=True)
+            proc.start()
+            child_end.close()
+            running[parent_end] = (proc, module_path, time.monotonic())
+
+        next_deadline = min(started for _p, _m, started in running.values()) \
+            + timeout_s
+
+        for conn in wait(list(running),
+                         max(next_deadline - time.monotonic(), 0)):
+            try:
+                status, value = conn.recv()
+            except EOFError:
+                # the pipe closes a moment before the process is reaped
+                proc = running[conn][0]
+                proc.join(DISCOVERY_EXIT_S)
+
+                if proc.exitcode is None:
+                    proc.kill()
+                    proc.join()
+
+                finish(conn, None, f'import crashed the process '
+                                   f'(exit code {proc.exitcode})')
+                continue
+
+            if status == 'ok':
+                finish(conn,
+                       PluggramMetadata.from_manifest(value) if value
+                       else None,
+                       None)
+            else:
+                finish(conn, None, value)
+
+        now = time.monotonic()
+
+        for conn, (proc, module_path, started) in list(running.items()):
+            if now - started >= timeout_s:
+                proc.kill()
+                finish(conn, None, f'timed out after {timeout_s:.0f}s')
+
+    return results
+
+
+def discover(programs_dir: str,
+             argument_count,
+             manifest_path: Optional[str] = None,
+             timeout_s=DISCOVERY_TIMEOUT_S,
+             workers: Optional[int] = None) -> List[DiscoveryResult]:
+    """
+    Find every pluggram under programs_dir. Modules are imported in
+    isolation and in parallel, see import_isolated(). With manifest_path,
+    metadata of modules whose files have not changed since the last run
+    comes from that file instead of importing them. Modules that did not
+    qualify are imported every time, in case what they were missing has
+    been installed since.
+    """
     if not os.path.isdir(programs_dir):
         raise RuntimeError(
             'Programs directory does not exist or is not a directory')
 
-    pluggram_metas = []
+    cached = read_manifest(manifest_path, argument_count) \
+        if manifest_path else {}
+    fingerprints = {}
+    results = {}
 
     for _, dirs, _ in os.walk(programs_dir, followlinks=False):
         dirs.sort()
@@ -529,63 +810,430 @@ def load(programs_dir: str, argument_count):
             module_path = os.path.abspath(
                 os.path.join(programs_dir, module_name))
             if os.path.exists(module_path):
-                meta = load_one(module_path, argument_count)
-                pluggram_metas.append(meta)
+                fingerprint = module_fingerprint(module_path)
+                fingerprints[module_path] = fingerprint
+                entry = cached.get(module_name)
+
+                if entry is not None and \
+                        entry['fingerprint'] == fingerprint and \
+                        entry['meta']['module_path'] == module_path:
+                    results[module_path] = DiscoveryResult(
+                        module_path,
+                        PluggramMetadata.from_manifest(entry['meta']),
+                        None,
+                        0.0,
+                        True)
+                else:
+                    results[module_path] = None
+
+    started = time.monotonic()
+    imported = import_isolated([p for p, r in results.items() if r is None],
+                               argument_count,
+                               timeout_s,
+                               workers)
+    results.update(imported)
+
+    for result in imported.values():
+        if result.error is not None:
+            LOG.warning(f'could not load pluggram "{result.name}" '
+                        f'({result.elapsed_ms:.0f}ms): {result.error}')
+        elif result.meta is None:
+            LOG.info(f'"{result.name}" is not a pluggram '
+                     f'({result.elapsed_ms:.0f}ms)')
+        else:
+            LOG.info(f'loaded pluggram "{result.name}" '
+                     f'({result.elapsed_ms:.0f}ms)')
+
+    LOG.info(f'found {len(results)} modules, {len(results) - len(imported)} '
+             f'from the manifest, imported {len(imported)} in '
+             f'{(time.monotonic() - started) * 1000:.0f}ms')
+
+    if manifest_path:
+        modules = {}
+
+        for module_path, result in results.items():
+            if result.meta is not None:
+                modules[result.name] = {
+                    'fingerprint': fingerprints[module_path],
+                    'meta': result.meta.manifest_entry()
+                }
 
-    return pluggram_metas
+        if modules != cached:
+            write_manifest(manifest_path, argument_count, modules)
+
+    return list(results.values())
+
+
+def load(programs_dir: str,
+         argument_count,
+         manifest_path: Optional[str] = None):
+    """
+    Metadata of every pluggram under programs_dir as found by discover(),
+    None for modules that failed or do not qualify.
+    """
+    return [r.meta for r in discover(programs_dir,
+                                     argument_count,
+                                     manifest_path)]
+
+
+@lru_cache(maxsize=None)
+def tick_takes_delta(live_type: type) -> bool:
+    return len(inspect.signature(live_type.tick).parameters) > 1
+
+
+def call_tick(instance, delta_ms: float):
+    """
+    Tick instance, passing delta_ms if its tick() takes it. Returns what
+    tick() returns, a coroutine for async pluggrams.
+    """
+    if tick_takes_delta(type(instance)):
+        return instance.tick(delta_ms)
+
+    return instance.tick()
 
 
 def exception_screen(screen: rpc.Screen, message: str):
-    screen.clear()
-    x, y = screen.center
-    screen.draw_text(x, y, 0x0000FF, message, anchor='mm', spacing=1,
-                     alignment='center')
+    try:
+        screen.clear()
+        x, y = screen.center
+        screen.draw_text(x, y, 0x0000FF, message, anchor='mm', spacing=1,
+                         alignment='center')
+    except rpc.RPCUnavailableError as e:
+        LOG.warning(f'could not show exception on screen: {str(e)}')
+
+
+class RunnerSlot:
+    """
+    Shared state of one pluggram worker. A runner has two so the next
+    pluggram can get ready while the current one runs. They are created up
+    front because forked workers can only inherit them.
+    """
+
+    def __init__(self):
+        self.stop = Event()
+        # the worker drew its first frame offscreen
+        self.ready = Event()
+        # the runner stopped the previous worker, show the first frame
+        self.go = Event()
+        # written by the worker after every tick, a torn read is harmless
+        self.tick_stats = Array('d', len(TICK_STAT_NAMES), lock=False)
+        # ('options', pluggram name, changed options) and ('profile',
+        # ProfileRequest) messages for the worker
+        self.control, self._control_sender = Pipe(duplex=False)
+
+    def reset(self):
+        self.stop.clear()
+        self.ready.clear()
+        self.go.clear()
+        self.tick_stats[:] = [0.0] * len(TICK_STAT_NAMES)
+
+        # messages meant for the previous worker
+        while self.control.poll():
+            self.control.recv()
+
+    def send_option_changes(self, name: str, changes: dict):
+        self._control_sender.send(('options', name, changes))
+
+    def send_profile_request(self, request: ProfileRequest):
+        self._control_sender.send(('profile', request))
+
+
+def change_options(screen: rpc.Screen,
+                   instance,
+                   module_name: str,
+                   filled_options: dict,
+                   changes: dict):
+    """
+    Apply changed option values to a running pluggram through its
+    on_options_changed(), or construct it again with them if it has none.
+    Returns the instance to tick from now on.
+    """
+    filled_options.update(changes)
+    on_options_changed = getattr(instance, 'on_options_changed', None)
+
+    if on_options_changed is not None:
+        on_options_changed(changes)
+        LOG.info(f'applied options {", ".join(changes)} to pluggram '
+                 f'"{module_name}"')
+        return instance
+
+    LOG.info(f'pluggram "{module_name}" has no on_options_changed(), '
+             f'constructing it again with the new options')
+    return type(instance)(screen, **filled_options)
+
+
+def draw_offscreen(screen: rpc.Screen) -> bool:
+    """
+    Send what a pluggram about to be constructed draws to an offscreen
+    canvas. Returns False if the screen cannot do that.
+    """
+    try:
+        screen.begin_offscreen()
+        return True
+    except rpc.RPCUnavailableError:
+        raise
+    except MSGPACKRPCError as e:
+        # screend predates offscreen drawing
+        LOG.warning(f'screen cannot draw offscreen: {str(e)}')
+        return False
+
+
+def hand_over(screen: rpc.Screen,
+              instance,
+              tick_rate: Optional[int],
+              slot: RunnerSlot,
+              offscreen: bool,
+              fade_ms: Optional[int]) -> bool:
+    """
+    Draw the first frame of a pluggram offscreen while another one still
+    has the screen, then present it once the runner says go. Without
+    offscreen, only wait for go. Returns False if the worker was stopped
+    first.
+    """
+    if offscreen:
+        call_tick(instance, tick_rate or 0)
+
+    drawn = time.monotonic()
+    slot.ready.set()
+
+    while not slot.go.wait(HANDOVER_POLL_S):
+        if slot.stop.is_set():
+            if offscreen:
+                screen.end_offscreen()
+            return False
+
+    if offscreen:
+        # a frame drawn ahead of time may be a tick out of date by now
+        since_drawn = time.monotonic() - drawn
+
+        if tick_rate and since_drawn >= tick_rate / 1000:
+            call_tick(instance, since_drawn * 1000)
+
+        screen.present(fade_ms)
+
+    return True
+
+
+def run_pluggram(screen: rpc.Screen,
+                 live_type: type,
+                 module_name: str,
+                 tick_rate: Optional[int],
+                 filled_options: dict,
+                 slot: RunnerSlot,
+                 tick_align: Optional[int] = None,
+                 handover=False,
+                 fade_ms: Optional[int] = None) -> int:
+    """
+    Construct a pluggram on a connected screen and tick it until the
+    slot's stop event is set. With handover, take the screen over from the
+    running pluggram as described in hand_over(). Returns the exit code
+    for the worker, MEMORY_EXIT_CODE if the pluggram ran out of memory.
+    """
+    stop_event = slot.stop
+    exit_code = 0
+
+    try:
+        offscreen = handover and draw_offscreen(screen)
+    except rpc.RPCUnavailableError as e:
+        LOG.error(f'screen unavailable, not starting pluggram '
+                  f'"{module_name}": {str(e)}')
+        return exit_code
+
+    try:
+        instance = live_type(screen, **filled_options)
+    except Exception as e:
+        LOG.error(f'exception {e.__class__.__name__} initializing pluggram '
+                  f'"{module_name}": {str(e)}')
+        LOG.error(traceback.format_exc())
+
+        # the running pluggram keeps the screen instead
+        if not handover:
+            exception_screen(screen, 'INIT\nEXC')
+        return MEMORY_EXIT_CODE if isinstance(e, MemoryError) else exit_code
+
+    if handover:
+        try:
+            if not hand_over(screen,
+                             instance,
+                             tick_rate,
+                             slot,
+                             offscreen,
+                             fade_ms):
+                return exit_code
+        except Exception as e:
+            # the runner sees this worker exit and keeps the running one
+            LOG.error(f'exception {e.__class__.__name__} preparing pluggram '
+                      f'"{module_name}": {str(e)}')
+            LOG.error(traceback.format_exc())
+            return exit_code
+
+    scheduler = TickScheduler(tick_rate,
+                              stop_event,
+                              tick_align,
+                              slot.tick_stats,
+                              rpc.METRICS.calls)
+    unavailable = False
+    profiler: Optional[TickProfiler] = None
+
+    while scheduler.wait():
+        try:
+            while slot.control.poll():
+                message = slot.control.recv()
+
+                if message[0] == 'profile':
+                    if profiler is not None:
+                        profiler.save()
+                    profiler = TickProfiler(message[1])
+                else:
+                    instance = change_options(screen,
+                                              instance,
+                                              module_name,
+                                              filled_options,
+                                              message[2])
+
+            if profiler is None:
+                call_tick(instance, scheduler.delta_ms)
+            else:
+                profiler.start()
+
+                try:
+                    call_tick(instance, scheduler.delta_ms)
+                finally:
+                    profiler.stop()
+
+                if profiler.tick_done():
+                    profiler.save()
+                    profiler = None
+
+            if unavailable:
+                LOG.info('screen is answering again')
+                unavailable = False
+        except rpc.RPCUnavailableError as e:
+            # skip frames until the screen answers instead of
+            # hanging on it or giving up on the pluggram
+            if not unavailable:
+                LOG.warning(f'screen unavailable while ticking '
+                            f'pluggram "{module_name}": {str(e)}')
+                unavailable = True
+            stop_event.wait(rpc.RPC_BACKOFF_MAX_S)
+        except Exception as e:
+            LOG.error(f'exception while ticking pluggram '
+                      f'"{module_name}": {str(e)}')
+            LOG.error(traceback.format_exc())
+            stop_event.set()
+            exception_screen(screen, 'TICK\nEXP')
+
+            if isinstance(e, MemoryError):
+                exit_code = MEMORY_EXIT_CODE
+
+    # a pluggram stopped early still leaves what was profiled
+    if profiler is not None:
+        profiler.save()
+
+    LOG.info(f'pluggram "{module_name}" stopped after {scheduler.summary()}')
+    return exit_code
 
 
 def runner_process(module_path: str,
                    module_name: str,
                    screen_url: str,
+                   screen_options: dict,
                    tick_rate: Optional[int],
                    filled_options: dict,
-                   stop_event: Event):
-    abort = False
+                   slot: RunnerSlot,
+                   rpc_counters: Optional[Array] = None,
+                   tick_align: Optional[int] = None,
+                   handover=False,
+                   fade_ms: Optional[int] = None,
+                   policy: Optional[RunnerPolicy] = None):
+    apply_policy(policy)
+
+    if rpc_counters is not None:
+        rpc.METRICS.attach(screen_url, rpc_counters)
+
     try:
         klass_name, live_type = load_type(module_path)
     except TypeError:
         LOG.error('failed to get module class type, try restarting')
-        abort = True
+        return
+
+    if inspect.iscoroutinefunction(live_type.tick):
+        from host import HostedPluggram, host_process
+        sys.exit(host_process(screen_url,
+                              screen_options,
+                              [HostedPluggram(live_type,
+                                              module_name,
+                                              tick_rate,
+                                              filled_options,
+                                              tick_align)],
+                              slot,
+                              handover,
+                              fade_ms))
+
+    # start screen RPC client
+    try:
+        screen = rpc.rpc_get_screen(screen_url, **screen_options)
+    except rpc.RPCUnavailableError as e:
+        LOG.error(f'screen unavailable, not starting pluggram '
+                  f'"{module_name}": {str(e)}')
+        return
+
+    exit_code = run_pluggram(screen,
+                             live_type,
+                             module_name,
+                             tick_rate,
+                             filled_options,
+                             slot,
+                             tick_align,
+                             handover,
+                             fade_ms)
+    screen.close()
+    sys.exit(exit_code)
+
+
+def group_process(members: List[Tuple],
+                  screen_url: str,
+                  screen_options: dict,
+                  slot: RunnerSlot,
+                  rpc_counters: Optional[Array] = None,
+                  handover=False,
+                  fade_ms: Optional[int] = None,
+                  policy: Optional[RunnerPolicy] = None):
+    """
+    Worker running several async pluggrams in one process, each in its own
+    box of the screen. members are (module_path, module_name, tick_rate,
+    filled_options, tick_align, box) tuples.
+    """
+    from host import HostedPluggram, host_process
 
-    if not abort:
-        # start screen RPC client
-        screen = rpc.rpc_get_screen(screen_url)
+    apply_policy(policy)
 
-        try:
-            instance = live_type(screen, **filled_options)
-        except Exception as e:
-            LOG.error(f'exception {e.__class__.__name__} initializing pluggram '
-                      f'"{module_name}": {str(e)}')
-            LOG.error(traceback.format_exc())
-            abort = True
+    if rpc_counters is not None:
+        rpc.METRICS.attach(screen_url, rpc_counters)
 
-            exception_screen(screen, 'INIT\nEXC')
+    hosted = []
 
-        if not abort:
-            marker = -tick_rate if tick_rate is not None else timing_counter()
-            while True:
-                timer = (tick_rate is not None and timing_counter() -
-                         marker > tick_rate)
-                if timer or tick_rate is None:
-                    marker = timing_counter()
-                    try:
-                        instance.tick()
-                    except Exception as e:
-                        LOG.error(f'exception while ticking pluggram '
-                                  f'"{module_name}": {str(e)}')
-                        LOG.error(traceback.format_exc())
-                        stop_event.set()
-                        exception_screen(screen, 'TICK\nEXP')
-                if stop_event.is_set():
-                    break
+    for module_path, module_name, tick_rate, filled_options, tick_align, \
+            box in members:
+        try:
+            klass_name, live_type = load_type(module_path)
+        except TypeError:
+            LOG.error('failed to get module class type, try restarting')
+            return
+
+        hosted.append(HostedPluggram(live_type,
+                                     module_name,
+                                     tick_rate,
+                                     filled_options,
+                                     tick_align,
+                                     tuple(box)))
+
+    sys.exit(host_process(screen_url,
+                          screen_options,
+                          hosted,
+                          slot,
+                          handover,
+                          fade_ms))
 
 
 class PluggramRunner:
@@ -607,42 +1255,411 @@ class PluggramRunner:
     def running(self) -> Optional[PluggramMetadata]:
         return self._meta
 
-    def __init__(self):
+    @property
+    def group(self) -> Optional[List[Tuple[PluggramMetadata, Tuple]]]:
+        """
+        Pluggrams and boxes of the running group, None unless start() was
+        given one. running is the first of them.
+        """
+        return self._group
+
+    @property
+    def prepared(self) -> Optional[PluggramMetadata]:
+        """
+        The pluggram waiting to take over the screen at commit().
+        """
+        return self._next[2] if self._next is not None else None
+
+    @property
+    def rpc_counters(self) -> dict:
+        return rpc.counters_dict(self._rpc_counters[:])
+
+    @property
+    def tick_stats(self) -> dict:
+        """
+        Tick timing of the running or last run pluggram.
+        """
+        return stats_dict(self._slots[self._active].tick_stats[:])
+
+    def runner_stats(self) -> List[Tuple[str, int, bool, dict]]:
+        """
+        Name, pid, whether it has the screen and tick stats of the running
+        and the prepared worker, read from their slots.
+        """
+        # read without the lock, like workers()
+        proc, meta, group = self._proc, self._meta, self._group
+        active, prepared = self._active, self._next
+        stats = []
+
+        if proc is not None and meta is not None and proc.is_alive():
+            stats.append((self._worker_name(meta, group),
+                          proc.pid,
+                          True,
+                          stats_dict(self._slots[active].tick_stats[:])))
+
+        if prepared is not None:
+            slot_index, proc, meta, group = prepared
+            stats.append((self._worker_name(meta, group),
+                          proc.pid,
+                          False,
+                          stats_dict(self._slots[slot_index].tick_stats[:])))
+
+        return stats
+
+    def workers(self) -> List[Tuple[str, object]]:
+        """
+        Names and processes of the running and the prepared worker.
+        """
+        # read without the lock, which stop() holds while workers exit
+        proc, meta, group = self._proc, self._meta, self._group
+        prepared = self._next
+        workers = []
+
+        if proc is not None and meta is not None:
+            workers.append((self._worker_name(meta, group), proc))
+
+        if prepared is not None:
+            _, proc, meta, group = prepared
+            workers.append((self._worker_name(meta, group), proc))
+
+        return workers
+
+    @staticmethod
+    def _worker_name(meta: PluggramMetadata, group) -> str:
+        if group is None:
+            return meta.name
+
+        return '+'.join(m.name for m, _ in group)
+
+    def __init__(self, policy: Optional[RunnerPolicy] = None):
         self._proc = None
+        self._policy = policy
         self._meta: PluggramMetadata = None
+        self._group: Optional[List[Tuple[PluggramMetadata, Tuple]]] = None
         self._screen_url: Optional[str] = None
-        self._event_stop = Event()
+        self._screen_options = {}
+        self._slots = (RunnerSlot(), RunnerSlot())
+        self._active = 0
+        # slot, worker, metadata and group of a pluggram waiting for commit()
+        self._next: Optional[Tuple[int, object, PluggramMetadata,
+                                   Optional[list]]] = None
+        # the playlist switches pluggrams from its own thread
+        self._lock = RLock()
+        # screen call counters of every runner this starts, kept across them
+        self._rpc_counters = Array('Q', len(rpc.COUNTER_NAMES))
+        self._zygote = None
+
+    def use_zygote(self,
+                   module_paths: List[str],
+                   screen_url: str,
+                   screen_options: Optional[dict] = None):
+        """
+        Fork workers from a zygote that has every module in module_paths
+        loaded and keeps a spare worker connected to screen_url, so start()
+        only constructs the pluggram. Falls back to spawning workers if the
+        zygote dies.
+        """
+        from zygote import Zygote
+        self._zygote = Zygote(module_paths,
+                              screen_url,
+                              screen_options or {},
+                              self._slots,
+                              self._rpc_counters,
+                              self._policy)
+
+    def _start_from_zygote(self,
+                           meta: PluggramMetadata,
+                           filled_options,
+                           slot_index: int,
+                           handover: bool,
+                           fade_ms: Optional[int]):
+        try:
+            return self._zygote.run(meta.module_path,
+                                    meta.name,
+                                    meta.tick_rate,
+                                    filled_options,
+                                    meta.tick_align,
+                                    slot_index,
+                                    handover,
+                                    fade_ms)
+        except (EOFError, OSError) as e:
+            LOG.warning(f'zygote is gone, spawning workers from now on: '
+                        f'{str(e)}')
+            self._zygote = None
+            return None
+
+    def _launch_group(self,
+                      slot: RunnerSlot,
+                      group: List[Tuple[PluggramMetadata, Tuple]],
+                      handover: bool,
+                      fade_ms: Optional[int]):
+        members = [(m.module_path,
+                    m.name,
+                    m.tick_rate,
+                    m.get_filled_options(),
+                    m.tick_align,
+                    box) for m, box in group]
+        proc = Process(target=group_process, args=(members,
+                                                   self._screen_url,
+                                                   self._screen_options,
+                                                   slot,
+                                                   self._rpc_counters,
+                                                   handover,
+                                                   fade_ms,
+                                                   self._policy))
+        proc.start()
+        LOG.info(f'started pluggram worker for programs '
+                 f'{", ".join(m.name for m, _ in group)}')
+        return proc
+
+    def _launch(self,
+                slot_index: int,
+                meta: PluggramMetadata,
+                handover=False,
+                fade_ms: Optional[int] = None,
+                group: Optional[List[Tuple[PluggramMetadata, Tuple]]] = None):
+        slot = self._slots[slot_index]
+        slot.reset()
+
+        if group is not None:
+            return self._launch_group(slot, group, handover, fade_ms)
 
-    def start(self, meta: PluggramMetadata, screen_url: str):
-        self.stop()
-        self._event_stop.clear()
-        self._meta = meta
-        self._screen_url = screen_url
         filled_options = meta.get_filled_options()
 
-        LOG.info(f'starting pluggram worker for program {self._meta.name}')
-        self._proc = Process(target=runner_process, args=(meta.module_path,
-                                                          meta.name,
-                                                          screen_url,
-                                                          meta.tick_rate,
-                                                          filled_options,
-                                                          self._event_stop))
-        self._proc.start()
-        LOG.info(f'started pluggram worker for program {self._meta.name}')
+        LOG.info(f'starting pluggram worker for program {meta.name}')
+
+        if self._zygote is not None and self._zygote.available:
+            proc = self._start_from_zygote(meta,
+                                           filled_options,
+                                           slot_index,
+                                           handover,
+                                           fade_ms)
+
+            if proc is not None:
+                LOG.info(f'started pluggram worker for program {meta.name} '
+                         f'from zygote')
+                return proc
+
+        proc = Process(target=runner_process, args=(meta.module_path,
+                                                    meta.name,
+                                                    self._screen_url,
+                                                    self._screen_options,
+                                                    meta.tick_rate,
+                                                    filled_options,
+                                                    slot,
+                                                    self._rpc_counters,
+                                                    meta.tick_align,
+                                                    handover,
+                                                    fade_ms,
+                                                    self._policy))
+        proc.start()
+        LOG.info(f'started pluggram worker for program {meta.name}')
+        return proc
+
+    def start(self,
+              meta: PluggramMetadata,
+              screen_url: str,
+              screen_options: Optional[dict] = None,
+              handover=False,
+              fade_ms: Optional[int] = None,
+              group: Optional[List[Tuple[PluggramMetadata, Tuple]]] = None) \
+            -> bool:
+        """
+        Run meta's pluggram instead of the running one. With handover, the
+        running pluggram keeps the screen until the new one has drawn its
+        first frame, see prepare(). Returns False if the new pluggram
+        failed before taking over.
+
+        A group of (metadata, box) pairs of async pluggrams runs them all
+        in one worker instead, each in its box of the screen. meta should
+        be the first of them.
+        """
+        with self._lock:
+            if not handover or not self.is_running:
+                self.stop()
+                self._meta = meta
+                self._group = group
+                self._screen_url = screen_url
+                self._screen_options = screen_options or {}
+                self._proc = self._launch(self._active, meta, group=group)
+                return True
+
+            self.prepare(meta, screen_url, screen_options, fade_ms, group)
+
+        return self.commit()
+
+    def prepare(self,
+                meta: PluggramMetadata,
+                screen_url: str,
+                screen_options: Optional[dict] = None,
+                fade_ms: Optional[int] = None,
+                group: Optional[List[Tuple[PluggramMetadata, Tuple]]] = None):
+        """
+        Start meta's pluggram, or group, next to the running one. It draws
+        its first frame offscreen and waits for commit() to hand it the
+        screen.
+        """
+        with self._lock:
+            self._discard_prepared()
+            self._screen_url = screen_url
+            self._screen_options = screen_options or {}
+            slot_index = 1 - self._active if self.is_running else self._active
+            proc = self._launch(slot_index, meta, True, fade_ms, group)
+            self._next = (slot_index, proc, meta, group)
+
+    def commit(self, timeout=HANDOVER_TIMEOUT_S) -> bool:
+        """
+        Wait for the prepared pluggram's first frame, stop the running one
+        and show it, crossfading if prepare() was given a fade. Returns
+        False, leaving the running pluggram alone, if the prepared one
+        failed first or was discarded meanwhile.
+        """
+        with self._lock:
+            prepared = self._next
+
+            if prepared is None:
+                return False
+
+        slot_index, proc, meta, group = prepared
+        slot = self._slots[slot_index]
+        waited = time.monotonic()
+
+        # without the lock, stop() and option changes go ahead meanwhile
+        while not slot.ready.wait(HANDOVER_POLL_S):
+            if not proc.is_alive():
+                break
+
+            if time.monotonic() - waited > timeout:
+                LOG.warning(f'pluggram {meta.name} did not draw its '
+                            f'first frame in {timeout:.0f}s, switching '
+                            f'anyway')
+                break
+
+        with self._lock:
+            if self._next is not prepared:
+                LOG.info(f'pluggram {meta.name} was discarded before taking '
+                         f'over the screen')
+                return False
+
+            self._next = None
+
+            if not slot.ready.is_set() and not proc.is_alive():
+                proc.join()
+                LOG.warning(f'pluggram {meta.name} failed before taking '
+                            f'over the screen')
+                return False
+
+            if slot_index != self._active:
+                self._stop_active()
+
+            slot.go.set()
+            self._active = slot_index
+            self._proc = proc
+            self._meta = meta
+            self._group = group
+            LOG.info(f'handed the screen over to {meta.name} after '
+                     f'{(time.monotonic() - waited) * 1000:.0f}ms')
+            return True
 
-    def stop(self, clear=False):
-        LOG.info('stopping pluggram worker')
+    @staticmethod
+    def _runs(meta: PluggramMetadata, worker_meta: PluggramMetadata,
+              group) -> bool:
+        if group is None:
+            return worker_meta.name == meta.name
+
+        return any(m.name == meta.name for m, _ in group)
+
+    def update_options(self, meta: PluggramMetadata, changes: dict) -> bool:
+        """
+        Send changed option values of meta's pluggram to the running and
+        the prepared worker, if they run it, to apply before their next
+        tick. Returns False if neither does.
+        """
+        with self._lock:
+            sent = False
+
+            if self.is_running and self._runs(meta, self._meta, self._group):
+                self._slots[self._active].send_option_changes(meta.name,
+                                                              changes)
+                sent = True
+
+            if self._next is not None:
+                slot_index, _, next_meta, group = self._next
+
+                if self._runs(meta, next_meta, group):
+                    self._slots[slot_index].send_option_changes(meta.name,
+                                                                changes)
+                    sent = True
+
+            return sent
+
+    def profile(self, request: ProfileRequest) -> bool:
+        """
+        Have the running worker profile its ticks as request says. Returns
+        False if no worker runs.
+        """
+        with self._lock:
+            if not self.is_running:
+                return False
+
+            self._slots[self._active].send_profile_request(request)
+            return True
+
+    @staticmethod
+    def _end_worker(proc):
+        """
+        Join a worker told to stop, terminating and then killing it if it
+        does not exit in time, such as one stuck in tick().
+        """
+        proc.join(STOP_TIMEOUT_S)
+
+        if proc.is_alive():
+            LOG.warning(f'pluggram worker {proc.pid} did not stop in '
+                        f'{STOP_TIMEOUT_S}s, terminating it')
+            proc.terminate()
+            proc.join(STOP_KILL_S)
+
+        if proc.is_alive():
+            LOG.warning(f'pluggram worker {proc.pid} ignored SIGTERM, '
+                        f'killing it')
+            proc.kill()
+            proc.join()
+
+    def _discard_prepared(self):
+        if self._next is not None:
+            slot_index, proc, meta, _ = self._next
+            self._next = None
+            self._slots[slot_index].stop.set()
+            self._end_worker(proc)
+            LOG.info(f'discarded prepared pluggram {meta.name}')
+
+    def _stop_active(self):
         if self.is_running:
-            self._event_stop.set()
-            self._proc.join()
+            self._slots[self._active].stop.set()
+            self._end_worker(self._proc)
             LOG.info('stopped pluggram worker')
 
-            if clear and self._screen_url is not None:
-                screen = rpc.rpc_get_screen(self._screen_url)
-                screen.clear()
-                screen.render()
-                LOG.info('cleared screen')
+    def stop(self, clear=False):
+        LOG.info('stopping pluggram worker')
 
-            self._meta = None
-            return True
-        return False
+        with self._lock:
+            self._discard_prepared()
+
+            if self.is_running:
+                self._stop_active()
+
+                if clear and self._screen_url is not None:
+                    try:
+                        with rpc.screen_session(self._screen_url,
+                                                **self._screen_options) \
+                                as screen:
+                            screen.clear()
+                            screen.render()
+                        LOG.info('cleared screen')
+                    except rpc.RPCUnavailableError as e:
+                        LOG.warning(f'could not clear screen: {str(e)}')
+
+                self._meta = None
+                self._group = None
+                return True
+            return False
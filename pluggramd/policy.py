@@ -0,0 +1,283 @@
+import os
+import time
+import ctypes
+import signal
+import logging
+import platform
+import resource
+from collections import deque
+from utils import configure_logger
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+from threading import Event, Lock, Thread
+from dataclasses import dataclass
+
+
+LOG = logging.getLogger('pluggramd.policy')
+configure_logger(LOG)
+WATCHDOG_INTERVAL_S = 1.0
+# CPU use is averaged over this long before a worker counts as runaway
+WATCHDOG_WINDOW_S = 5.0
+MAX_VIOLATIONS = 64
+IONICE_CLASSES = {'best-effort': 2, 'idle': 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+# a worker whose pluggram ran out of address space exits with this code
+MEMORY_EXIT_CODE = 75
+# ioprio_set has no wrapper in libc or os
+IOPRIO_SET_SYSCALLS = {'x86_64': 251,
+                       'aarch64': 30,
+                       'armv6l': 314,
+                       'armv7l': 314,
+                       'i686': 289}
+
+
+@dataclass(frozen=True)
+class RunnerPolicy:
+    """
+    Limits applied to every pluggram worker. None leaves a limit off.
+    """
+    # cores workers must stay off, such as the one screend is pinned to
+    reserved_cpus: Tuple[int, ...] = ()
+    nice: Optional[int] = None
+    ionice: Optional[str] = None
+    # address space limit, and resident size the watchdog enforces
+    memory_mb: Optional[int] = None
+    # CPU seconds a worker may use over its whole life
+    cpu_time_s: Optional[int] = None
+    # share of a core a worker may use, averaged over WATCHDOG_WINDOW_S
+    cpu_percent: Optional[float] = None
+
+    @property
+    def watched(self) -> bool:
+        return self.memory_mb is not None or \
+               self.cpu_time_s is not None or \
+               self.cpu_percent is not None
+
+
+@dataclass(frozen=True)
+class Violation:
+    time: float
+    name: str
+    pid: int
+    # "memory", "cpu", "cpu_time" or "killed"
+    kind: str
+    detail: str
+    terminated: bool
+
+
+def _set_ionice(class_name: str, nice: Optional[int]):
+    syscall = IOPRIO_SET_SYSCALLS.get(platform.machine())
+
+    if syscall is None:
+        LOG.warning(f'cannot set I/O priority on {platform.machine()}')
+        return
+
+    # best-effort levels follow niceness like the kernel's default does
+    level = 4 if nice is None else min(max((nice + 20) // 5, 0), 7)
+    priority = IONICE_CLASSES[class_name] << IOPRIO_CLASS_SHIFT | level
+    libc = ctypes.CDLL(None, use_errno=True)
+
+    if libc.syscall(syscall, IOPRIO_WHO_PROCESS, 0, priority) != 0:
+        LOG.warning(f'could not set I/O priority: '
+                    f'{os.strerror(ctypes.get_errno())}')
+
+
+def apply_policy(policy: Optional[RunnerPolicy]):
+    """
+    Limit the calling worker process as policy says. Limits the system
+    refuses are logged and skipped.
+    """
+    if policy is None:
+        return
+
+    if policy.reserved_cpus:
+        cpus = os.sched_getaffinity(0) - set(policy.reserved_cpus)
+
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+        else:
+            LOG.warning('every allowed CPU is reserved, not pinning worker')
+
+    if policy.nice is not None:
+        try:
+            os.nice(policy.nice - os.nice(0))
+        except OSError as e:
+            LOG.warning(f'could not set niceness: {str(e)}')
+
+    if policy.ionice is not None:
+        _set_ionice(policy.ionice, policy.nice)
+
+    if policy.memory_mb is not None:
+        limit = policy.memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    if policy.cpu_time_s is not None:
+        # SIGXCPU at the soft limit, SIGKILL a second later if ignored
+        resource.setrlimit(resource.RLIMIT_CPU,
+                           (policy.cpu_time_s, policy.cpu_time_s + 1))
+
+
+def _read_usage(pid: int) -> Tuple[float, int]:
+    """
+    CPU seconds used and resident bytes of a process.
+    """
+    with open(f'/proc/{pid}/stat', 'r') as f:
+        # the command name may hold spaces, fields after it do not
+        fields = f.read().rsplit(')', 1)[1].split()
+
+    with open(f'/proc/{pid}/statm', 'r') as f:
+        resident_pages = int(f.read().split()[1])
+
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu_s = (int(fields[11]) + int(fields[12])) / ticks
+    return cpu_s, resident_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+class Watchdog:
+    """
+    Samples the CPU and memory use of pluggram workers on a thread and
+    terminates those over the policy's limits. Workers the kernel stopped
+    for running out of CPU time, or that were killed by anyone else, are
+    reported too.
+
+    workers() lists (name, worker) pairs to watch, where a worker is a
+    Process or anything with pid, is_alive() and exitcode.
+    """
+
+    @property
+    def violations(self) -> List[Violation]:
+        with self._lock:
+            return list(self._violations)
+
+    def __init__(self,
+                 policy: RunnerPolicy,
+                 workers: Callable[[], List[Tuple[str, object]]],
+                 on_violation: Optional[Callable[[Violation], None]] = None,
+                 interval_s=WATCHDOG_INTERVAL_S,
+                 window_s=WATCHDOG_WINDOW_S):
+        self._policy = policy
+        self._workers = workers
+        self._on_violation = on_violation
+        self._interval_s = interval_s
+        self._window_s = window_s
+        self._lock = Lock()
+        self._violations: Deque[Violation] = deque(maxlen=MAX_VIOLATIONS)
+        # pid: name, worker and (time, CPU seconds) samples
+        self._watched: Dict[int, Tuple[str, object, deque]] = {}
+        # exited workers the runner still lists
+        self._finished = set()
+        self._terminated = set()
+        self._stop = Event()
+        self._thread = Thread(target=self._run,
+                              name='runner-watchdog',
+                              daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _report(self, name: str, pid: int, kind: str, detail: str,
+                terminated: bool):
+        violation = Violation(time.time(), name, pid, kind, detail, terminated)
+        LOG.warning(f'pluggram {name} ({pid}) {detail}'
+                    f'{", terminating it" if terminated else ""}')
+
+        with self._lock:
+            self._violations.append(violation)
+
+        if self._on_violation is not None:
+            try:
+                self._on_violation(violation)
+            except Exception as e:
+                LOG.warning(f'violation listener failed: {str(e)}')
+
+    def _terminate(self, pid: int):
+        # a worker that ignored SIGTERM last round gets SIGKILL
+        sig = signal.SIGKILL if pid in self._terminated else signal.SIGTERM
+        self._terminated.add(pid)
+
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def _exited(self, pid: int, name: str, worker):
+        code = worker.exitcode
+
+        if pid in self._terminated:
+            self._terminated.discard(pid)
+        elif code == -signal.SIGXCPU:
+            self._report(name, pid, 'cpu_time',
+                         f'used up its {self._policy.cpu_time_s}s of CPU time',
+                         False)
+        elif code == MEMORY_EXIT_CODE:
+            self._report(name, pid, 'memory',
+                         f'ran out of its {self._policy.memory_mb}MB of '
+                         f'address space',
+                         False)
+        elif code == -signal.SIGKILL:
+            self._report(name, pid, 'killed',
+                         'was killed, possibly for running out of memory',
+                         False)
+
+    def _check(self, pid: int, name: str, samples: deque):
+        if pid in self._terminated:
+            self._terminate(pid)
+            return
+
+        try:
+            cpu_s, rss = _read_usage(pid)
+        except (OSError, IndexError, ValueError):
+            return
+
+        now = time.monotonic()
+        samples.append((now, cpu_s))
+
+        # keep the newest sample that is at least a window old
+        while len(samples) > 1 and now - samples[1][0] >= self._window_s:
+            samples.popleft()
+
+        if self._policy.memory_mb is not None and \
+                rss > self._policy.memory_mb * 1024 * 1024:
+            self._report(name, pid, 'memory',
+                         f'uses {rss / 1024 / 1024:.0f}MB of memory, more than '
+                         f'{self._policy.memory_mb}MB',
+                         True)
+            self._terminate(pid)
+            return
+
+        # only judge CPU use over a full window
+        elapsed = now - samples[0][0]
+
+        if self._policy.cpu_percent is not None and \
+                elapsed >= self._window_s:
+            percent = (cpu_s - samples[0][1]) / elapsed * 100
+
+            if percent > self._policy.cpu_percent:
+                self._report(name, pid, 'cpu',
+                             f'used {percent:.0f}% CPU for {elapsed:.0f}s, '
+                             f'more than {self._policy.cpu_percent:.0f}%',
+                             True)
+                self._terminate(pid)
+
+    def _run(self):
+        while not self._stop.wait(self._interval_s):
+            workers = self._workers()
+
+            for name, worker in workers:
+                if worker.pid not in self._watched and \
+                        worker.pid not in self._finished:
+                    self._watched[worker.pid] = (name, worker, deque())
+
+            for pid, (name, worker, samples) in list(self._watched.items()):
+                if worker.is_alive():
+                    self._check(pid, name, samples)
+                else:
+                    del self._watched[pid]
+                    self._finished.add(pid)
+                    self._exited(pid, name, worker)
+
+            self._finished &= {worker.pid for _, worker in workers}
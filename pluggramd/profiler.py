@@ -0,0 +1,155 @@
+import os
+import sys
+import time
+import cProfile
+import logging
+import threading
+from utils import configure_logger
+from typing import Dict, Optional
+from threading import Event, Thread
+from dataclasses import dataclass
+
+
+LOG = logging.getLogger('pluggramd.profiler')
+configure_logger(LOG)
+# the sampling profiler looks at the ticking thread this often
+SAMPLE_INTERVAL_S = 0.005
+# format of the file each mode writes
+PROFILE_FORMATS = {'cprofile': 'pstats', 'sampling': 'collapsed'}
+
+
+@dataclass(frozen=True)
+class ProfileRequest:
+    """
+    What a runner should profile: its next ticks ticks, or the ticks of
+    the next seconds seconds, whichever ends first, with cProfile or the
+    sampling profiler. The result goes to path.
+    """
+    mode: str
+    path: str
+    ticks: Optional[int] = None
+    seconds: Optional[float] = None
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:' \
+           f'{code.co_firstlineno})'
+
+
+class _Sampler:
+    """
+    Counts the call stacks of one thread, seen from another thread, while
+    active is set.
+    """
+
+    def __init__(self, thread_id: int, interval_s=SAMPLE_INTERVAL_S):
+        self.active = False
+        self.stacks: Dict[str, int] = {}
+        self._thread_id = thread_id
+        self._interval_s = interval_s
+        self._stop = Event()
+        self._thread = Thread(target=self._run,
+                              name='profile-sampler',
+                              daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self._interval_s):
+            if not self.active:
+                continue
+
+            frame = sys._current_frames().get(self._thread_id)
+            names = []
+
+            while frame is not None:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+
+            if names:
+                stack = ';'.join(reversed(names))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+
+class TickProfiler:
+    """
+    Profiles a worker's ticks as a ProfileRequest says. start() and stop()
+    bracket what is measured, once around every tick or once around a
+    whole stretch of an event loop. tick_done() counts ticks and tells
+    when the request is satisfied, then save() writes the result.
+
+    cProfile results are pstats files, sampling results are collapsed
+    stacks, one "frame;frame;frame count" line per stack, as flame graph
+    tools read them. Nothing is measured before a request arrives.
+    """
+
+    def __init__(self, request: ProfileRequest):
+        self._request = request
+        self._ticks = 0
+        self._started = time.monotonic()
+        self._profile: Optional[cProfile.Profile] = None
+        self._sampler: Optional[_Sampler] = None
+
+        if request.mode == 'sampling':
+            self._sampler = _Sampler(threading.get_ident())
+            self._sampler.start()
+        else:
+            self._profile = cProfile.Profile()
+
+    def start(self):
+        if self._sampler is not None:
+            self._sampler.active = True
+        else:
+            self._profile.enable()
+
+    def stop(self):
+        if self._sampler is not None:
+            self._sampler.active = False
+        else:
+            self._profile.disable()
+
+    def tick_done(self) -> bool:
+        """
+        Count a finished tick. Returns True once enough were profiled.
+        """
+        self._ticks += 1
+
+        if self._request.ticks is not None and \
+                self._ticks >= self._request.ticks:
+            return True
+
+        return self._request.seconds is not None and \
+            time.monotonic() - self._started >= self._request.seconds
+
+    def save(self):
+        """
+        Write what was measured so far to the request's path. The file
+        appears whole, readers never see it half written.
+        """
+        partial = f'{self._request.path}.part'
+
+        try:
+            if self._sampler is not None:
+                self._sampler.close()
+
+                with open(partial, 'w') as f:
+                    for stack, count in self._sampler.stacks.items():
+                        f.write(f'{stack} {count}\n')
+            else:
+                self._profile.dump_stats(partial)
+
+            os.replace(partial, self._request.path)
+        except OSError as e:
+            # the pluggram keeps running without its profile
+            LOG.warning(f'could not save profile to '
+                        f'"{self._request.path}": {str(e)}')
+            return
+
+        LOG.info(f'saved profile of {self._ticks} ticks to '
+                 f'"{self._request.path}"')
@@ -10,6 +10,8 @@ class ScrollingText(Pluggram):
     DESCRIPTION = 'Scrolling text message board'
     VERSION = '1.0.0'
     TICK_RATE = '20ms'
+    # frame_skip pixels are scrolled per this many milliseconds
+    STEP_MS = 20
     OPTIONS = [
         Option('brightness', 128, min=1, max=190),
         Option('message', 'Computer science rocks!', min=1),
@@ -17,7 +19,7 @@ class ScrollingText(Pluggram):
                help='What TrueType font face to load from file. (.ttf)'),
         Option('start_delay', 1000, min=0, help='Wait this many milliseconds before scrolling.'),
         Option('font_size', 17, min=6, max=60),
-        Option('frame_skip', 1, min=1, max=100, help='How many frames to skip per tick.'),
+        Option('frame_skip', 1, min=1, max=100, help='How many pixels to scroll every 20 milliseconds.'),
         Option('foreground', 0xFFFFFF, min=0, max=0xFFFFFF, color_picker=True, help='Text color.'),
         Option('background', 0, min=0, max=0xFFFFFF, color_picker=True),
         Option('stroke_thickness', 0, min=0, max=10, help='Number of pixels to outline around text.'),
@@ -62,7 +64,7 @@ class ScrollingText(Pluggram):
     def draw_line_message(self):
         self._screen.fill(self._bg)
         if self._centered:
-            self._screen.draw_text(self._x,
+            self._screen.draw_text(round(self._x),
                                    (self._screen.height // 2),
                                    self._fg,
                                    self._message,
@@ -71,7 +73,7 @@ class ScrollingText(Pluggram):
                                    stroke_width=self._stroke_thickness,
                                    stroke_fill=self._stroke_color)
         else:
-            self._screen.draw_text(self._x,
+            self._screen.draw_text(round(self._x),
                                    0,
                                    self._fg,
                                    self._message,
@@ -80,11 +82,11 @@ class ScrollingText(Pluggram):
                                    stroke_width=self._stroke_thickness,
                                    stroke_fill=self._stroke_color)
 
-    def tick(self):
+    def tick(self, delta_ms):
         if self._scrolling_enabled:
             self.draw_line_message()
 
-            if self._x == -self._reset_pos:
+            if self._x <= -self._reset_pos:
                 self._x = self._screen.width
 
                 if self._randomize:
@@ -94,7 +96,8 @@ class ScrollingText(Pluggram):
                         random.randrange(0x11, 0xFF)
                     )
             else:
-                self._x -= self._frame_skip
+                # late ticks scroll further so the speed stays the same
+                self._x -= self._frame_skip * delta_ms / self.STEP_MS
 
             self._screen.render()
         else:
@@ -0,0 +1,76 @@
+import os
+import asyncio
+from typing import Optional
+from aiorpc import AsyncScreen
+from pluggram import Option, Pluggram
+
+
+class SystemLoad(Pluggram):
+    DISPLAY_NAME = 'System Load'
+    DESCRIPTION = 'Load average of the screen computer'
+    VERSION = '1.0.0'
+    TICK_RATE = '1s'
+    OPTIONS = [
+        Option('brightness', 128, min=1, max=190),
+        Option('refresh_seconds', 5, min=1, max=60,
+               help='How often to read the load average.'),
+        Option('foreground', 0xFFFFFF, min=0, max=0xFFFFFF, color_picker=True,
+               help='Color of all rendered text.'),
+        Option('background', 0, min=0, max=0xFFFFFF, color_picker=True,
+               help='Color behind text.')
+    ]
+    FONT = 'arialbd.ttf'
+    FONT_SIZE = 10
+
+    def __init__(self,
+                 screen: AsyncScreen,
+                 **options):
+        self._brightness = options['brightness']
+        self._refresh_seconds = options['refresh_seconds']
+        self._foreground = options['foreground']
+        self._background = options['background']
+        self._screen = screen
+        self._load = None
+        self._fetching: Optional[asyncio.Task] = None
+
+    async def setup(self):
+        await self._screen.set_brightness(self._brightness)
+        await self._screen.set_font(self.FONT, self.FONT_SIZE)
+        # fetching runs beside ticking, it never holds a frame up
+        self._fetching = asyncio.ensure_future(self._fetch())
+
+    async def teardown(self):
+        if self._fetching is not None:
+            self._fetching.cancel()
+
+    async def on_options_changed(self, changes: dict):
+        self._refresh_seconds = changes.get('refresh_seconds',
+                                            self._refresh_seconds)
+        self._foreground = changes.get('foreground', self._foreground)
+        self._background = changes.get('background', self._background)
+
+        if 'brightness' in changes:
+            self._brightness = changes['brightness']
+            await self._screen.set_brightness(self._brightness)
+
+    async def _fetch(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            self._load = await loop.run_in_executor(None, os.getloadavg)
+            await asyncio.sleep(self._refresh_seconds)
+
+    async def tick(self):
+        message = 'LOAD\n...' if self._load is None \
+            else f'LOAD\n{self._load[0]:.2f}'
+
+        await self._screen.fill(self._background)
+        x, y = self._screen.center
+        await self._screen.draw_text(x,
+                                     y,
+                                     self._foreground,
+                                     message,
+                                     anchor='mm',
+                                     spacing=1,
+                                     alignment='center')
+        await self._screen.render()
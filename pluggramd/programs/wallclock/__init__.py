@@ -8,6 +8,7 @@ class WallClock(Pluggram):
     DESCRIPTION = 'Live digital clock display'
     VERSION = '1.0.0'
     TICK_RATE = '500ms'
+    TICK_ALIGN = '1s'
     OPTIONS = [
         Option('brightness', 128, min=1, max=190),
         Option('foreground', 0xFFFFFF, min=0, max=0xFFFFFF, color_picker=True,
@@ -94,3 +95,23 @@ class WallClock(Pluggram):
         # invert the colon
         if self._flash_colon:
             self._flasher = not self._flasher
+
+    def on_options_changed(self, changes: dict):
+        self._brightness = changes.get('brightness', self._brightness)
+        self._show_seconds = changes.get('show_seconds', self._show_seconds)
+        self._flash_colon = changes.get('flash_colon', self._flash_colon)
+        self._foreground = changes.get('foreground', self._foreground)
+        self._background = changes.get('background', self._background)
+        self._show_date = changes.get('show_date', self._show_date)
+        self._stroke_thickness = changes.get('stroke_thickness',
+                                             self._stroke_thickness)
+        self._stroke_fill = changes.get('stroke_color', self._stroke_fill)
+
+        if 'brightness' in changes:
+            self._screen.set_brightness(self._brightness)
+
+        if not self._flash_colon:
+            self._flasher = True
+
+        if not self._show_date:
+            self._screen.set_font(self.FONT_BOLD, size=self.LARGE_FONT)
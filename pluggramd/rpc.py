@@ -1,21 +1,400 @@
 import io
+import os
 import zmq
+import time
+import logging
+import tinyrpc.exc
 from enum import IntFlag
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from typing import List, Tuple, Union, Optional
 from tinyrpc import RPCClient
-from threading import Lock
+from utils import configure_logger
+# utils has put the shared modules on the path
+from drawing import LOG as DRAWING_LOG, Canvas
+# the rest of pluggramd reaches these through rpc
+from resilience import LOG as RESILIENCE_LOG, RPC_TIMEOUT_S, \
+    RPC_BACKOFF_MAX_S, COUNTER_NAMES, METRICS, CallProxy, DeadlineTransport, \
+    RPCUnavailableError, ResilientClient, counters_dict, get_rpc_metrics
+from threading import Lock, Condition
 from dataclasses import dataclass
-from tinyrpc.transports.zmq import ZmqClientTransport
+from tinyrpc.protocols import RPCErrorResponse
 from tinyrpc.protocols.msgpackrpc import MSGPACKRPCProtocol
 
 
-def rpc_get_screen(screen_url: str, context=zmq.Context()):
-    client = RPCClient(
-        MSGPACKRPCProtocol(),
-        ZmqClientTransport.create(context, screen_url)
-    )
-    proxy = client.get_proxy()
-    return Screen(proxy)
+# screen calls that return nothing and can be sent without waiting
+ONE_WAY_METHODS = frozenset([
+    'paste',
+    'set_pixel',
+    'set_brightness',
+    'draw_text',
+    'fill',
+    'draw_ellipse',
+    'draw_line',
+    'clear',
+    'write_file',
+    'reset_frame_count'
+])
+TEXT_CACHE_SIZE = 256
+# answered by screend itself with the caller's failed one-way calls
+TAKE_ERRORS_METHOD = 'take_deferred_errors'
+# failed one-way calls a client keeps until Screen.take_errors()
+DEFERRED_ERRORS_KEPT = 16
+POOL_MAX_SOCKETS = 8
+POOL_IDLE_CHECK_S = 10.0
+POOL_PING_TIMEOUT_S = 1.0
+# screen calls that can be repeated after a lost reply without changing
+# what ends up on the screen. Offscreen calls are not: screend keys the
+# surface by connection, and a retry goes out on a fresh connection.
+SCREEN_IDEMPOTENT_METHODS = frozenset([
+    'ping',
+    'describe',
+    'font_names',
+    'text_dimensions',
+    'current_font',
+    'set_font',
+    'get_frame',
+    'antialiasing',
+    'max_brightness'
+])
+
+LOG = logging.getLogger('pluggramd.rpc')
+configure_logger(LOG)
+configure_logger(DRAWING_LOG)
+configure_logger(RESILIENCE_LOG)
+
+
+def rpc_get_screen(screen_url: str,
+                   pipelined=False,
+                   fonts_dir=None,
+                   timeout=RPC_TIMEOUT_S,
+                   pool=None):
+    """
+    Connect to screend with a client leased from the process's pool. Call
+    close() on the screen to give the connection back. With fonts_dir set,
+    drawing happens on a local canvas using fonts from that directory and
+    render() ships whole frames. Calls without a reply within timeout
+    seconds raise CallTimeoutError.
+    """
+    pool = pool or get_pool()
+    client = pool.acquire(screen_url, pipelined)
+    proxy = ResilientClient(client,
+                            screen_url,
+                            SCREEN_IDEMPOTENT_METHODS,
+                            timeout).get_proxy()
+
+    try:
+        if fonts_dir is not None:
+            screen = LocalScreen(proxy, fonts_dir)
+        else:
+            screen = Screen(proxy)
+    except Exception as e:
+        pool.release(client, discard=not is_remote_error(e))
+        raise
+
+    screen.on_close = lambda discard: pool.release(client, discard)
+    return screen
+
+
+@contextmanager
+def screen_session(screen_url: str, **screen_options):
+    """
+    rpc_get_screen() for short tasks: the connection goes back to the pool
+    when the block ends, or is dropped if the transport failed.
+    """
+    screen = rpc_get_screen(screen_url, **screen_options)
+    try:
+        yield screen
+    except Exception as e:
+        screen.close(discard=not is_remote_error(e))
+        raise
+    screen.close()
+
+
+def is_remote_error(e: Exception) -> bool:
+    # an error reply leaves the socket usable, and so does a deadline as
+    # the transport resets itself, but ZeroMQ errors may not
+    return isinstance(e, tinyrpc.exc.RPCError)
+
+
+class PoolExhaustedError(Exception):
+    pass
+
+
+class ClientPool:
+    """
+    Connected screen RPC clients of one process, reused by URL and client
+    kind. At most max_sockets are open at once; idle ones for other URLs
+    are closed to make room, otherwise acquire() waits for a release.
+    Clients idle for longer than idle_check_s are pinged before reuse.
+
+    ZeroMQ contexts and sockets must not be used across fork(), so each
+    process gets its own pool from get_pool().
+    """
+
+    @property
+    def socket_count(self) -> int:
+        return len(self._idle) + len(self._leased)
+
+    def __init__(self,
+                 context: Optional[zmq.Context] = None,
+                 max_sockets=POOL_MAX_SOCKETS,
+                 idle_check_s=POOL_IDLE_CHECK_S,
+                 ping_timeout_s=POOL_PING_TIMEOUT_S):
+        self.pid = os.getpid()
+        self._context = context or zmq.Context()
+        self._max_sockets = max_sockets
+        self._idle_check_s = idle_check_s
+        self._ping_timeout_s = ping_timeout_s
+        # (key, client, released at), least recently released first
+        self._idle = []
+        self._leased = {}
+        self._cond = Condition()
+
+    def _connect(self, key: tuple):
+        url, pipelined = key
+
+        if pipelined:
+            client = PipelinedClient.create(self._context, url)
+        else:
+            client = RPCClient(
+                MSGPACKRPCProtocol(),
+                DeadlineTransport(self._context, url)
+            )
+        LOG.debug(f'opened {"pipelined " if pipelined else ""}screen '
+                  f'connection to {url}')
+        return client
+
+    @staticmethod
+    def _close(client):
+        socket = client.socket if isinstance(client, PipelinedClient) \
+            else client.transport.socket
+        socket.close(linger=0)
+
+    def _ping(self, client) -> bool:
+        holder = client if isinstance(client, PipelinedClient) \
+            else client.transport
+        timeout = holder.timeout
+        holder.timeout = self._ping_timeout_s
+
+        try:
+            client.get_proxy().ping()
+            return True
+        except tinyrpc.exc.RPCError:
+            return True
+        except Exception:
+            return False
+        finally:
+            holder.timeout = timeout
+
+    def _take(self, key: tuple, timeout: Optional[float]):
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._cond:
+            while True:
+                for i in range(len(self._idle) - 1, -1, -1):
+                    if self._idle[i][0] == key:
+                        _, client, released_at = self._idle.pop(i)
+                        self._leased[id(client)] = (key, client)
+                        return client, released_at
+
+                if self.socket_count >= self._max_sockets and self._idle:
+                    _, oldest, _ = self._idle.pop(0)
+                    self._close(oldest)
+
+                if self.socket_count < self._max_sockets:
+                    client = self._connect(key)
+                    self._leased[id(client)] = (key, client)
+                    return client, None
+
+                remaining = None if deadline is None \
+                    else deadline - time.monotonic()
+
+                if remaining is not None and remaining <= 0:
+                    raise PoolExhaustedError(f'all {self._max_sockets} screen '
+                                             f'connections are in use')
+
+                self._cond.wait(remaining)
+
+    def acquire(self,
+                url: str,
+                pipelined=False,
+                timeout: Optional[float] = None):
+        key = (url, pipelined)
+
+        while True:
+            client, released_at = self._take(key, timeout)
+
+            if released_at is None or \
+                    time.monotonic() - released_at < self._idle_check_s:
+                return client
+
+            if self._ping(client):
+                return client
+
+            LOG.info(f'dropping dead screen connection to {url}')
+            self.release(client, discard=True)
+
+    def release(self, client, discard=False):
+        # the next lease must not be handed this one's failed calls
+        if not discard and isinstance(client, PipelinedClient):
+            discard = not client.sync()
+
+        with self._cond:
+            leased = self._leased.pop(id(client), None)
+
+            if leased is None or discard:
+                self._close(client)
+            else:
+                self._idle.append((leased[0], client, time.monotonic()))
+
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            for _, client, _ in self._idle:
+                self._close(client)
+            self._idle.clear()
+
+
+_pool: Optional[ClientPool] = None
+_pool_lock = Lock()
+
+
+def _after_fork():
+    global _pool, _pool_lock
+    # the parent's sockets belong to its context, leave them alone
+    _pool = None
+    _pool_lock = Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def get_pool() -> ClientPool:
+    """
+    The calling process's client pool, created on first use.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = ClientPool()
+        return _pool
+
+
+class PipelinedClient:
+    """
+    msgpack-rpc client on a DEALER socket.
+
+    Calls named in one_way_methods go out as notifications and return
+    immediately, so any number of them can be in flight. Every other call
+    is a sync point that waits for its own reply. The server keeps failed
+    notifications until they are taken, which the first sync point after
+    them does in the same round trip. They are logged and kept in errors
+    for Screen.take_errors().
+    """
+
+    def __init__(self,
+                 socket: zmq.Socket,
+                 one_way_methods=ONE_WAY_METHODS,
+                 timeout: Optional[float] = None):
+        self.socket = socket
+        self.timeout = timeout
+        self._protocol = MSGPACKRPCProtocol()
+        self._one_way_methods = one_way_methods
+        self.errors = deque(maxlen=DEFERRED_ERRORS_KEPT)
+        # notifications went out since the server's errors were last taken
+        self._unsynced = False
+
+    @classmethod
+    def create(cls, context: zmq.Context, endpoint: str, **kwargs):
+        socket = context.socket(zmq.DEALER)
+        socket.connect(endpoint)
+        return cls(socket, **kwargs)
+
+    def is_one_way(self, method: str) -> bool:
+        return method in self._one_way_methods
+
+    def _send(self, request):
+        # a peer that stopped reading fills the queue until sends block
+        if self.timeout is not None and \
+                not self.socket.poll(int(self.timeout * 1000), zmq.POLLOUT):
+            raise tinyrpc.exc.TimeoutError()
+
+        # empty delimiter frame makes this look like a REQ envelope
+        self.socket.send_multipart([b'', request.serialize()])
+
+    def _receive(self, request):
+        while True:
+            if self.timeout is not None and \
+                    not self.socket.poll(int(self.timeout * 1000)):
+                raise tinyrpc.exc.TimeoutError()
+
+            frames = self.socket.recv_multipart()
+            response = self._protocol.parse_reply(frames[-1])
+
+            if response.unique_id == request.unique_id:
+                return response
+
+    def _record_errors(self, errors: List[str]):
+        for error in errors:
+            LOG.warning(f'screen call {error}')
+
+        self.errors.extend(errors)
+
+    def call(self, method: str, args):
+        one_way = self.is_one_way(method)
+        request = self._protocol.create_request(method, args, None, one_way)
+        self._send(request)
+
+        if one_way:
+            self._unsynced = True
+            return None
+
+        take = None
+
+        if self._unsynced and method != TAKE_ERRORS_METHOD:
+            take = self._protocol.create_request(TAKE_ERRORS_METHOD,
+                                                 [],
+                                                 None,
+                                                 False)
+            self._send(take)
+
+        self._unsynced = False
+        response = self._receive(request)
+
+        if take is not None:
+            self._record_errors(self._receive(take).result)
+
+        if isinstance(response, RPCErrorResponse):
+            self._protocol.raise_error(response)
+
+        if method == TAKE_ERRORS_METHOD:
+            self._record_errors(response.result)
+            errors = list(self.errors)
+            self.errors.clear()
+            return errors
+
+        return response.result
+
+    def sync(self) -> bool:
+        """
+        Take and forget this connection's errors, on the server too, so
+        whoever uses it next starts clean. False if the server did not
+        answer.
+        """
+        try:
+            if self._unsynced:
+                self.call(TAKE_ERRORS_METHOD, [])
+        except Exception:
+            return False
+
+        self.errors.clear()
+        return True
+
+    def get_proxy(self):
+        return CallProxy(self)
 
 
 def get_key_display_name(key: str):
@@ -26,19 +405,19 @@ class Screen:
 
     @property
     def width(self) -> int:
-        return self._rpc.width()
+        return self._describe()['width']
 
     @property
     def height(self) -> int:
-        return self._rpc.height()
+        return self._describe()['height']
 
     @property
     def pixel_count(self) -> int:
-        return self._rpc.pixel_count()
+        return self._describe()['pixel_count']
 
     @property
     def center(self) -> Tuple[int, int]:
-        return self._rpc.center()
+        return self._describe()['center']
 
     @property
     def antialiasing(self) -> bool:
@@ -55,10 +434,31 @@ class Screen:
 
     @property
     def max_brightness(self) -> int:
-        return self._rpc.max_brightness()
+        return self._describe()['max_brightness']
 
-    def __init__(self, rpc_proxy):
+    def __init__(self, rpc_proxy, text_cache_size=TEXT_CACHE_SIZE):
         self._rpc = rpc_proxy
+        self.on_close = None
+        self._description: Optional[dict] = None
+        self._font_key = None
+        self._text_cache = OrderedDict()
+        self._text_cache_size = text_cache_size
+
+    def _describe(self) -> dict:
+        if self._description is None:
+            description = self._rpc.describe()
+            description['center'] = tuple(description['center'])
+            self._description = description
+        return self._description
+
+    def _check_epoch(self, epoch: Optional[int]):
+        # a new epoch means screend restarted and may be configured
+        # differently, so everything learned from it is stale
+        if self._description is not None:
+            if epoch != self._description['epoch']:
+                self._description = None
+                self._font_key = None
+                self._text_cache.clear()
 
     def paste(self,
               img,
@@ -69,7 +469,23 @@ class Screen:
         self._rpc.paste(output.getvalue(), box)
 
     def render(self):
-        self._rpc.render()
+        self._check_epoch(self._rpc.render())
+
+    def begin_offscreen(self):
+        """
+        Draw and render to a canvas of this connection's own in screend
+        until present() puts it on the screen.
+        """
+        self._check_epoch(self._rpc.begin_offscreen())
+        # the new canvas starts with the default font
+        self._font_key = None
+
+    def end_offscreen(self):
+        self._rpc.end_offscreen()
+        self._font_key = None
+
+    def present(self, fade_ms=None):
+        self._check_epoch(self._rpc.present(fade_ms))
 
     def set_pixel(self,
                   x: int,
@@ -85,7 +501,12 @@ class Screen:
                  name: str,
                  size=None,
                  font_face=None) -> bool:
-        return self._rpc.set_font(name, size, font_face)
+        loaded = self._rpc.set_font(name, size, font_face)
+
+        if loaded:
+            self._font_key = (name.lower().strip(), size, font_face)
+
+        return loaded
 
     def font_names(self) -> list:
         return self._rpc.font_names()
@@ -95,10 +516,31 @@ class Screen:
                         spacing=None,
                         features=None,
                         stroke_width=None) -> Tuple[int, int]:
-        return self._rpc.text_dimensions(message,
-                                         spacing,
-                                         features,
-                                         stroke_width)
+        key = (self._font_key,
+               message,
+               spacing,
+               tuple(features) if features else None,
+               stroke_width)
+
+        # screend's font is only known once set_font() succeeded
+        cacheable = self._font_key is not None
+
+        if cacheable and key in self._text_cache:
+            self._text_cache.move_to_end(key)
+            return self._text_cache[key]
+
+        dimensions = tuple(self._rpc.text_dimensions(message,
+                                                     spacing,
+                                                     features,
+                                                     stroke_width))
+
+        if cacheable:
+            self._text_cache[key] = dimensions
+
+            if len(self._text_cache) > self._text_cache_size:
+                self._text_cache.popitem(last=False)
+
+        return dimensions
 
     def index_of(self,
                  x: int,
@@ -159,6 +601,127 @@ class Screen:
     def reset_frame_count(self):
         self._rpc.reset_frame_count()
 
+    def take_errors(self) -> List[str]:
+        """
+        Errors of drawing calls sent without waiting for a reply, since the
+        last time they were taken. Each was logged when it came back with
+        the next call that waited for a reply. Always empty unless
+        pipelined.
+        """
+        return self._rpc.take_deferred_errors()
+
+    def close(self, discard=False):
+        if self.on_close is not None:
+            self.on_close(discard)
+            self.on_close = None
+
+
+class LocalScreen(Screen):
+    """
+    Screen that rasterizes in this process and sends one raw frame per
+    render(), no matter how many primitives were drawn. Output matches
+    server-side drawing pixel for pixel.
+    """
+
+    @property
+    def current_font(self) -> Tuple[str, str]:
+        return self._canvas.current_font
+
+    def __init__(self, rpc_proxy, fonts_dir: str, **kwargs):
+        super().__init__(rpc_proxy, **kwargs)
+        self._fonts_dir = fonts_dir
+        self._canvas = Canvas(self.width, self.height, fonts_dir)
+
+    def _check_epoch(self, epoch: Optional[int]):
+        super()._check_epoch(epoch)
+
+        if self._description is None:
+            if (self._canvas.width, self._canvas.height) != \
+                    (self.width, self.height):
+                self._canvas = Canvas(self.width, self.height, self._fonts_dir)
+
+    def paste(self,
+              img,
+              box=None,
+              fmt='png'):
+        self._canvas.paste(img, box)
+
+    def render(self):
+        self._check_epoch(self._rpc.render_frame(self._canvas.tobytes()))
+
+    def set_pixel(self,
+                  x: int,
+                  y: int,
+                  color: int):
+        self._canvas.set_pixel(x, y, color)
+
+    def set_font(self,
+                 name: str,
+                 size=None,
+                 font_face=None) -> bool:
+        return self._canvas.set_font(name, size, font_face)
+
+    def font_names(self) -> list:
+        return self._canvas.font_names()
+
+    def text_dimensions(self,
+                        message: str,
+                        spacing=None,
+                        features=None,
+                        stroke_width=None) -> Tuple[int, int]:
+        return self._canvas.text_dimensions(message,
+                                            spacing,
+                                            features,
+                                            stroke_width)
+
+    def draw_text(self,
+                  x: int,
+                  y: int,
+                  color: int,
+                  message: str,
+                  anchor=None,
+                  spacing=None,
+                  alignment=None,
+                  stroke_width=None,
+                  stroke_fill=None):
+        self._canvas.draw_text(x,
+                               y,
+                               color,
+                               message,
+                               anchor,
+                               spacing,
+                               alignment,
+                               stroke_width,
+                               stroke_fill)
+
+    def fill(self,
+             color: int,
+             box=None):
+        self._canvas.fill(color, box)
+
+    def draw_ellipse(self,
+                     x: int,
+                     y: int,
+                     width=None,
+                     color=None,
+                     outline=None):
+        self._canvas.draw_ellipse(x, y, width, color, outline)
+
+    def draw_line(self,
+                  x: int,
+                  y: int,
+                  color=None,
+                  width=None,
+                  rounded=False):
+        self._canvas.draw_line(x, y, color, width, rounded)
+
+    def clear(self):
+        self._canvas.clear()
+
+    def write_file(self,
+                   filename: str):
+        self._canvas.write_file(filename)
+
 
 class InputMethod(IntFlag):
     DEFAULT = 0b00000000
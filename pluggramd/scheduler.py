@@ -0,0 +1,241 @@
+import os
+import math
+import time
+import asyncio
+from typing import Callable, Optional
+
+
+TICK_STAT_NAMES = ('ticks',
+                   'overruns',
+                   'skipped',
+                   'jitter_mean_ms',
+                   'jitter_max_ms',
+                   'busy_mean_ms',
+                   'busy_max_ms',
+                   'cpu_percent',
+                   'target_hz',
+                   'effective_hz',
+                   'busy_last_ms',
+                   'rpc_calls_per_tick',
+                   'rss_mb')
+# wall clock steps smaller than this leave aligned ticks where they are
+REALIGN_THRESHOLD_S = 0.05
+# weight of the latest tick period in the effective rate
+RATE_SMOOTHING = 0.1
+# resident size is read from /proc at most this often
+RSS_INTERVAL_S = 1.0
+
+
+def stats_dict(values) -> dict:
+    return dict(zip(TICK_STAT_NAMES, values))
+
+
+class TickScheduler:
+    """
+    Paces a pluggram's ticks on absolute deadlines.
+
+    Deadlines advance by exactly one interval, so time spent ticking does
+    not add up to drift. A tick that starts more than a whole interval late
+    skips the deadlines it missed instead of firing them back to back. With
+    align_ms, the first deadline falls on a wall-clock multiple of it and
+    ticks move with the wall clock when it is set. Without an interval
+    ticks run back to back. Sleeps end at once when stop_event is set.
+    wait_async() paces coroutines on an event loop the same way.
+
+    delta_ms is the time between the starts of the last two ticks, which
+    grows past the interval when ticks overrun or are skipped.
+
+    Tick start jitter, overruns, busy time, the target and effective tick
+    rates and the process's resident size go to stats, a shared array laid
+    out as TICK_STAT_NAMES, so the parent process can read them without
+    asking. With call_count, a function returning how many RPC calls the
+    process made so far, calls per tick go there too.
+    """
+
+    def __init__(self,
+                 interval_ms: Optional[int],
+                 stop_event,
+                 align_ms: Optional[int] = None,
+                 stats=None,
+                 call_count: Optional[Callable[[], int]] = None):
+        self._interval_s = interval_ms / 1000 if interval_ms else None
+        self._align_s = align_ms / 1000 if align_ms else None
+        self._stop = stop_event
+        self._stats = stats
+        self._call_count = call_count
+        self._calls_start = call_count() if call_count is not None else 0
+        self._deadline: Optional[float] = None
+        self._wall_offset = 0.0
+        self._tick_start: Optional[float] = None
+        self._run_start = time.monotonic()
+        self._cpu_start = time.process_time()
+        self._ticks = 0
+        self._overruns = 0
+        self._skipped = 0
+        self._jitter_sum = 0.0
+        self._jitter_max = 0.0
+        self._busy_sum = 0.0
+        self._busy_max = 0.0
+        self._busy_last = 0.0
+        self._rss_bytes = 0
+        self._rss_read: Optional[float] = None
+        self._delta_s = self._interval_s or 0.0
+        self._period_s: Optional[float] = None
+
+    @property
+    def delta_ms(self) -> float:
+        return self._delta_s * 1000
+
+    def _aligned(self, now: float) -> float:
+        wall = time.time()
+        self._wall_offset = wall - now
+        boundary = math.ceil(wall / self._align_s) * self._align_s
+        return now + boundary - wall
+
+    def _next_deadline(self, now: float) -> float:
+        if self._deadline is None:
+            if self._align_s is not None:
+                return self._aligned(now)
+            return now
+
+        deadline = self._deadline + self._interval_s
+
+        if self._align_s is not None and \
+                abs(time.time() - now - self._wall_offset) > \
+                REALIGN_THRESHOLD_S:
+            return self._aligned(now)
+
+        if now - deadline >= self._interval_s:
+            missed = math.floor((now - deadline) / self._interval_s)
+            self._skipped += missed
+            deadline += missed * self._interval_s
+
+        return deadline
+
+    def _finish_tick(self, now: float):
+        busy = now - self._tick_start
+        self._busy_last = busy
+        self._busy_sum += busy
+        self._busy_max = max(self._busy_max, busy)
+
+        if self._interval_s is not None and busy > self._interval_s:
+            self._overruns += 1
+
+    def _until_due(self) -> float:
+        """
+        Close the last tick and schedule the next. Returns how long until
+        it is due.
+        """
+        now = time.monotonic()
+
+        if self._tick_start is not None:
+            self._finish_tick(now)
+            self._publish(now)
+
+        if self._interval_s is None:
+            self._deadline = now
+            return 0.0
+
+        self._deadline = self._next_deadline(now)
+        return self._deadline - now
+
+    def _start_tick(self):
+        now = time.monotonic()
+
+        if self._tick_start is not None:
+            self._delta_s = now - self._tick_start
+            self._period_s = self._delta_s if self._period_s is None else \
+                self._period_s + RATE_SMOOTHING * \
+                (self._delta_s - self._period_s)
+
+        self._tick_start = now
+
+        if self._interval_s is not None:
+            jitter = self._tick_start - self._deadline
+            self._jitter_sum += jitter
+            self._jitter_max = max(self._jitter_max, jitter)
+
+        self._ticks += 1
+
+    def wait(self) -> bool:
+        """
+        Sleep until the next tick is due. Returns False instead once the
+        stop event is set.
+        """
+        remaining = self._until_due()
+
+        if remaining > 0 and self._stop.wait(remaining):
+            return False
+
+        self._start_tick()
+        return not self._stop.is_set()
+
+    async def wait_async(self) -> bool:
+        """
+        wait() for coroutines, with an asyncio.Event as the stop event.
+        """
+        remaining = self._until_due()
+
+        if remaining > 0:
+            try:
+                await asyncio.wait_for(self._stop.wait(), remaining)
+                return False
+            except asyncio.TimeoutError:
+                pass
+        else:
+            # let other pluggrams on the loop run between back to back ticks
+            await asyncio.sleep(0)
+
+        self._start_tick()
+        return not self._stop.is_set()
+
+    def values(self) -> list:
+        ticks = max(self._ticks, 1)
+        elapsed = time.monotonic() - self._run_start
+        cpu = time.process_time() - self._cpu_start
+        calls = self._call_count() - self._calls_start \
+            if self._call_count is not None else 0
+
+        return [self._ticks,
+                self._overruns,
+                self._skipped,
+                self._jitter_sum / ticks * 1000,
+                self._jitter_max * 1000,
+                self._busy_sum / ticks * 1000,
+                self._busy_max * 1000,
+                cpu / elapsed * 100 if elapsed > 0 else 0.0,
+                1 / self._interval_s if self._interval_s else 0.0,
+                1 / self._period_s if self._period_s else 0.0,
+                self._busy_last * 1000,
+                calls / ticks,
+                self._rss_bytes / 1024 / 1024]
+
+    def _read_rss(self):
+        try:
+            with open('/proc/self/statm', 'r') as f:
+                resident_pages = int(f.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            return
+
+        self._rss_bytes = resident_pages * os.sysconf('SC_PAGE_SIZE')
+
+    def _publish(self, now: float):
+        if self._stats is None:
+            return
+
+        if self._rss_read is None or now - self._rss_read >= RSS_INTERVAL_S:
+            self._rss_read = now
+            self._read_rss()
+
+        self._stats[:] = self.values()
+
+    def summary(self) -> str:
+        stats = stats_dict(self.values())
+        return (f'{stats["ticks"]:.0f} ticks, '
+                f'jitter mean {stats["jitter_mean_ms"]:.2f}ms '
+                f'max {stats["jitter_max_ms"]:.2f}ms, '
+                f'{stats["overruns"]:.0f} overruns, '
+                f'{stats["skipped"]:.0f} skipped, '
+                f'{stats["effective_hz"]:.1f} of '
+                f'{stats["target_hz"]:.1f} ticks/s, '
+                f'{stats["cpu_percent"]:.1f}% CPU')
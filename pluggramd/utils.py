@@ -1,3 +1,5 @@
+import os
+import sys
 import time
 import logging
 
@@ -7,6 +9,14 @@ DEV_FORMATTER = logging.Formatter('{levelname:>8}: {message} [{name}@{lineno}]',
                                   datefmt='%x %H:%M:%S',
                                   style='{')
 FORMATTER = logging.Formatter('{levelname:>8}: {message}', style='{')
+# modules the daemons have in common, importable once utils is imported
+SHARED_DIR = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                           os.pardir,
+                                           os.pardir,
+                                           'shared'))
+
+if SHARED_DIR not in sys.path:
+    sys.path.append(SHARED_DIR)
 
 
 def configure_logger(log):
@@ -49,6 +59,13 @@ def get_key_display_name(key: str):
     return key.replace('_', ' ').capitalize()
 
 
+def canonical_filename(directory: str, name: str):
+    for file in os.listdir(directory):
+        if file.lower().strip() == name.lower().strip():
+            return file
+    return None
+
+
 def timing_counter():
     """
     perf_counter() in milliseconds.
@@ -0,0 +1,442 @@
+import os
+import rpc
+import time
+import signal
+import inspect
+import logging
+import traceback
+from utils import configure_logger
+from typing import Dict, List, Optional, Sequence, Tuple
+from policy import RunnerPolicy, apply_policy
+from threading import Lock
+from collections import OrderedDict
+from pluggram import RunnerSlot, load_type, run_pluggram
+from PIL import Image, ImageDraw, ImageFont
+from multiprocessing import Array, Pipe, Process
+from multiprocessing.connection import Connection, wait
+
+
+LOG = logging.getLogger('pluggramd.zygote')
+configure_logger(LOG)
+# pause before replacing a spare that died before it was used
+SPARE_RETRY_S = 1.0
+# exit codes of this many finished workers are kept for exitcode
+EXIT_CODES_KEPT = 16
+# workers left running this long after pluggramd went away are killed
+WORKER_EXIT_S = 3.0
+
+
+class RunnerHandle:
+    """
+    A pluggram worker forked by the zygote. Stands in for the Process of a
+    directly spawned worker.
+    """
+
+    def __init__(self, zygote: 'Zygote', pid: int):
+        self._zygote = zygote
+        self.pid = pid
+        # remembered here, as the zygote forgets old exits and pids recur
+        self._exited = False
+        self._exitcode: Optional[int] = None
+
+    @property
+    def exitcode(self) -> Optional[int]:
+        return self._exitcode
+
+    def _record_exit(self):
+        self._exited = True
+        self._exitcode = self._zygote.exitcode(self.pid)
+
+    def is_alive(self) -> bool:
+        if not self._exited and not self._zygote.is_alive(self.pid):
+            self._record_exit()
+
+        return not self._exited
+
+    def join(self, timeout: Optional[float] = None):
+        if not self._exited and self._zygote.join(self.pid, timeout):
+            self._record_exit()
+
+    def _signal(self, sig: int):
+        # once reaped, the pid may belong to another process
+        if self.is_alive():
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self._signal(signal.SIGTERM)
+
+    def kill(self):
+        self._signal(signal.SIGKILL)
+
+
+def _preload(module_paths: List[str]) -> Dict[str, Tuple[str, type]]:
+    types = {}
+
+    for module_path in module_paths:
+        try:
+            types[module_path] = load_type(module_path)
+        except TypeError:
+            LOG.warning(f'could not preload "{module_path}"')
+
+    # first use of PIL's drawing and fonts loads more than the imports do
+    img = Image.new('RGB', (8, 8))
+    ImageDraw.Draw(img).text((0, 0), '0', font=ImageFont.load_default())
+    return types
+
+
+def _spare_process(conn: Connection,
+                   types: Dict[str, Tuple[str, type]],
+                   screen_url: str,
+                   screen_options: dict,
+                   slots: Sequence[RunnerSlot],
+                   rpc_counters: Array,
+                   policy: Optional[RunnerPolicy]) -> Optional[int]:
+    apply_policy(policy)
+
+    if rpc_counters is not None:
+        rpc.METRICS.attach(screen_url, rpc_counters)
+
+    screen = None
+
+    try:
+        screen = rpc.rpc_get_screen(screen_url, **screen_options)
+        # opens the connection and caches the screen's description
+        _ = screen.width
+    except rpc.RPCUnavailableError as e:
+        LOG.debug(f'spare could not reach the screen yet: {str(e)}')
+
+        if screen is not None:
+            screen.close(discard=True)
+            screen = None
+
+    try:
+        module_path, module_name, tick_rate, filled_options, tick_align, \
+            slot_index, handover, fade_ms = conn.recv()
+    except EOFError:
+        # the zygote is going away
+        return
+
+    conn.close()
+
+    if screen is None:
+        try:
+            screen = rpc.rpc_get_screen(screen_url, **screen_options)
+        except rpc.RPCUnavailableError as e:
+            LOG.error(f'screen unavailable, not starting pluggram '
+                      f'"{module_name}": {str(e)}')
+            return
+
+    if module_path in types:
+        live_type = types[module_path][1]
+    else:
+        live_type = load_type(module_path)[1]
+
+    if inspect.iscoroutinefunction(live_type.tick):
+        # async pluggrams bring their own connection
+        from host import HostedPluggram, host_process
+        screen.close()
+        return host_process(screen_url,
+                            screen_options,
+                            [HostedPluggram(live_type,
+                                            module_name,
+                                            tick_rate,
+                                            filled_options,
+                                            tick_align)],
+                            slots[slot_index],
+                            handover,
+                            fade_ms)
+
+    exit_code = run_pluggram(screen,
+                             live_type,
+                             module_name,
+                             tick_rate,
+                             filled_options,
+                             slots[slot_index],
+                             tick_align,
+                             handover,
+                             fade_ms)
+    screen.close()
+    return exit_code
+
+
+def _fork_spare(control: Connection,
+                interrupt_handler,
+                types,
+                *args) -> Tuple[int, Connection]:
+    parent_end, child_end = Pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        code = 0
+        control.close()
+        parent_end.close()
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # Ctrl-C stops workers as it did before there was a zygote
+        signal.signal(signal.SIGINT, interrupt_handler)
+
+        try:
+            code = _spare_process(child_end, types, *args) or 0
+        except Exception:
+            LOG.error(traceback.format_exc())
+            code = 1
+        finally:
+            os._exit(code)
+
+    child_end.close()
+    return pid, parent_end
+
+
+def _reap() -> List[Tuple[int, int]]:
+    """
+    Pids and exit codes of the children that exited, negative signal
+    numbers for those killed by one, like Process.exitcode.
+    """
+    exited = []
+
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+
+        if pid == 0:
+            break
+
+        code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) \
+            else os.WEXITSTATUS(status)
+        exited.append((pid, code))
+
+    return exited
+
+
+def zygote_process(parent_control: Connection,
+                   control: Connection,
+                   module_paths: List[str],
+                   screen_url: str,
+                   screen_options: dict,
+                   slots: Sequence[RunnerSlot],
+                   rpc_counters: Array,
+                   policy: Optional[RunnerPolicy] = None):
+    """
+    Preloads every pluggram and keeps one forked spare worker connected to
+    the screen, waiting for the pluggram to run. Answers "run" requests
+    on control with the pid of the spare it handed the pluggram to and
+    reports each worker's exit.
+    """
+    # with pluggramd's end closed here, its exit shows as EOF on control
+    parent_control.close()
+    types = _preload(module_paths)
+    LOG.info(f'preloaded {len(types)} pluggrams')
+
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_r, False)
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGCHLD, lambda _s, _f: None)
+    signal.signal(signal.SIGTERM, lambda _s, _f: None)
+    interrupt_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    spare: Optional[Tuple[int, Connection]] = None
+    # a spare that exited early is replaced no sooner than this
+    respawn_at = 0.0
+    running = set()
+    stopping = False
+
+    def fork():
+        return _fork_spare(control,
+                           interrupt_handler,
+                           types,
+                           screen_url,
+                           screen_options,
+                           slots,
+                           rpc_counters,
+                           policy)
+
+    while not stopping:
+        timeout = None
+
+        if spare is None:
+            timeout = respawn_at - time.monotonic()
+
+            if timeout <= 0:
+                spare = fork()
+                timeout = None
+
+        for ready in wait([control, wake_r], timeout):
+            if ready is wake_r:
+                signals = os.read(wake_r, 64)
+                stopping = signal.SIGTERM in signals
+
+                for pid, code in _reap():
+                    if spare is not None and pid == spare[0]:
+                        LOG.warning('spare pluggram worker exited early')
+                        spare[1].close()
+                        spare = None
+                        respawn_at = time.monotonic() + SPARE_RETRY_S
+                    elif pid in running:
+                        running.discard(pid)
+
+                        try:
+                            control.send(('exited', pid, code))
+                        except BrokenPipeError:
+                            stopping = True
+            else:
+                try:
+                    request = control.recv()
+                except EOFError:
+                    stopping = True
+                    break
+
+                if request[0] == 'run':
+                    pid, conn = spare or fork()
+                    spare = None
+                    conn.send(request[1])
+                    conn.close()
+                    running.add(pid)
+                    control.send(('started', pid))
+
+    # pluggramd is exiting, take the workers along
+    for slot in slots:
+        slot.stop.set()
+
+    if spare is not None:
+        os.kill(spare[0], signal.SIGTERM)
+        running.add(spare[0])
+
+    deadline = time.monotonic() + WORKER_EXIT_S
+
+    while running:
+        running.difference_update(pid for pid, _ in _reap())
+        remaining = deadline - time.monotonic()
+
+        if not running or remaining <= 0:
+            break
+
+        if wait([wake_r], remaining):
+            os.read(wake_r, 64)
+
+    for pid in running:
+        LOG.warning(f'pluggram worker {pid} did not stop, killing it')
+        os.kill(pid, signal.SIGKILL)
+
+
+class Zygote:
+    """
+    Handle on the zygote process, which forks pluggram workers that are
+    already warm, from the pluggramd process.
+    """
+
+    def __init__(self,
+                 module_paths: List[str],
+                 screen_url: str,
+                 screen_options: dict,
+                 slots: Sequence[RunnerSlot],
+                 rpc_counters: Array,
+                 policy: Optional[RunnerPolicy] = None):
+        self._control, child_control = Pipe()
+        # the heartbeat and watchdog threads ask whether workers run too
+        self._lock = Lock()
+        self._exited = set()
+        self._exit_codes = OrderedDict()
+        self._proc = Process(target=zygote_process,
+                             name='pluggram-zygote',
+                             args=(self._control,
+                                   child_control,
+                                   module_paths,
+                                   screen_url,
+                                   screen_options,
+                                   slots,
+                                   rpc_counters,
+                                   policy),
+                             daemon=True)
+        self._proc.start()
+        child_control.close()
+        LOG.info(f'started zygote ({self._proc.pid})')
+
+    @property
+    def available(self) -> bool:
+        return self._proc.is_alive()
+
+    def _receive(self, timeout: Optional[float] = 0.0):
+        """
+        Handle one message, None if none arrived in time.
+        """
+        if not self._control.poll(timeout):
+            return None
+
+        message = self._control.recv()
+
+        if message[0] == 'exited':
+            self._exited.add(message[1])
+            self._exit_codes[message[1]] = message[2]
+
+            while len(self._exit_codes) > EXIT_CODES_KEPT:
+                self._exited.discard(self._exit_codes.popitem(last=False)[0])
+
+        return message
+
+    def run(self,
+            module_path: str,
+            module_name: str,
+            tick_rate: Optional[int],
+            filled_options: dict,
+            tick_align: Optional[int],
+            slot_index: int,
+            handover: bool,
+            fade_ms: Optional[int]) -> RunnerHandle:
+        with self._lock:
+            self._control.send(('run', (module_path,
+                                        module_name,
+                                        tick_rate,
+                                        filled_options,
+                                        tick_align,
+                                        slot_index,
+                                        handover,
+                                        fade_ms)))
+
+            while True:
+                message = self._receive(None)
+
+                if message[0] == 'started':
+                    # a pid that is reused belongs to a new worker
+                    self._exited.discard(message[1])
+                    self._exit_codes.pop(message[1], None)
+                    return RunnerHandle(self, message[1])
+
+    def is_alive(self, pid: int) -> bool:
+        with self._lock:
+            try:
+                while self._receive() is not None:
+                    pass
+            except EOFError:
+                # orphaned workers cannot be tracked, but they still stop
+                return False
+
+            return pid not in self._exited
+
+    def exitcode(self, pid: int) -> Optional[int]:
+        """
+        Exit code of a finished worker, None while it runs or if it is long
+        gone.
+        """
+        with self._lock:
+            return self._exit_codes.get(pid)
+
+    def join(self, pid: int, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for a worker to exit, True once it did.
+        """
+        with self._lock:
+            try:
+                while pid not in self._exited:
+                    if self._receive(timeout) is None:
+                        return False
+            except EOFError:
+                return False
+
+            return True
@@ -2,9 +2,12 @@ import io
 import os
 import utils
 import logging
-import pathlib
+import time
 from PIL import Image, ImageDraw, ImageFont
+# utils has put the shared modules on the path
+from drawing import LOG as DRAWING_LOG, Canvas
 from typing import List, Tuple, Optional
+from collections import OrderedDict
 from tinyrpc.dispatch import public
 
 
@@ -16,6 +19,35 @@ except ModuleNotFoundError:
     _LED_STRIP_CLASS = DummyStrip
 
 
+# clients drawing offscreen at once, the oldest is dropped beyond this
+MAX_OFFSCREEN = 4
+MAX_FADE_MS = 1000
+FADE_FPS = 30
+
+
+class Surface(Canvas):
+    """
+    A canvas with its own current font and, once set, brightness.
+    """
+
+    def __init__(self, w: int, h: int, fonts_dir: str, fonts: dict):
+        super().__init__(w, h, fonts_dir, fonts)
+        self.brightness: Optional[int] = None
+
+
+class Crossfade:
+    """
+    A crossfade in progress from a frame to whatever the front surface
+    shows, over steps frames FADE_FPS apart.
+    """
+
+    def __init__(self, start: Image.Image, steps: int):
+        self.start = start
+        self.steps = steps
+        self.started = time.monotonic()
+        self.shown = 0
+
+
 class Screen:
 
     # property
@@ -38,6 +70,21 @@ class Screen:
     def center(self):
         return int(round(self._w / 2)), int(round(self._h / 2))
 
+    @public
+    def describe(self) -> dict:
+        """
+        Every property that stays fixed for the lifetime of this process,
+        tagged with an epoch that changes whenever screend restarts.
+        """
+        return {
+            'epoch': self._epoch,
+            'width': self._w,
+            'height': self._h,
+            'pixel_count': self.pixel_count(),
+            'center': self.center(),
+            'max_brightness': self._max_brightness
+        }
+
     # property
     def antialiasing(self):
         return self._painter.fontmode == 'L'
@@ -52,13 +99,22 @@ class Screen:
     # property
     @public
     def current_font(self) -> Tuple[str, str]:
-        return self._current_font.getname()
+        return self._surface.current_font
 
     # property
     @public
     def max_brightness(self) -> int:
         return self._max_brightness
 
+    # drawing state of the surface the current caller draws on
+    @property
+    def _canvas(self) -> Image.Image:
+        return self._surface.image
+
+    @property
+    def _painter(self) -> ImageDraw.ImageDraw:
+        return self._surface.painter
+
     def __init__(self,
                  w: int,
                  h: int,
@@ -70,7 +126,9 @@ class Screen:
                  gpio_channel: int,
                  fonts_dir: str,
                  antialiasing=False,
-                 frames_dir=None):
+                 frames_dir=None,
+                 strip_class=None,
+                 preview=None):
         assert isinstance(w, int)
         assert isinstance(h, int)
         assert isinstance(output_pin, int)
@@ -85,63 +143,193 @@ class Screen:
         super().__init__()
         self.LOG = logging.getLogger('screend.api')
         utils.configure_logger(self.LOG)
+        utils.configure_logger(DRAWING_LOG)
 
         self._logger = logging.getLogger()
+        self._epoch = int(time.time() * 1000)
         self._w = w
         self._h = h
         self._frame_count = 1
         self._frames_dir = frames_dir
+        self._preview = preview
         self._output_pin = output_pin
         self._fonts_dir = os.path.abspath(fonts_dir)
         self._cached_fonts = {'default': ImageFont.load_default()}
-        self._current_font = self._cached_fonts['default']
-        self._canvas = self._create_canvas('RGB', 0)
-        self._painter = ImageDraw.Draw(self._canvas)
+        # what render() shows, and what clients draw on unless they asked
+        # for an offscreen surface of their own
+        self._front = Surface(w, h, self._fonts_dir, self._cached_fonts)
+        self._surface = self._front
+        self._offscreen = OrderedDict()
+        self._caller = None
+        self._shown: Optional[Image.Image] = None
+        self._fade: Optional[Crossfade] = None
         self.antialiasing = antialiasing
         self._max_brightness = max_brightness
-        self._matrix = _LED_STRIP_CLASS(self.pixel_count(),
-                                        self._output_pin,
-                                        frequency,
-                                        dma_channel,
-                                        invert_signal,
-                                        max_brightness,
-                                        gpio_channel)
+        strip_class = strip_class or _LED_STRIP_CLASS
+        self._matrix = strip_class(self.pixel_count(),
+                                   self._output_pin,
+                                   frequency,
+                                   dma_channel,
+                                   invert_signal,
+                                   max_brightness,
+                                   gpio_channel)
         self.set_brightness(max_brightness)
         self._matrix.begin()
         self.clear()
 
-    def _setup_painter(self):
-        self._painter = ImageDraw.Draw(self._canvas)
-        self._painter.fontmode = self.antialiasing
-
-    def _set_canvas(self, mode: str, color: int):
-        self._canvas = self._create_canvas(mode, color)
-        self._setup_painter()
-
-    def _create_canvas(self, mode: str, color_data):
-        return Image.new(mode, (self._w, self._h), color_data)
-
     @public
     def paste(self, data: bytes, box: Optional[Tuple[int, int, int, int]]):
         img = Image.open(io.BytesIO(data))
-        self._canvas.paste(img, box=box)
+        self._surface.paste(img, box)
 
-    @public
-    def render(self):
-        for i, (r, g, b) in enumerate(self._canvas.getdata()):
+    def set_caller(self, client: Optional[bytes]):
+        """
+        Called by the server before each call with the identity of the
+        client making it, so drawing goes to that client's surface.
+        """
+        self._caller = client
+        self._surface = self._offscreen.get(client, self._front)
+
+    def _show(self, image: Image.Image):
+        self._shown = image
+
+        for i, (r, g, b) in enumerate(image.getdata()):
             self._matrix.setPixelColor(i, utils.combine_rgb(r, g, b))
 
         self._matrix.show()
 
         if self._frames_dir is not None:
             path = os.path.join(self._frames_dir, f'{self._frame_count}.png')
-            self.write_file(path)
+            image.save(path)
+
+        if self._preview is not None:
+            self._preview.offer(self._w,
+                                self._h,
+                                self._epoch,
+                                self._frame_count,
+                                image.tobytes())
 
         self._frame_count += 1
 
+    @public
+    def render(self) -> int:
+        # an offscreen frame waits for present(), and during a crossfade
+        # the next step shows the new front
+        if self._surface is self._front and self._fade is None:
+            self._show(self._canvas)
+
+        return self._epoch
+
+    @public
+    def begin_offscreen(self) -> int:
+        """
+        Send the calling client's drawing and renders to a blank canvas of
+        its own, leaving the screen to other clients until it calls
+        present().
+        """
+        if self._caller is None:
+            raise RuntimeError('Offscreen drawing needs a client identity')
+
+        self._offscreen.pop(self._caller, None)
+        self._offscreen[self._caller] = Surface(self._w,
+                                                self._h,
+                                                self._fonts_dir,
+                                                self._cached_fonts)
+
+        while len(self._offscreen) > MAX_OFFSCREEN:
+            self._offscreen.popitem(last=False)
+            self.LOG.warning('dropped an abandoned offscreen surface')
+
+        self.set_caller(self._caller)
+        return self._epoch
+
+    @public
+    def end_offscreen(self):
+        self._offscreen.pop(self._caller, None)
+        self.set_caller(self._caller)
+
+    @public
+    def present(self, fade_ms: Optional[int]) -> int:
+        """
+        Make the calling client's offscreen canvas the screen and show it,
+        crossfading from the current frame over fade_ms. Renders as usual
+        for clients drawing on the screen already. The crossfade runs on
+        after the call returns, see advance_fade().
+        """
+        surface = self._offscreen.pop(self._caller, None)
+
+        if surface is None:
+            return self.render()
+
+        steps = min(fade_ms or 0, MAX_FADE_MS) * FADE_FPS // 1000
+        start = self._front.image if self._shown is None else self._shown
+        self._front = surface
+        self._surface = surface
+        self._fade = None
+
+        if surface.brightness is not None:
+            self.set_brightness(surface.brightness)
+
+        self.LOG.info('presented offscreen surface')
+
+        if steps > 1:
+            self._fade = Crossfade(start.copy(), steps)
+            self.advance_fade()
+            return self._epoch
+
+        return self.render()
+
+    def advance_fade(self) -> Optional[float]:
+        """
+        Show the crossfade step that is due, if any. Returns the seconds
+        until the next one, or None once no crossfade is running. The
+        server calls this between requests, so other clients are served
+        while the screen fades.
+        """
+        fade = self._fade
+
+        if fade is None:
+            return None
+
+        step = int((time.monotonic() - fade.started) * FADE_FPS) + 1
+
+        if step > fade.shown:
+            fade.shown = step
+
+            if step >= fade.steps:
+                self._fade = None
+                self._show(self._front.image)
+                return None
+
+            self._show(Image.blend(fade.start,
+                                   self._front.image,
+                                   step / fade.steps))
+
+        return max(0.0, fade.started + fade.shown / FADE_FPS -
+                   time.monotonic())
+
+    @public
+    def render_frame(self, data: bytes) -> int:
+        """
+        Replace the whole canvas with raw RGB data drawn by a client, then
+        render it.
+        """
+        expected = self._w * self._h * 3
+
+        if len(data) != expected:
+            raise ValueError(f'Frame must be exactly {expected} bytes of RGB '
+                             f'data, got {len(data)}')
+
+        self._canvas.frombytes(data)
+        return self.render()
+
+    @public
+    def get_frame(self) -> bytes:
+        return self._canvas.tobytes()
+
     @public
     def set_pixel(self, x: int, y: int, color: int):
-        self._painter.point((x, y), fill=color)
+        self._surface.set_pixel(x, y, color)
 
     @public
     def set_brightness(self, v: int):
@@ -151,6 +339,11 @@ class Screen:
         if v > self._max_brightness:
             raise RuntimeError('Too bright! Tried to exceed safety maximum')
 
+        # an offscreen surface brings its brightness along to present()
+        if self._surface is not self._front:
+            self._surface.brightness = v
+            return
+
         self._matrix.setBrightness(v)
         self.LOG.info('screen brightness changed ({})'.format(v))
 
@@ -159,51 +352,11 @@ class Screen:
                  name: str,
                  size: Optional[int],
                  font_face: Optional[int]) -> bool:
-        unique_name = name.lower().strip()
-
-        if size is not None:
-            assert isinstance(size, int)
-            unique_name += f'@{size}'
-
-        if font_face is not None:
-            assert isinstance(font_face, int)
-            unique_name += f'#{font_face}'
-
-        if size is None:
-            raise ValueError('Font size is required for all non-default fonts')
-
-        if unique_name in self._cached_fonts.keys():
-            self._current_font = self._cached_fonts[unique_name]
-            return True
-        else:
-            try:
-                canonical_name = utils.canonical_filename(self._fonts_dir, name)
-
-                if canonical_name is None:
-                    raise FileNotFoundError()
-
-                font_path = os.path.join(self._fonts_dir, canonical_name)
-                ext = pathlib.Path(font_path).suffix
-
-                if ext == '.ttf':
-                    self._current_font = ImageFont.truetype(font_path, size,
-                                                            font_face or 0)
-                    self.LOG.info(f'loaded TrueType font "{name}"')
-                else:
-                    self._current_font = ImageFont.load(font_path)
-                    self.LOG.info(f'loaded font "{name}"')
-
-                self._cached_fonts.update({unique_name: self._current_font})
-                return True
-            except OSError:
-                self.LOG.warning(f'failed to load font "{name}" from '
-                                 f'"{self._fonts_dir}"')
-
-        return False
+        return self._surface.set_font(name, size, font_face)
 
     @public
     def font_names(self) -> list:
-        return [n.lower() for n in os.listdir(self._fonts_dir)]
+        return self._surface.font_names()
 
     @public
     def text_dimensions(self,
@@ -211,12 +364,10 @@ class Screen:
                         spacing: Optional[int],
                         features: Optional[List[str]],
                         stroke_width: Optional[int]) -> Tuple:
-        a, b = self._painter.multiline_textsize(message,
-                                                self._current_font,
-                                                spacing=spacing or 4,
-                                                features=features,
-                                                stroke_width=stroke_width or 0)
-        return a, b
+        return self._surface.text_dimensions(message,
+                                             spacing,
+                                             features,
+                                             stroke_width)
 
     @public
     def index_of(self, x: int, y: int) -> int:
@@ -239,28 +390,19 @@ class Screen:
                   alignment: Optional[str],
                   stroke_width: Optional[int],
                   stroke_fill: Optional[int]):
-        self._painter.text((x, y),
-                           message,
-                           fill=color,
-                           font=self._current_font,
-                           anchor=anchor,
-                           spacing=spacing or 0,
-                           align=alignment,
-                           stroke_width=stroke_width or 0,
-                           stroke_fill=stroke_fill)
+        self._surface.draw_text(x,
+                                y,
+                                color,
+                                message,
+                                anchor,
+                                spacing,
+                                alignment,
+                                stroke_width,
+                                stroke_fill)
 
     @public
     def fill(self, color: int, box: Optional[Tuple[int, int, int, int]]):
-        if box is not None:
-            if not isinstance(box, tuple):
-                raise ValueError('box must be a tuple of structure (x1, y1, '
-                                 'x2, y2)')
-
-            if len(box) != 4:
-                raise ValueError('box must be a tuple of structure (x1, y1, '
-                                 'x2, y2)')
-
-        self._painter.rectangle(box or (0, 0, self._w, self._h), fill=color)
+        self._surface.fill(color, box)
 
     @public
     def draw_ellipse(self,
@@ -269,7 +411,7 @@ class Screen:
                      width: Optional[int],
                      color: Optional[int],
                      outline: Optional[int]):
-        self._painter.ellipse((x, y), fill=color, outline=outline, width=width)
+        self._surface.draw_ellipse(x, y, width, color, outline)
 
     @public
     def draw_line(self,
@@ -278,22 +420,25 @@ class Screen:
                   color: Optional[int],
                   width: Optional[int],
                   rounded: bool):
-        self._painter.line((x, y), fill=color, width=width,
-                           joint='curve' if rounded else None)
+        self._surface.draw_line(x, y, color, width, rounded)
 
     @public
     def clear(self):
-        self.fill(0, None)
+        self._surface.clear()
         self.LOG.info('cleared screen')
 
     @public
     def write_file(self, filename: str):
-        self._canvas.save(filename)
+        self._surface.write_file(filename)
 
     @public
     def get_data(self):
         self._canvas.getdata()
 
+    @public
+    def ping(self, payload: Optional[bytes] = None) -> int:
+        return len(payload) if payload else 0
+
     @public
     def reset_frame_count(self):
         self._frame_count = 1
@@ -0,0 +1,307 @@
+import io
+import os
+import sys
+import json
+import utils
+import logging
+import argparse
+import platform
+from api import Screen
+from PIL import Image
+from datetime import datetime
+from dummy_ws281x import DummyStrip
+from typing import Callable, List, Tuple
+
+
+BENCHMARK_VERSION = 1
+DEFAULT_RESOLUTIONS = [(54, 36), (108, 72), (216, 144)]
+DEFAULT_FONTS = [('slkscr.ttf', 9), ('arial.ttf', 17), ('arialbd.ttf', 13)]
+DEFAULT_ITERATIONS = 500
+DEFAULT_THRESHOLD = 10.0
+SAMPLE_TEXT = 'Hello 12:34'
+
+
+def percentile(ordered: List[float], pct: float) -> float:
+    if not ordered:
+        return 0.0
+
+    index = int(round((pct / 100) * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def measure(func: Callable, iterations: int, warmup: int) -> dict:
+    for _ in range(warmup):
+        func()
+
+    timings = []
+    started = utils.timing_counter()
+    for _ in range(iterations):
+        marker = utils.timing_counter()
+        func()
+        timings.append(utils.timing_counter() - marker)
+    elapsed = utils.timing_counter() - started
+
+    timings.sort()
+    return {
+        'iterations': iterations,
+        'ops_per_sec': (iterations / elapsed) * 1000 if elapsed > 0 else 0.0,
+        'mean_ms': sum(timings) / len(timings),
+        'p50_ms': percentile(timings, 50),
+        'p95_ms': percentile(timings, 95),
+        'p99_ms': percentile(timings, 99),
+        'max_ms': timings[-1]
+    }
+
+
+def create_screen(w: int, h: int, fonts_dir: str) -> Screen:
+    screen = Screen(w,
+                    h,
+                    18,
+                    800000,
+                    10,
+                    255,
+                    False,
+                    0,
+                    fonts_dir,
+                    strip_class=DummyStrip)
+
+    # font loads and clears are logged at INFO, which would dominate timings
+    screen.LOG.setLevel(logging.WARNING)
+    return screen
+
+
+def encode_png(w: int, h: int) -> bytes:
+    img = Image.new('RGB', (w, h), 0x00FF00)
+    output = io.BytesIO()
+    img.save(output, format='png')
+    return output.getvalue()
+
+
+def font_cases(screen: Screen, fonts: List[Tuple[str, int]]):
+    cases = []
+
+    for name, size in fonts:
+        if not screen.set_font(name, size, None):
+            print(f'skipping font "{name}" at size {size}: failed to load')
+            continue
+
+        def select(n=name, s=size):
+            return screen.set_font(n, s, None)
+
+        def draw(n=name, s=size):
+            screen.set_font(n, s, None)
+            screen.draw_text(0, 0, 0xFFFFFF, SAMPLE_TEXT, 'lt', None,
+                             'left', None, None)
+
+        def miss(n=name, s=size):
+            # drop only this font so every call takes the loading path
+            screen._cached_fonts.pop(f'{n.lower().strip()}@{s}', None)
+            screen.set_font(n, s, None)
+
+        cases.append((f'draw_text:{name}@{size}', draw))
+        cases.append((f'set_font_hit:{name}@{size}', select))
+        cases.append((f'set_font_miss:{name}@{size}', miss))
+
+    return cases
+
+
+def run_resolution(w: int,
+                   h: int,
+                   fonts_dir: str,
+                   fonts: List[Tuple[str, int]],
+                   iterations: int,
+                   warmup: int) -> dict:
+    screen = create_screen(w, h, fonts_dir)
+    png_data = encode_png(w, h)
+    cx, cy = w // 2, h // 2
+
+    cases = [
+        ('render', screen.render),
+        ('fill', lambda: screen.fill(0x0000FF, None)),
+        ('fill_box', lambda: screen.fill(0xFF0000, (0, 0, cx, cy))),
+        ('set_pixel', lambda: screen.set_pixel(cx, cy, 0xFFFFFF)),
+        ('paste', lambda: screen.paste(png_data, None))
+    ]
+    cases.extend(font_cases(screen, fonts))
+
+    results = {}
+    for name, func in cases:
+        results[name] = measure(func, iterations, warmup)
+        print(f'{w}x{h} {name:<32} '
+              f'{results[name]["ops_per_sec"]:>12.1f} ops/s '
+              f'p50 {results[name]["p50_ms"]:.4f}ms '
+              f'p95 {results[name]["p95_ms"]:.4f}ms')
+
+    return results
+
+
+def run_suite(resolutions: List[Tuple[int, int]],
+              fonts_dir: str,
+              fonts: List[Tuple[str, int]],
+              iterations: int,
+              warmup: int) -> dict:
+    import PIL
+
+    suite = {
+        'version': BENCHMARK_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'machine': platform.machine(),
+        'iterations': iterations,
+        'results': {}
+    }
+
+    for w, h in resolutions:
+        suite['results'][f'{w}x{h}'] = run_resolution(w,
+                                                      h,
+                                                      fonts_dir,
+                                                      fonts,
+                                                      iterations,
+                                                      warmup)
+    return suite
+
+
+def compare(suite: dict, baseline: dict, threshold: float) -> List[Tuple]:
+    """
+    Find every case that got slower than the baseline by more than
+    threshold percent of operations per second. Cases missing from
+    either side are ignored.
+    """
+    regressions = []
+
+    for resolution, cases in suite['results'].items():
+        base_cases = baseline.get('results', {}).get(resolution, {})
+
+        for name, stats in cases.items():
+            base_stats = base_cases.get(name)
+
+            if base_stats is None or base_stats['ops_per_sec'] <= 0:
+                continue
+
+            change = ((stats['ops_per_sec'] - base_stats['ops_per_sec']) /
+                      base_stats['ops_per_sec']) * 100
+
+            if change < -threshold:
+                regressions.append((resolution,
+                                    name,
+                                    base_stats['ops_per_sec'],
+                                    stats['ops_per_sec'],
+                                    change))
+    return regressions
+
+
+def parse_resolution(text: str) -> Tuple[int, int]:
+    w, _, h = text.lower().partition('x')
+    return int(w), int(h)
+
+
+def parse_font(text: str) -> Tuple[str, int]:
+    name, _, size = text.partition('@')
+    return name, int(size)
+
+
+def get_cla():
+    ap = argparse.ArgumentParser(description='Micro-benchmarks for the screen '
+                                             'drawing and render paths')
+    ap.add_argument('-c', '--config',
+                    type=str,
+                    metavar='PATH',
+                    dest='config',
+                    default='screen.toml',
+                    help='Configuration TOML file to read the fonts '
+                         'directory from.')
+    ap.add_argument('-F', '--fonts-dir',
+                    type=str,
+                    metavar='DIRECTORY',
+                    dest='fonts_dir',
+                    default=None,
+                    help='Fonts directory. Overrides the configuration file.')
+    ap.add_argument('-r', '--resolution',
+                    type=parse_resolution,
+                    metavar='WxH',
+                    dest='resolutions',
+                    action='append',
+                    default=None,
+                    help='Screen resolution to benchmark. May be given more '
+                         'than once. Default is 54x36, 108x72 and 216x144.')
+    ap.add_argument('--font',
+                    type=parse_font,
+                    metavar='NAME@SIZE',
+                    dest='fonts',
+                    action='append',
+                    default=None,
+                    help='Font and size for the draw_text and set_font cases. '
+                         'May be given more than once.')
+    ap.add_argument('-n', '--iterations',
+                    type=int,
+                    metavar='COUNT',
+                    dest='iterations',
+                    default=DEFAULT_ITERATIONS,
+                    help='Timed calls per case.')
+    ap.add_argument('-w', '--warmup',
+                    type=int,
+                    metavar='COUNT',
+                    dest='warmup',
+                    default=20,
+                    help='Untimed calls per case before measuring.')
+    ap.add_argument('-o', '--output',
+                    type=str,
+                    metavar='PATH',
+                    dest='output',
+                    default=None,
+                    help='Write results JSON to this file.')
+    ap.add_argument('--compare',
+                    type=str,
+                    metavar='PATH',
+                    dest='baseline',
+                    default=None,
+                    help='Baseline results JSON to check for regressions.')
+    ap.add_argument('--threshold',
+                    type=float,
+                    metavar='PERCENT',
+                    dest='threshold',
+                    default=DEFAULT_THRESHOLD,
+                    help='Allowed drop in ops/sec before a case counts as a '
+                         'regression.')
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    cla = get_cla()
+
+    fonts_dir = cla.fonts_dir
+    if fonts_dir is None:
+        config = utils.load_config(cla.config)
+        fonts_dir = config['fonts_dir']
+
+    if not os.path.isdir(fonts_dir):
+        print(f'fonts directory "{fonts_dir}" does not exist')
+        exit(1)
+
+    suite = run_suite(cla.resolutions or DEFAULT_RESOLUTIONS,
+                      fonts_dir,
+                      cla.fonts or DEFAULT_FONTS,
+                      cla.iterations,
+                      cla.warmup)
+
+    if cla.output is not None:
+        with open(cla.output, 'w') as rf:
+            json.dump(suite, rf, indent=2)
+        print(f'wrote results to "{cla.output}"')
+
+    if cla.baseline is not None:
+        with open(cla.baseline, 'r') as bf:
+            baseline_suite = json.load(bf)
+
+        found = compare(suite, baseline_suite, cla.threshold)
+
+        for res, case, before, after, pct in found:
+            print(f'REGRESSION {res} {case}: {before:.1f} -> {after:.1f} '
+                  f'ops/s ({pct:+.1f}%)')
+
+        if found:
+            print(f'{len(found)} regressions beyond {cla.threshold}%')
+            sys.exit(4)
+
+        print(f'no regressions beyond {cla.threshold}%')
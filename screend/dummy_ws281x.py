@@ -1,10 +1,62 @@
+import time
 import logging
+from array import array
 
 
 LOG = logging.getLogger('ledscreen.dummy_ws281x')
+BITS_PER_PIXEL = 24
+# WS2813 needs the line held low at least 280us to latch a frame
+RESET_TIME_S = 0.00028
+
+
+class RGBW(int):
+
+    def __new__(cls, r, g=None, b=None, w=None):
+        if g is None:
+            return int.__new__(cls, r)
+
+        if w is None:
+            w = 0
+
+        return int.__new__(cls, (w << 24) | (r << 16) | (g << 8) | b)
+
+    @property
+    def r(self):
+        return (self >> 16) & 0xff
+
+    @property
+    def g(self):
+        return (self >> 8) & 0xff
+
+    @property
+    def b(self):
+        return self & 0xff
+
+    @property
+    def w(self):
+        return (self >> 24) & 0xff
 
 
 class DummyStrip:
+    """
+    Stand-in for rpi_ws281x.PixelStrip that keeps pixel state in memory.
+
+    With wire_time enabled, show() blocks like the DMA driver does: it waits
+    out whatever is left of the previous frame on the wire, then starts the
+    next one, so a laptop paces frames the same way the Pi does.
+    """
+
+    @property
+    def show_count(self):
+        return self._show_count
+
+    @property
+    def bytes_sent(self):
+        return self._bytes_sent
+
+    @property
+    def frame_time(self):
+        return self._frame_time
 
     def __init__(self,
                  num,
@@ -15,37 +67,58 @@ class DummyStrip:
                  brightness=255,
                  channel=0,
                  strip_type=None,
-                 gamma=None):
-        LOG.debug(f'DummyStrip({num}, {pin}, {freq_hz}, {dma}, {invert}, {brightness}, {channel}, {strip_type}, {gamma}) created')
+                 gamma=None,
+                 wire_time=False):
+        self._num = num
+        self._pixels = array('I', bytes(4 * num))
+        self._brightness = brightness
+        self._wire_time = wire_time
+        self._frame_time = (num * BITS_PER_PIXEL) / freq_hz + RESET_TIME_S
+        self._busy_until = 0.0
+        self._show_count = 0
+        self._bytes_sent = 0
+        LOG.debug(f'DummyStrip({num}, {pin}, {freq_hz}, {dma}, {invert}, '
+                  f'{brightness}, {channel}, {strip_type}, {gamma}, '
+                  f'{wire_time}) created')
 
     def begin(self):
         LOG.debug('begin() called')
-        pass
 
     def show(self):
-        LOG.debug('show() called')
-        pass
+        if self._wire_time:
+            remaining = self._busy_until - time.perf_counter()
+
+            if remaining > 0:
+                time.sleep(remaining)
+
+            self._busy_until = time.perf_counter() + self._frame_time
+
+        self._show_count += 1
+        self._bytes_sent += self._num * (BITS_PER_PIXEL // 8)
 
     def setPixelColor(self, n, color):
-        LOG.debug(f'setPixelColor({n}, {color}) called')
-        pass
+        self._pixels[n] = color
 
     def setPixelColorRGB(self, n, red, green, blue, white=0):
-        LOG.debug(f'setPixelColorRGB({n}, {red}, {green}, {blue}, {white}) called')
-        pass
+        self._pixels[n] = RGBW(red, green, blue, white)
 
     def setBrightness(self, brightness):
-        LOG.debug(f'setBrightness({brightness}) called')
-        pass
+        self._brightness = brightness
+
+    def getBrightness(self):
+        return self._brightness
+
+    def numPixels(self):
+        return self._num
+
+    def getPixels(self):
+        return self._pixels
 
     def getPixelColor(self, n):
-        LOG.debug(f'getPixelColor({n}) called')
-        pass
+        return self._pixels[n]
 
     def getPixelColorRGB(self, n):
-        LOG.debug(f'getPixelColorRGB({n}) called')
-        pass
+        return RGBW(self._pixels[n])
 
     def getPixelColorRGBW(self, n):
-        LOG.debug(f'getPixelColorRGBW({n}) called')
-        pass
+        return RGBW(self._pixels[n])
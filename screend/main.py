@@ -1,9 +1,11 @@
+import os
 import zmq
 import utils
 import logging
 import argparse
 from api import Screen
-from tinyrpc.server import RPCServer
+from preview import PreviewPublisher, MAX_FPS
+from server import ScreenRPCServer
 from tinyrpc.dispatch import RPCDispatcher
 from tinyrpc.transports.zmq import ZmqServerTransport
 from tinyrpc.protocols.msgpackrpc import MSGPACKRPCProtocol
@@ -76,6 +78,37 @@ if __name__ == '__main__':
                     dest='config',
                     default='screen.toml',
                     help='Location of configuration TOML file.')
+    ap.add_argument('-d', '--dummy',
+                    action='store_true',
+                    dest='dummy',
+                    help='Emulate the LED strip instead of driving hardware.')
+    ap.add_argument('--wire-time',
+                    action='store_true',
+                    dest='wire_time',
+                    help='Make the emulated strip take as long to show a '
+                         'frame as real WS2812 pixels would.')
+    ap.add_argument('--preview',
+                    type=str,
+                    metavar='URL',
+                    dest='preview_url',
+                    default=None,
+                    help='Publish rendered frames for live previews on an '
+                         'XPUB socket bound to this URL.')
+    ap.add_argument('--preview-fps',
+                    type=int,
+                    metavar='FPS',
+                    dest='preview_fps',
+                    default=MAX_FPS,
+                    help='Publish at most this many preview frames per '
+                         'second.')
+    ap.add_argument('--cpu',
+                    type=int,
+                    metavar='CPU',
+                    dest='cpu',
+                    default=None,
+                    help='Run only on this CPU core. Start pluggramd with '
+                         '--reserve-cpu and the same core to keep pluggrams '
+                         'off it.')
     ap.add_argument(type=str,
                     metavar='URL',
                     dest='rpc_url',
@@ -83,9 +116,25 @@ if __name__ == '__main__':
     cla = ap.parse_args()
     config_path = cla.config
     rpc_url = cla.rpc_url
+    strip_class = None
+
+    if cla.dummy:
+        from functools import partial
+        from dummy_ws281x import DummyStrip
+        strip_class = partial(DummyStrip, wire_time=cla.wire_time)
+        LOG.info('using emulated LED strip')
+
+    if cla.cpu is not None:
+        os.sched_setaffinity(0, {cla.cpu})
+        LOG.info(f'running on CPU {cla.cpu}')
 
     config = utils.load_config(config_path)
     utils.validate_config(config_path, config)
+    context = zmq.Context()
+    preview = None
+
+    if cla.preview_url is not None:
+        preview = PreviewPublisher(context, cla.preview_url, cla.preview_fps)
 
     screen = Screen(
         config['width'],
@@ -98,19 +147,22 @@ if __name__ == '__main__':
         config['gpio_channel'],
         fonts_dir=config['fonts_dir'],
         antialiasing=config['antialiasing'],
-        frames_dir=config.get('frames_dir')
+        frames_dir=config.get('frames_dir'),
+        strip_class=strip_class,
+        preview=preview
     )
 
     startup_banner(screen, config)
 
     dispatcher = RPCDispatcher()
     dispatcher.register_instance(screen)
-    transport = ZmqServerTransport.create(zmq.Context(), rpc_url)
+    transport = ZmqServerTransport.create(context, rpc_url)
 
-    rpc_server = RPCServer(
+    rpc_server = ScreenRPCServer(
         transport,
         MSGPACKRPCProtocol(),
-        dispatcher
+        dispatcher,
+        screen
     )
 
     LOG.info('serving...')
@@ -0,0 +1,98 @@
+import zmq
+import time
+import struct
+import logging
+import utils
+from typing import Optional
+from threading import Event, Thread
+
+
+LOG = logging.getLogger('screend.preview')
+utils.configure_logger(LOG)
+MAX_FPS = 30
+TOPIC = b'frame'
+# width, height, epoch, frame number
+HEADER = struct.Struct('!HHQQ')
+
+
+class PreviewPublisher:
+    """
+    Publishes rendered frames on an XPUB socket for live previews.
+
+    render() only hands over the canvas bytes, a few kilobytes. A thread
+    owns the socket, watches subscriptions and sends the newest frame at up
+    to max_fps, so frames are only sent while someone subscribes and new
+    subscribers get the current frame right away. Messages are the topic,
+    a HEADER and the raw RGB canvas.
+    """
+
+    def __init__(self,
+                 context: zmq.Context,
+                 url: str,
+                 max_fps=MAX_FPS):
+        self._socket = context.socket(zmq.XPUB)
+        # hear every subscription, not only the first, to greet each one
+        self._socket.setsockopt(zmq.XPUB_VERBOSE, 1)
+        self._socket.bind(url)
+        self._interval_s = 1 / max_fps
+        self._latest: Optional[tuple] = None
+        self._fresh = Event()
+        self._subscribed = set()
+        Thread(target=self._run, name='preview', daemon=True).start()
+        LOG.info(f'publishing previews on {url} at up to {max_fps} fps')
+
+    def offer(self,
+              width: int,
+              height: int,
+              epoch: int,
+              number: int,
+              data: bytes):
+        self._latest = (width, height, epoch, number, data)
+        self._fresh.set()
+
+    def _subscriptions(self) -> bool:
+        """
+        Track (un)subscriptions, returns whether a new subscriber joined.
+        """
+        joined = False
+
+        while True:
+            try:
+                message = self._socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return joined
+
+            topic = message[1:]
+
+            if message[:1] == b'\x01':
+                joined = True
+                self._subscribed.add(topic)
+                LOG.info('preview subscriber joined')
+            else:
+                self._subscribed.discard(topic)
+                LOG.info('preview subscriber left')
+
+    def _send(self):
+        width, height, epoch, number, data = self._latest
+        self._socket.send_multipart([TOPIC,
+                                     HEADER.pack(width, height, epoch, number),
+                                     data],
+                                    copy=False)
+
+    def _run(self):
+        last_sent = 0.0
+
+        while True:
+            # sleep until someone subscribes, then tick at the frame rate
+            timeout_ms = int(self._interval_s * 1000) \
+                if self._subscribed else None
+
+            if self._socket.poll(timeout_ms) and self._subscriptions():
+                self._fresh.set()
+
+            if self._subscribed and self._latest is not None and \
+                    self._fresh.is_set() and \
+                    time.monotonic() - last_sent >= self._interval_s:
+                self._fresh.clear()
+                self._send()
+                last_sent = time.monotonic()
@@ -0,0 +1,94 @@
+import utils
+import logging
+import tinyrpc.exc
+from collections import OrderedDict
+from tinyrpc.server import RPCServer
+
+
+LOG = logging.getLogger('screend.server')
+utils.configure_logger(LOG)
+MAX_DEFERRED_ERRORS = 16
+MAX_TRACKED_CLIENTS = 64
+# answered by the server itself with the caller's failed one-way calls
+TAKE_ERRORS_METHOD = 'take_deferred_errors'
+
+
+class ScreenRPCServer(RPCServer):
+    """
+    RPCServer that remembers failures of one-way calls (notifications).
+
+    A notification has no reply to carry its error, so failures are logged
+    and kept per client until the client calls take_deferred_errors(), which
+    returns and forgets them. Two-way calls run regardless, so a bad drawing
+    call costs the frame no more than that call.
+
+    The screen, if given, learns which client makes each call so clients
+    can draw offscreen, and gets to show crossfade steps between calls.
+    """
+
+    def __init__(self, transport, protocol, dispatcher, screen=None):
+        super().__init__(transport, protocol, dispatcher)
+        self._deferred = OrderedDict()
+        self._screen = screen
+
+    def _defer(self, client, message: str):
+        errors = self._deferred.pop(client, [])
+
+        if len(errors) < MAX_DEFERRED_ERRORS:
+            errors.append(message)
+            LOG.warning(f'one-way call {message}')
+
+            if len(errors) == MAX_DEFERRED_ERRORS:
+                LOG.warning('dropping further one-way call errors of a '
+                            'client until it takes them')
+
+        self._deferred[client] = errors
+
+        while len(self._deferred) > MAX_TRACKED_CLIENTS:
+            self._deferred.popitem(last=False)
+
+    def _notify(self, client, request):
+        try:
+            method = self.dispatcher.get_method(request.method)
+            method(*request.args)
+        except Exception as e:
+            self._defer(client, f'{request.method}(): {str(e)}')
+
+    def _reply(self, context, response):
+        if response is not None:
+            self.transport.send_reply(context, response.serialize())
+
+    def serve_forever(self):
+        while True:
+            wait_s = None if self._screen is None \
+                else self._screen.advance_fade()
+
+            # a crossfade step may come due before the next request
+            if wait_s is None or \
+                    self.transport.socket.poll(int(wait_s * 1000) + 1):
+                self.receive_one_message()
+
+    def receive_one_message(self):
+        context, message = self.transport.receive_message()
+
+        try:
+            request = self.protocol.parse_request(message)
+        except tinyrpc.exc.RPCError as e:
+            self._reply(context, e.error_respond())
+            return
+
+        # first frame of a ROUTER message is the peer identity
+        client = context[0]
+
+        if self._screen is not None:
+            self._screen.set_caller(client)
+
+        if request.one_way:
+            self._notify(client, request)
+            return
+
+        if request.method == TAKE_ERRORS_METHOD:
+            self._reply(context,
+                        request.respond(self._deferred.pop(client, [])))
+        else:
+            self._reply(context, self.dispatcher.dispatch(request))
@@ -1,4 +1,5 @@
 import os
+import sys
 import time
 import pytoml
 import logging
@@ -10,6 +11,14 @@ DEV_FORMATTER = logging.Formatter('{levelname:>8}: {message} [{name}@{lineno}]',
                                   datefmt='%x %H:%M:%S',
                                   style='{')
 FORMATTER = logging.Formatter('{levelname:>8}: {message}', style='{')
+# modules the daemons have in common, importable once utils is imported
+SHARED_DIR = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                           os.pardir,
+                                           os.pardir,
+                                           'shared'))
+
+if SHARED_DIR not in sys.path:
+    sys.path.append(SHARED_DIR)
 
 
 def configure_logger(log):
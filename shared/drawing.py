@@ -0,0 +1,174 @@
+import os
+import logging
+import pathlib
+from PIL import Image, ImageDraw, ImageFont
+from typing import List, Tuple, Optional
+
+
+LOG = logging.getLogger('ledscreen.drawing')
+
+
+class Canvas:
+    """
+    The screen's drawing primitives on a Pillow image. screend draws with
+    it for RPC clients and pluggramd draws with it locally, so frames
+    shipped whole are pixel-identical to the same calls made over RPC.
+
+    Loaded fonts are kept in fonts, which canvases may share.
+    """
+
+    @property
+    def width(self):
+        return self._w
+
+    @property
+    def height(self):
+        return self._h
+
+    @property
+    def current_font(self) -> Tuple[str, str]:
+        return self.font.getname()
+
+    def __init__(self,
+                 w: int,
+                 h: int,
+                 fonts_dir: str,
+                 fonts: Optional[dict] = None):
+        self._w = w
+        self._h = h
+        self._fonts_dir = os.path.abspath(fonts_dir)
+        self._fonts = fonts if fonts is not None \
+            else {'default': ImageFont.load_default()}
+        self.font = self._fonts['default']
+        self.image = Image.new('RGB', (w, h), 0)
+        self.painter = ImageDraw.Draw(self.image)
+
+    def tobytes(self) -> bytes:
+        return self.image.tobytes()
+
+    def paste(self, img: Image.Image, box=None):
+        self.image.paste(img, box=box)
+
+    def set_pixel(self, x: int, y: int, color: int):
+        self.painter.point((x, y), fill=color)
+
+    def _font_path(self, name: str) -> Optional[str]:
+        for file in os.listdir(self._fonts_dir):
+            if file.lower().strip() == name.lower().strip():
+                return os.path.join(self._fonts_dir, file)
+        return None
+
+    def set_font(self,
+                 name: str,
+                 size: Optional[int],
+                 font_face: Optional[int]) -> bool:
+        unique_name = name.lower().strip()
+
+        if size is not None:
+            assert isinstance(size, int)
+            unique_name += f'@{size}'
+
+        if font_face is not None:
+            assert isinstance(font_face, int)
+            unique_name += f'#{font_face}'
+
+        if size is None:
+            raise ValueError('Font size is required for all non-default fonts')
+
+        if unique_name in self._fonts.keys():
+            self.font = self._fonts[unique_name]
+            return True
+        else:
+            try:
+                font_path = self._font_path(name)
+
+                if font_path is None:
+                    raise FileNotFoundError()
+
+                ext = pathlib.Path(font_path).suffix
+
+                if ext == '.ttf':
+                    self.font = ImageFont.truetype(font_path, size,
+                                                   font_face or 0)
+                    LOG.info(f'loaded TrueType font "{name}"')
+                else:
+                    self.font = ImageFont.load(font_path)
+                    LOG.info(f'loaded font "{name}"')
+
+                self._fonts.update({unique_name: self.font})
+                return True
+            except OSError:
+                LOG.warning(f'failed to load font "{name}" from '
+                            f'"{self._fonts_dir}"')
+
+        return False
+
+    def font_names(self) -> list:
+        return [n.lower() for n in os.listdir(self._fonts_dir)]
+
+    def text_dimensions(self,
+                        message: str,
+                        spacing: Optional[int],
+                        features: Optional[List[str]],
+                        stroke_width: Optional[int]) -> Tuple:
+        a, b = self.painter.multiline_textsize(message,
+                                               self.font,
+                                               spacing=spacing or 4,
+                                               features=features,
+                                               stroke_width=stroke_width or 0)
+        return a, b
+
+    def draw_text(self,
+                  x: int,
+                  y: int,
+                  color: int,
+                  message: str,
+                  anchor: Optional[str],
+                  spacing: Optional[int],
+                  alignment: Optional[str],
+                  stroke_width: Optional[int],
+                  stroke_fill: Optional[int]):
+        self.painter.text((x, y),
+                          message,
+                          fill=color,
+                          font=self.font,
+                          anchor=anchor,
+                          spacing=spacing or 0,
+                          align=alignment,
+                          stroke_width=stroke_width or 0,
+                          stroke_fill=stroke_fill)
+
+    def fill(self, color: int, box: Optional[Tuple[int, int, int, int]]):
+        if box is not None:
+            if not isinstance(box, tuple):
+                raise ValueError('box must be a tuple of structure (x1, y1, '
+                                 'x2, y2)')
+
+            if len(box) != 4:
+                raise ValueError('box must be a tuple of structure (x1, y1, '
+                                 'x2, y2)')
+
+        self.painter.rectangle(box or (0, 0, self._w, self._h), fill=color)
+
+    def draw_ellipse(self,
+                     x: int,
+                     y: int,
+                     width: Optional[int],
+                     color: Optional[int],
+                     outline: Optional[int]):
+        self.painter.ellipse((x, y), fill=color, outline=outline, width=width)
+
+    def draw_line(self,
+                  x: int,
+                  y: int,
+                  color: Optional[int],
+                  width: Optional[int],
+                  rounded: bool):
+        self.painter.line((x, y), fill=color, width=width,
+                          joint='curve' if rounded else None)
+
+    def clear(self):
+        self.fill(0, None)
+
+    def write_file(self, filename: str):
+        self.image.save(filename)
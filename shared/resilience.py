@@ -0,0 +1,334 @@
+import os
+import zmq
+import time
+import random
+import logging
+import tinyrpc.exc
+from typing import Optional
+from tinyrpc import RPCClient
+from threading import Lock
+from tinyrpc.transports.zmq import ZmqClientTransport
+from tinyrpc.protocols.msgpackrpc import MSGPACKRPCError
+
+
+RPC_TIMEOUT_S = 2.0
+RPC_RETRIES = 2
+RPC_BACKOFF_S = 0.05
+RPC_BACKOFF_MAX_S = 1.0
+BREAKER_FAILURES = 3
+BREAKER_RESET_S = 5.0
+RPC_UNAVAILABLE_CODE = -32001
+COUNTER_NAMES = ('calls', 'timeouts', 'retries', 'rejected', 'errors')
+
+LOG = logging.getLogger('ledscreen.resilience')
+
+
+class RPCUnavailableError(MSGPACKRPCError):
+    """
+    A call that got no reply from the server.
+    """
+
+    def __init__(self, message: str):
+        # tinyrpc reads message before it assigns it from the tuple
+        self.message = message
+        super().__init__((RPC_UNAVAILABLE_CODE, message))
+
+
+class CallTimeoutError(RPCUnavailableError):
+    pass
+
+
+class CircuitOpenError(RPCUnavailableError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast after failure_threshold calls in a row timed out.
+    Once reset_s has passed a single trial call is let through; a reply
+    closes the circuit again, another timeout re-opens it.
+    """
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if self._trial or \
+                    time.monotonic() - self._opened_at >= self._reset_s:
+                return 'half-open'
+            return 'open'
+
+    def __init__(self,
+                 name: str,
+                 failure_threshold=BREAKER_FAILURES,
+                 reset_s=BREAKER_RESET_S):
+        self._name = name
+        self._failure_threshold = failure_threshold
+        self._reset_s = reset_s
+        self._lock = Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            if self._trial or \
+                    time.monotonic() - self._opened_at < self._reset_s:
+                return False
+
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                LOG.info(f'{self._name} answered again, closing circuit')
+
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+
+            if self._trial or self._failures >= self._failure_threshold:
+                if self._opened_at is None:
+                    LOG.warning(f'{self._name} stopped answering, failing '
+                                f'calls for {self._reset_s}s')
+
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+
+class RPCMetrics:
+    """
+    Call counters of this process by endpoint. attach() also keeps an
+    endpoint's counters in a shared array, so a parent process can read
+    them, and snapshot() reports the shared ones.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Forget every count and attached array, as a forked child must.
+        """
+        self._lock = Lock()
+        self._counters = {}
+        self._shared = {}
+
+    def attach(self, endpoint: str, shared):
+        self._shared[endpoint] = shared
+
+    def increment(self, endpoint: str, name: str, n=1):
+        index = COUNTER_NAMES.index(name)
+        shared = self._shared.get(endpoint)
+
+        if shared is not None:
+            with shared.get_lock():
+                shared[index] += n
+
+        # kept for attached endpoints too, as this process's own share
+        with self._lock:
+            counters = self._counters.setdefault(endpoint,
+                                                 [0] * len(COUNTER_NAMES))
+            counters[index] += n
+
+    def calls(self) -> int:
+        """
+        Calls this process made to any endpoint.
+        """
+        index = COUNTER_NAMES.index('calls')
+
+        with self._lock:
+            return sum(c[index] for c in self._counters.values())
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            values = {e: list(c) for e, c in self._counters.items()}
+
+        for endpoint, shared in self._shared.items():
+            values[endpoint] = shared[:]
+
+        return {e: counters_dict(v) for e, v in values.items()}
+
+
+def counters_dict(values) -> dict:
+    return dict(zip(COUNTER_NAMES, values))
+
+
+METRICS = RPCMetrics()
+_breakers = {}
+_breakers_lock = Lock()
+
+
+def _after_fork():
+    global _breakers_lock
+    _breakers.clear()
+    _breakers_lock = Lock()
+    # in place, modules that imported METRICS keep the same object
+    METRICS.reset()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def get_breaker(endpoint: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if endpoint not in _breakers:
+            _breakers[endpoint] = CircuitBreaker(endpoint)
+        return _breakers[endpoint]
+
+
+def get_rpc_metrics() -> dict:
+    """
+    Call counters and circuit state of every endpoint this process called.
+    """
+    metrics = METRICS.snapshot()
+
+    for endpoint, counters in metrics.items():
+        counters['circuit'] = get_breaker(endpoint).state
+
+    return metrics
+
+
+class DeadlineTransport(ZmqClientTransport):
+    """
+    REQ transport that gives up on a reply after timeout seconds. A REQ
+    socket that missed a reply refuses to send again, so on timeout the
+    socket is replaced with a fresh connection before raising.
+    """
+
+    def __init__(self,
+                 context: zmq.Context,
+                 endpoint: str,
+                 timeout: Optional[float] = None):
+        self._context = context
+        self._endpoint = endpoint
+        super().__init__(self._open(), timeout)
+
+    def _open(self) -> zmq.Socket:
+        socket = self._context.socket(zmq.REQ)
+        socket.connect(self._endpoint)
+        return socket
+
+    def reset(self):
+        self.socket.close(linger=0)
+        self.socket = self._open()
+
+    def send_message(self, message: bytes, expect_reply: bool = True):
+        try:
+            return super().send_message(message, expect_reply)
+        except tinyrpc.exc.TimeoutError:
+            self.reset()
+            raise
+
+
+class ResilientClient:
+    """
+    Wraps an RPC client with a deadline on every call, retries with
+    jittered exponential backoff for calls named in idempotent_methods and
+    the endpoint's circuit breaker. Calls that get no reply raise
+    CallTimeoutError, calls refused by an open circuit CircuitOpenError.
+    Both are MSGPACKRPCErrors, like errors reported by the server.
+
+    client is a tinyrpc RPCClient, or any client with a timeout attribute
+    and call(method, args). Those may also answer is_one_way(method) for
+    calls that return before the server sees them.
+    """
+
+    def __init__(self,
+                 client,
+                 endpoint: str,
+                 idempotent_methods=frozenset(),
+                 timeout: Optional[float] = RPC_TIMEOUT_S,
+                 retries=RPC_RETRIES,
+                 backoff_s=RPC_BACKOFF_S,
+                 backoff_max_s=RPC_BACKOFF_MAX_S):
+        self.client = client
+        self.endpoint = endpoint
+        self._idempotent_methods = idempotent_methods
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff_s = backoff_s
+        self._backoff_max_s = backoff_max_s
+        self._jitter = random.Random()
+
+    def _send(self, method: str, args):
+        if isinstance(self.client, RPCClient):
+            self.client.transport.timeout = self._timeout
+            return self.client.call(method, list(args), {})
+
+        self.client.timeout = self._timeout
+        return self.client.call(method, args)
+
+    def _is_one_way(self, method: str) -> bool:
+        is_one_way = getattr(self.client, 'is_one_way', None)
+        return is_one_way is not None and is_one_way(method)
+
+    def call(self, method: str, args):
+        breaker = get_breaker(self.endpoint)
+        attempts = 1
+
+        if method in self._idempotent_methods:
+            attempts += self._retries
+
+        for attempt in range(attempts):
+            if not breaker.allow():
+                METRICS.increment(self.endpoint, 'rejected')
+                raise CircuitOpenError(f'{self.endpoint} is not answering, '
+                                       f'{method}() was not sent')
+
+            METRICS.increment(self.endpoint, 'calls')
+
+            try:
+                rv = self._send(method, args)
+            except tinyrpc.exc.TimeoutError:
+                breaker.record_failure()
+                METRICS.increment(self.endpoint, 'timeouts')
+
+                if attempt + 1 == attempts:
+                    raise CallTimeoutError(f'{method}() on {self.endpoint} '
+                                           f'got no reply in '
+                                           f'{self._timeout}s')
+
+                METRICS.increment(self.endpoint, 'retries')
+                delay = min(self._backoff_max_s,
+                            self._backoff_s * 2 ** attempt)
+                time.sleep(self._jitter.uniform(delay / 2, delay))
+                continue
+            except tinyrpc.exc.RPCError:
+                # the server answered, just not with a result
+                breaker.record_success()
+                METRICS.increment(self.endpoint, 'errors')
+                raise
+            except Exception:
+                breaker.record_failure()
+                METRICS.increment(self.endpoint, 'errors')
+                raise
+
+            # a notification that was queued says nothing about the server
+            if not self._is_one_way(method):
+                breaker.record_success()
+            return rv
+
+    def get_proxy(self):
+        return CallProxy(self)
+
+
+class CallProxy:
+    """
+    Turns attribute calls into client.call(name, args).
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name: str):
+        return lambda *args: self.client.call(name, args)
@@ -1,5 +1,8 @@
+import os
 import rpc
-import zmq
+import events
+import stream
+import preview
 import flask
 import common
 import signal
@@ -8,10 +11,7 @@ from utils import (load_config,
                    get_config_path,
                    validate_config,
                    configure_logger)
-from tinyrpc import RPCClient
 from flask_minify import minify
-from tinyrpc.transports.zmq import ZmqClientTransport
-from tinyrpc.protocols.msgpackrpc import MSGPACKRPCProtocol
 
 
 VERSION = '1.0.0'
@@ -19,39 +19,93 @@ LOG = logging.getLogger('ledscreen')
 configure_logger(LOG)
 
 
-zmq_context = zmq.Context()
-
-
 def create_app():
-    global zmq_context
-
     config_path = get_config_path()
     conf = load_config(config_path)
     validate_config(config_path, conf)
     LOG.info(f'loaded application config')
 
-    pluggram_client = RPCClient(
-        MSGPACKRPCProtocol(),
-        ZmqClientTransport.create(zmq_context, conf['app.pluggramd_url'])
+    # connections are made per worker process on first use, so this is
+    # safe to run in a uWSGI master before it forks
+    pluggram_proxy = rpc.rpc_get_pluggram_proxy(
+        conf['app.pluggramd_url'],
+        conf.get('app.rpc_timeout', rpc.RPC_TIMEOUT_S),
+        conf.get('app.rpc_connections', rpc.POOL_MAX_CLIENTS)
     )
-    pluggram_proxy = pluggram_client.get_proxy()
-    plugman = rpc.PluggramManager(pluggram_proxy)
+    subscriber = None
 
-    LOG.info(f'started pluggram RPC client')
+    if 'app.pluggramd_events_url' in conf:
+        # the subscriber thread starts in each worker on first use
+        subscriber = events.EventSubscriber(conf['app.pluggramd_events_url'])
+
+    plugman = rpc.PluggramManager(pluggram_proxy, subscriber)
 
-    LOG.debug('RPC sanity check 1 of 2...')
-    plugman.get_names()
-    LOG.debug('RPC sanity check 2 of 2...')
-    plugman.get_running()
+    LOG.info(f'started pluggram RPC client')
 
     app = flask.Flask(__name__)
     app.url_map.strict_slashes = False
-    app.secret_key = conf['app.secret']
-    LOG.debug('initialized flask')
+    # processes that ran the sanity check, never a uWSGI master, which
+    # must not connect before it forks
+    checked_pids = set()
+
+    @app.before_request
+    def check_pluggramd():
+        if os.getpid() in checked_pids:
+            return
+
+        checked_pids.add(os.getpid())
+
+        try:
+            LOG.debug('RPC sanity check 1 of 2...')
+            plugman.get_names()
+            LOG.debug('RPC sanity check 2 of 2...')
+            plugman.get_running()
+        except rpc.RPCUnavailableError as e:
+            # pluggramd may still be starting, calls fail fast until it
+            # answers
+            LOG.warning(f'pluggramd did not answer sanity check: {str(e)}')
 
     common.config = conf
     common.pluggram_manager = plugman
 
+    if 'app.stream_port' in conf:
+        # reads the config, so only importable now
+        import system
+
+        stream_server = stream.StreamServer(
+            conf.get('app.stream_host', stream.STREAM_HOST),
+            conf['app.stream_port'],
+            authorize=system.is_stream_authorized
+        )
+
+        if subscriber is not None:
+            stream_server.add_channel('/api/events',
+                                      events.EventChannel(stream_server,
+                                                          '/api/events',
+                                                          subscriber))
+
+        if 'app.screen_preview_url' in conf:
+            stream_server.add_channel('/api/screen/preview',
+                                      preview.PreviewChannel(
+                                          stream_server,
+                                          '/api/screen/preview',
+                                          conf['app.screen_preview_url'],
+                                          conf.get('app.preview_fps',
+                                                   preview.PREVIEW_FPS),
+                                          conf.get('app.preview_scale',
+                                                   preview.PREVIEW_SCALE)))
+
+        # both start in each worker with its first request, browsers open
+        # streams from a page they just got
+        @app.before_request
+        def start_streams():
+            if subscriber is not None:
+                subscriber.ensure_running()
+            stream_server.ensure_running()
+
+    app.secret_key = conf['app.secret']
+    LOG.debug('initialized flask')
+
     from routes import endpoints, management, authentication
 
     app.register_blueprint(authentication.bp)
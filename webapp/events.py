@@ -0,0 +1,266 @@
+import os
+import zmq
+import json
+import msgpack
+import logging
+from typing import Callable, List, Optional
+from stream import Channel
+from threading import Event, Lock, Thread
+
+
+LOG = logging.getLogger('ledscreen.events')
+HEARTBEAT_S = 2.0
+# heartbeats in a row that may go missing before the stream counts as lost
+HEARTBEAT_MISSES = 3
+# how long browsers wait before reconnecting a dropped event stream
+SSE_RETRY_MS = 3000
+# what peek() returns for keys that hold no value
+MISSING = object()
+
+
+class _Flight:
+
+    def __init__(self, generation: int):
+        self.generation = generation
+        self._done = Event()
+        self._value = None
+        self._error: Optional[Exception] = None
+
+    def finish(self, value=None, error: Optional[Exception] = None):
+        self._value = value
+        self._error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+
+        if self._error is not None:
+            raise self._error
+
+        return self._value
+
+
+class ReadCache:
+    """
+    Values read from pluggramd, kept until an event invalidates them.
+
+    A read of a key that is already being loaded waits for that load
+    instead of making its own call. While disabled nothing is kept, but
+    concurrent reads are still coalesced. A load that overlaps any
+    invalidation is returned to its callers but not kept.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._values = {}
+        self._flights = {}
+        self._generation = 0
+        self._enabled = False
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    def get(self, key: str, loader: Callable):
+        with self._lock:
+            value = self._values.get(key, MISSING)
+
+            if value is not MISSING:
+                return value
+
+            flight = self._flights.get(key)
+            leader = flight is None
+
+            if leader:
+                flight = _Flight(self._generation)
+                self._flights[key] = flight
+
+        if not leader:
+            return flight.wait()
+
+        try:
+            value = loader()
+        except Exception as e:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.finish(error=e)
+            raise
+
+        with self._lock:
+            self._flights.pop(key, None)
+
+            if self._enabled and flight.generation == self._generation:
+                self._values[key] = value
+
+        flight.finish(value)
+        return value
+
+    def peek(self, key: str):
+        with self._lock:
+            return self._values.get(key, MISSING)
+
+    def invalidate(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+            self._generation += 1
+
+    def enable(self):
+        with self._lock:
+            self._values.clear()
+            self._generation += 1
+            self._enabled = True
+
+    def disable(self):
+        with self._lock:
+            self._values.clear()
+            self._generation += 1
+            self._enabled = False
+
+
+class EventSubscriber:
+    """
+    Follows pluggramd's event stream on a background thread and hands every
+    event to the registered listeners as listener(topic, event).
+
+    Besides pluggramd's own topics, listeners get a "health" event with
+    healthy set to False when heartbeats stop, and to True when the stream
+    is back or had a gap, after which anything derived from earlier events
+    should be thrown away.
+
+    The thread is started on first use in each process because threads and
+    ZeroMQ sockets do not survive the fork into uWSGI workers.
+    """
+
+    @property
+    def healthy(self) -> bool:
+        return self._healthy
+
+    def __init__(self, url: str, heartbeat_s=HEARTBEAT_S):
+        self._url = url
+        self._heartbeat_s = heartbeat_s
+        self._listeners: List[Callable[[str, dict], None]] = []
+        self._pid = None
+        self._lock = Lock()
+        self._healthy = False
+
+    def add_listener(self, listener: Callable[[str, dict], None]):
+        self._listeners.append(listener)
+
+    def ensure_running(self):
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._healthy = False
+                Thread(target=self._run,
+                       name='pluggramd-events',
+                       daemon=True).start()
+
+    def _notify(self, topic: str, event: dict):
+        for listener in self._listeners:
+            try:
+                listener(topic, event)
+            except Exception as e:
+                LOG.warning(f'event listener failed on "{topic}": {str(e)}')
+
+    def _set_health(self, healthy: bool):
+        if healthy != self._healthy:
+            LOG.info(f'pluggramd event stream '
+                     f'{"is up" if healthy else "went quiet"}')
+
+        self._healthy = healthy
+        self._notify('health', {'healthy': healthy})
+
+    def _run(self):
+        context = zmq.Context()
+        socket = context.socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, b'')
+        socket.connect(self._url)
+        timeout_ms = int(self._heartbeat_s * HEARTBEAT_MISSES * 1000)
+        epoch = None
+        seq = None
+
+        while True:
+            if not socket.poll(timeout_ms):
+                if self._healthy:
+                    self._set_health(False)
+                continue
+
+            topic, data = socket.recv_multipart()
+
+            try:
+                event = msgpack.unpackb(data, raw=False)
+            except ValueError:
+                LOG.warning('dropping malformed pluggramd event')
+                continue
+
+            # a restart or a lost message means the listeners may be stale
+            if not self._healthy or event.get('epoch') != epoch or \
+                    event.get('seq') != seq + 1:
+                self._set_health(True)
+
+            epoch = event.get('epoch')
+            seq = event.get('seq')
+            self._notify(topic.decode(), event)
+
+
+def format_sse(event: str, data: dict) -> bytes:
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode()
+
+
+class EventChannel(Channel):
+    """
+    Server-sent events for browsers: "running" with the name of the
+    running pluggram, "options" with the name of a pluggram whose options
+    were saved and "health" telling whether pluggramd is reachable.
+
+    New clients get the current running pluggram and health right away,
+    from the last events seen, so nothing is asked of pluggramd per client.
+    """
+
+    content_type = 'text/event-stream'
+
+    def __init__(self, server, path: str, subscriber: EventSubscriber):
+        self._server = server
+        self._path = path
+        self._lock = Lock()
+        self._running = MISSING
+        self._healthy: Optional[bool] = None
+        subscriber.add_listener(self._on_event)
+
+    def _on_event(self, topic: str, event: dict):
+        with self._lock:
+            if topic == 'health':
+                if event['healthy'] == self._healthy:
+                    return
+                self._healthy = event['healthy']
+                message = format_sse('health', {'healthy': self._healthy})
+            elif topic in ('running', 'heartbeat'):
+                # heartbeats cover running events that were missed
+                if event['running'] == self._running:
+                    return
+                self._running = event['running']
+                message = format_sse('running', {'name': self._running})
+            elif topic == 'options':
+                message = format_sse('options', {'name': event['name']})
+            else:
+                return
+
+        self._server.broadcast(self._path, message)
+
+    def greeting(self) -> bytes:
+        greeting = f'retry: {SSE_RETRY_MS}\n\n'.encode()
+
+        with self._lock:
+            if self._healthy is not None:
+                greeting += format_sse('health', {'healthy': self._healthy})
+            if self._running is not MISSING:
+                greeting += format_sse('running', {'name': self._running})
+
+        return greeting
+
+    def keepalive(self) -> bytes:
+        return b':\n\n'
@@ -0,0 +1,366 @@
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from typing import List, Optional
+
+
+DEFAULT_PATHS = ['/api/pluggrams/running', '/api/pluggrams']
+DEFAULT_WORKERS = [1, 2, 4]
+APP_CONFIG = """[server]
+host = "127.0.0.1"
+port = {port}
+
+[app]
+secret = "loadtest"
+minification = false
+api_keys = []
+max_session_minutes = 10
+pluggramd_url = "{pluggramd_url}"
+rpc_connections = {connections}
+
+[user]
+password = "loadtest"
+"""
+
+
+def percentile(ordered: List[float], pct: float) -> float:
+    if not ordered:
+        return 0.0
+
+    index = int(round((pct / 100) * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def summarize(timings: List[float]) -> dict:
+    ordered = sorted(timings)
+    return {
+        'count': len(ordered),
+        'mean_ms': sum(ordered) / len(ordered) if ordered else 0.0,
+        'p50_ms': percentile(ordered, 50),
+        'p95_ms': percentile(ordered, 95),
+        'p99_ms': percentile(ordered, 99),
+        'max_ms': ordered[-1] if ordered else 0.0
+    }
+
+
+def serve_prefork(port: int, workers: int):
+    """
+    Stand-in for a uWSGI master when uWSGI is not installed: create the
+    application, and with it the RPC clients, then fork workers that
+    serve the same listening socket.
+    """
+    from app import application
+    from werkzeug.serving import make_server
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(128)
+    children = []
+
+    for _ in range(workers):
+        pid = os.fork()
+
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            server = make_server('127.0.0.1',
+                                 port,
+                                 application,
+                                 threaded=True,
+                                 fd=listener.fileno())
+            server.serve_forever()
+            os._exit(0)
+
+        children.append(pid)
+
+    def stop(_a, _b):
+        for child in children:
+            os.kill(child, signal.SIGTERM)
+        exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+
+    for child in children:
+        os.waitpid(child, 0)
+
+
+def start_pluggramd(pluggramd_dir: str, url: str) -> subprocess.Popen:
+    # nothing listens on the screen URL, the load only reads catalog state
+    return subprocess.Popen([sys.executable,
+                             '-O',
+                             'main.py',
+                             'programs',
+                             'tcp://127.0.0.1:1',
+                             url],
+                            cwd=pluggramd_dir,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+
+def start_webapp(port: int,
+                 pluggramd_url: str,
+                 workers: int,
+                 threads: int,
+                 server: str) -> subprocess.Popen:
+    fd, config_path = tempfile.mkstemp(suffix='.toml')
+    with os.fdopen(fd, 'w') as cf:
+        cf.write(APP_CONFIG.format(port=port,
+                                   pluggramd_url=pluggramd_url,
+                                   connections=threads))
+
+    env = dict(os.environ, APP_CONFIG=config_path)
+
+    if server == 'uwsgi':
+        args = ['uwsgi',
+                '--http-socket', f'127.0.0.1:{port}',
+                '--module', 'app:application',
+                '--master',
+                '--processes', str(workers),
+                '--threads', str(threads),
+                '--enable-threads',
+                '--die-on-term']
+    else:
+        args = [sys.executable, '-O', __file__,
+                '--serve-prefork', str(workers),
+                '--port', str(port)]
+
+    proc = subprocess.Popen(args,
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env=env,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    proc.config_path = config_path
+    return proc
+
+
+def stop_process(proc: subprocess.Popen):
+    proc.terminate()
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+    config_path = getattr(proc, 'config_path', None)
+    if config_path is not None:
+        os.remove(config_path)
+
+
+def wait_for_http(url: str, deadline_s: float) -> bool:
+    started = time.monotonic()
+
+    while time.monotonic() - started < deadline_s:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                response.read()
+            return True
+        except (OSError, urllib.error.URLError):
+            time.sleep(0.2)
+    return False
+
+
+def run_load(base_url: str,
+             paths: List[str],
+             concurrency: int,
+             duration_s: float) -> dict:
+    timings = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration_s
+
+    def client(offset: int):
+        own_timings = []
+        own_errors = 0
+        n = offset
+
+        while time.monotonic() < deadline:
+            url = base_url + paths[n % len(paths)]
+            n += 1
+            marker = time.perf_counter()
+
+            try:
+                with urllib.request.urlopen(url, timeout=10) as response:
+                    response.read()
+                own_timings.append((time.perf_counter() - marker) * 1000)
+            except (OSError, urllib.error.URLError):
+                own_errors += 1
+
+        with lock:
+            timings.extend(own_timings)
+            errors.append(own_errors)
+
+    started = time.monotonic()
+    clients = [threading.Thread(target=client, args=(i,))
+               for i in range(concurrency)]
+
+    for th in clients:
+        th.start()
+    for th in clients:
+        th.join()
+
+    elapsed_s = time.monotonic() - started
+    result = summarize(timings)
+    result['concurrency'] = concurrency
+    result['elapsed_s'] = elapsed_s
+    result['requests_per_sec'] = len(timings) / elapsed_s
+    result['errors'] = sum(errors)
+    return result
+
+
+def print_result(label: str, result: dict):
+    print(f'{label:<24} {result["requests_per_sec"]:>9.1f} req/s '
+          f'p50 {result["p50_ms"]:.2f}ms '
+          f'p95 {result["p95_ms"]:.2f}ms '
+          f'p99 {result["p99_ms"]:.2f}ms '
+          f'errors {result["errors"]}')
+
+
+def get_cla():
+    ap = argparse.ArgumentParser(description='Concurrency load test of the '
+                                             'web API and its pluggramd '
+                                             'connections')
+    ap.add_argument('-u', '--url',
+                    type=str,
+                    metavar='URL',
+                    dest='url',
+                    default=None,
+                    help='Load an already running webapp, for example '
+                         'http://127.0.0.1:8000, instead of spawning '
+                         'pluggramd and webapp workers.')
+    ap.add_argument('-w', '--workers',
+                    type=lambda t: [int(s) for s in t.split(',') if s],
+                    metavar='N,N,...',
+                    dest='workers',
+                    default=DEFAULT_WORKERS,
+                    help='Worker process counts to spawn the webapp with, '
+                         'one run each.')
+    ap.add_argument('-T', '--threads',
+                    type=int,
+                    metavar='COUNT',
+                    dest='threads',
+                    default=4,
+                    help='Threads per uWSGI worker and pluggramd connections '
+                         'per worker.')
+    ap.add_argument('-c', '--concurrency',
+                    type=int,
+                    metavar='COUNT',
+                    dest='concurrency',
+                    default=None,
+                    help='Requests in flight. Default is twice the workers '
+                         'times threads of each run.')
+    ap.add_argument('-p', '--path',
+                    type=str,
+                    metavar='PATH',
+                    dest='paths',
+                    action='append',
+                    default=None,
+                    help='API path to request, may be given more than once. '
+                         'Requests rotate over the paths.')
+    ap.add_argument('-t', '--duration',
+                    type=float,
+                    metavar='SECONDS',
+                    dest='duration',
+                    default=5.0,
+                    help='How long to load each run.')
+    ap.add_argument('--server',
+                    type=str,
+                    choices=['auto', 'uwsgi', 'prefork'],
+                    dest='server',
+                    default='auto',
+                    help='Serve spawned workers with uWSGI or with a built-in '
+                         'prefork server. auto uses uWSGI when installed.')
+    ap.add_argument('-s', '--pluggramd',
+                    type=str,
+                    metavar='DIRECTORY',
+                    dest='pluggramd_dir',
+                    default='../pluggramd',
+                    help='Location of the pluggramd module.')
+    ap.add_argument('--port',
+                    type=int,
+                    dest='port',
+                    default=8990,
+                    help='HTTP port for spawned webapp workers. pluggramd '
+                         'listens on the next one.')
+    ap.add_argument('-o', '--output',
+                    type=str,
+                    metavar='PATH',
+                    dest='output',
+                    default=None,
+                    help='Write results JSON to this file.')
+    ap.add_argument('--serve-prefork',
+                    type=int,
+                    metavar='WORKERS',
+                    dest='serve_prefork',
+                    default=None,
+                    help=argparse.SUPPRESS)
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    cla = get_cla()
+
+    if cla.serve_prefork is not None:
+        serve_prefork(cla.port, cla.serve_prefork)
+        exit(0)
+
+    paths = cla.paths or DEFAULT_PATHS
+    report = {'paths': paths, 'runs': []}
+
+    if cla.url is not None:
+        result = run_load(cla.url.rstrip('/'),
+                          paths,
+                          cla.concurrency or 8,
+                          cla.duration)
+        report['runs'].append(result)
+        print_result(cla.url, result)
+    else:
+        server = cla.server
+        if server == 'auto':
+            server = 'uwsgi' if shutil.which('uwsgi') else 'prefork'
+
+        pluggramd_url = f'tcp://127.0.0.1:{cla.port + 1}'
+        pluggramd_proc = start_pluggramd(cla.pluggramd_dir, pluggramd_url)
+        base_url = f'http://127.0.0.1:{cla.port}'
+        report['server'] = server
+        report['threads'] = cla.threads
+
+        try:
+            for workers in cla.workers:
+                webapp_proc = start_webapp(cla.port,
+                                           pluggramd_url,
+                                           workers,
+                                           cla.threads,
+                                           server)
+                try:
+                    if not wait_for_http(base_url + paths[0], 20):
+                        print(f'webapp with {workers} workers did not answer '
+                              f'in time')
+                        exit(2)
+
+                    result = run_load(base_url,
+                                      paths,
+                                      cla.concurrency or
+                                      2 * workers * cla.threads,
+                                      cla.duration)
+                finally:
+                    stop_process(webapp_proc)
+
+                result['workers'] = workers
+                report['runs'].append(result)
+                print_result(f'{server} {workers}x{cla.threads}', result)
+        finally:
+            stop_process(pluggramd_proc)
+
+    if cla.output is not None:
+        with open(cla.output, 'w') as rf:
+            json.dump(report, rf, indent=2)
+        print(f'wrote results to "{cla.output}"')
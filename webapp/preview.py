@@ -0,0 +1,140 @@
+import io
+import os
+import zmq
+import time
+import struct
+import logging
+from PIL import Image
+from stream import Channel
+from threading import Lock, Thread
+
+
+LOG = logging.getLogger('ledscreen.preview')
+PREVIEW_FPS = 10
+PREVIEW_SCALE = 8
+JPEG_QUALITY = 90
+BOUNDARY = 'frame'
+TOPIC = b'frame'
+# width, height, epoch, frame number, as published by screend
+HEADER = struct.Struct('!HHQQ')
+
+
+class PreviewChannel(Channel):
+    """
+    MJPEG stream of the screen for browsers.
+
+    Frames come from screend's preview publisher, which only sends while
+    this process subscribes, and this process only subscribes while it has
+    viewers. Each frame is upscaled and encoded once for all viewers, at
+    most max_fps times a second. Viewers that fall behind skip frames.
+    """
+
+    content_type = f'multipart/x-mixed-replace; boundary={BOUNDARY}'
+    skip_when_behind = True
+
+    def __init__(self,
+                 server,
+                 path: str,
+                 url: str,
+                 max_fps=PREVIEW_FPS,
+                 scale=PREVIEW_SCALE):
+        self._server = server
+        self._path = path
+        self._url = url
+        self._interval_s = 1 / max_fps
+        self._scale = scale
+        self._viewers = 0
+        self._part = b''
+        self._pid = None
+        self._lock = Lock()
+
+    def clients_changed(self, count: int):
+        self._viewers = count
+
+        if count:
+            self._ensure_running()
+
+    def _ensure_running(self):
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._part = b''
+                Thread(target=self._run,
+                       name='screen-preview',
+                       daemon=True).start()
+
+    def _encode(self, header: bytes, data: bytes) -> bytes:
+        width, height, _epoch, _number = HEADER.unpack(header)
+        img = Image.frombytes('RGB', (width, height), data)
+        img = img.resize((width * self._scale, height * self._scale),
+                         Image.NEAREST)
+        output = io.BytesIO()
+        img.save(output, format='jpeg', quality=JPEG_QUALITY)
+        jpeg = output.getvalue()
+
+        return (f'--{BOUNDARY}\r\n'
+                f'Content-Type: image/jpeg\r\n'
+                f'Content-Length: {len(jpeg)}\r\n\r\n').encode() + \
+            jpeg + b'\r\n'
+
+    def _run(self):
+        context = zmq.Context()
+        socket = context.socket(zmq.SUB)
+        socket.connect(self._url)
+        subscribed = False
+        pending = None
+        last_sent = 0.0
+
+        while True:
+            watched = self._viewers > 0
+
+            if watched != subscribed:
+                socket.setsockopt(zmq.SUBSCRIBE if watched
+                                  else zmq.UNSUBSCRIBE, TOPIC)
+                subscribed = watched
+                LOG.debug(f'preview {"subscribed" if watched else "idle"}')
+
+                if not watched:
+                    # screend greets the next subscription with a new frame
+                    self._part = b''
+                    pending = None
+
+            if pending is None:
+                timeout_ms = 1000
+            else:
+                timeout_ms = max(last_sent + self._interval_s -
+                                 time.monotonic(), 0) * 1000
+
+            if socket.poll(timeout_ms):
+                # only the newest of the frames that arrived meanwhile counts
+                while True:
+                    try:
+                        pending = socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+
+            if pending is None or \
+                    time.monotonic() - last_sent < self._interval_s:
+                continue
+
+            _topic, header, data = pending
+            pending = None
+            last_sent = time.monotonic()
+
+            try:
+                self._part = self._encode(header, data)
+            except (ValueError, struct.error) as e:
+                LOG.warning(f'dropping malformed preview frame: {str(e)}')
+                continue
+
+            self._server.broadcast(self._path, self._part)
+
+    def greeting(self) -> bytes:
+        return self._part
+
+    def keepalive(self) -> bytes:
+        # an idle screen sends no frames, repeat the last one
+        return self._part
@@ -1,8 +1,9 @@
-import functools
-
+import rpc
+import json
 import system
+import hashlib
 import logging
-from flask import Blueprint, request
+from flask import Blueprint, Response, request
 from common import config, pluggram_manager
 from flask_restful import Api, Resource
 from tinyrpc.protocols.msgpackrpc import MSGPACKRPCError
@@ -29,7 +30,19 @@ def key_or_session():
         return False
 
 
-@functools.lru_cache(16)
+def conditional(payload):
+    """
+    Reply with payload, or with 304 if the client already holds it.
+    """
+    encoded = json.dumps(payload, sort_keys=True).encode()
+    etag = hashlib.sha1(encoded).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+
+    return payload, 200, {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+
+
 def get_query_pluggram_name(query_name: str):
     selected_name = None
 
@@ -174,47 +187,150 @@ class RunningPluggram(Resource):
         except MSGPACKRPCError as e:
             return {'message': e.message}, 500
 
-        return {'name': running_name}, 200
+        return conditional({'name': running_name})
 
 
 api.add_resource(RunningPluggram, '/pluggrams/running')
 
 
+class RunnerStats(Resource):
+
+    def get(self):
+        try:
+            runners = pluggram_manager.get_runner_stats()
+        except MSGPACKRPCError as e:
+            return {'message': e.message}, 500
+
+        return {'runners': [{'name': r.name,
+                             'pid': r.pid,
+                             'on_screen': r.on_screen,
+                             'stats': r.stats} for r in runners]}, 200
+
+
+api.add_resource(RunnerStats, '/pluggrams/running/stats')
+
+
+class ProfileRunningPluggram(Resource):
+
+    def post(self):
+        if not key_or_session():
+            return {}, 403
+
+        # unparseable values come back as None
+        ticks = request.args.get('ticks', None, type=int)
+        seconds = request.args.get('seconds', None, type=float)
+
+        if (ticks is None and seconds is None) or \
+                (ticks is not None and ticks <= 0) or \
+                (seconds is not None and seconds <= 0):
+            return {'message': 'give a positive number of "ticks" or '
+                               '"seconds" to profile'}, 400
+
+        sampling = request.args.get('sampling', 'false').lower() == 'true'
+
+        try:
+            profile_id = pluggram_manager.profile(ticks, seconds, sampling)
+        except MSGPACKRPCError:
+            return {'message': 'RPC call failed to start profiling'}, 500
+
+        if profile_id is None:
+            return {'message': 'no pluggram is running'}, 400
+
+        LOG.info(f'requested profile {profile_id} of the running pluggram')
+        return {'id': profile_id}, 202
+
+
+api.add_resource(ProfileRunningPluggram, '/pluggrams/running/profile')
+
+
+class Profiles(Resource):
+
+    def get(self):
+        if not key_or_session():
+            return {}, 403
+
+        try:
+            profiles = pluggram_manager.get_profiles()
+        except MSGPACKRPCError as e:
+            return {'message': e.message}, 500
+
+        return {'profiles': [{'id': p.id,
+                              'name': p.name,
+                              'format': p.format,
+                              'done': p.done} for p in profiles]}, 200
+
+
+api.add_resource(Profiles, '/profiles')
+
+
+class ProfileDownload(Resource):
+
+    def get(self, profile_id: int):
+        if not key_or_session():
+            return {}, 403
+
+        try:
+            profile = pluggram_manager.get_profile(profile_id)
+        except rpc.RPCUnavailableError:
+            return {'message': 'RPC call failed to get profile'}, 500
+        except MSGPACKRPCError as e:
+            return {'message': e.message}, 500
+
+        if profile is None:
+            return {'id': profile_id}, 404
+
+        fmt, data = profile
+
+        if data is None:
+            return {'id': profile_id, 'message': 'still profiling'}, 202
+
+        mimetype = 'text/plain' if fmt == 'collapsed' \
+            else 'application/octet-stream'
+        return Response(data,
+                        mimetype=mimetype,
+                        headers={'Content-Disposition':
+                                 f'attachment; filename='
+                                 f'profile-{profile_id}.{fmt}'})
+
+
+api.add_resource(ProfileDownload, '/profiles/<int:profile_id>')
+
+
 class Pluggrams(Resource):
 
     def get(self):
         payload = []
 
         try:
-            for name in pluggram_manager.get_names():
-                options = pluggram_manager.get_options(name)
-                options_node = []
-
-                for opt in options:
-                    option_node = {
-                        'name': opt.name,
-                        'type': opt.type_name,
-                        'min': opt.min,
-                        'max': opt.max,
-                        'choices': opt.choices,
-                        'default_value': opt.default,
-                        'value': opt.value
-                    }
-                    options_node.append(option_node)
-
-                info = pluggram_manager.get_info(name)
-                pluggram_node = {
-                    'name': name,
-                    'display_name': info.display_name,
-                    'version': info.version,
-                    'description': info.description,
-                    'options': options_node
-                }
-                payload.append(pluggram_node)
+            catalog = pluggram_manager.get_catalog()
         except MSGPACKRPCError:
             return {'message': 'RPC call failed to get pluggram options'}, 500
 
-        return payload, 200
+        for info in catalog.programs:
+            options_node = []
+
+            for opt in info.options:
+                option_node = {
+                    'name': opt.name,
+                    'type': opt.type_name,
+                    'min': opt.min,
+                    'max': opt.max,
+                    'choices': opt.choices,
+                    'default_value': opt.default,
+                    'value': opt.value
+                }
+                options_node.append(option_node)
+
+            pluggram_node = {
+                'name': info.name,
+                'display_name': info.display_name,
+                'version': info.version,
+                'description': info.description,
+                'options': options_node
+            }
+            payload.append(pluggram_node)
+
+        return conditional(payload)
 
 
 api.add_resource(Pluggrams, '/pluggrams')
@@ -254,3 +370,18 @@ class SystemPoweroff(Resource):
 
 
 api.add_resource(SystemPoweroff, '/system/poweroff')
+
+
+class SystemMetrics(Resource):
+
+    def get(self):
+        try:
+            pluggramd_metrics = pluggram_manager.get_rpc_metrics()
+        except MSGPACKRPCError as e:
+            pluggramd_metrics = {'message': e.message}
+
+        return {'webapp': rpc.get_rpc_metrics(),
+                'pluggramd': pluggramd_metrics}, 200
+
+
+api.add_resource(SystemMetrics, '/system/metrics')
@@ -1,6 +1,6 @@
 import logging
 from flask import Blueprint, render_template
-from common import pluggram_manager
+from common import config, pluggram_manager
 from .authentication import auth_or_login
 
 
@@ -11,14 +11,12 @@ bp = Blueprint('manage', __name__, url_prefix='/manage')
 @bp.route('/', methods=['GET'])
 def index():
     auth_or_login()
-    programs = []
 
-    names = pluggram_manager.get_names()
-    LOG.debug(f'got list of {len(names)} pluggram names')
+    catalog = pluggram_manager.get_catalog()
+    LOG.debug(f'got catalog version {catalog.version} of '
+              f'{len(catalog.programs)} pluggrams')
 
-    for name in names:
-        info = pluggram_manager.get_info(name, options=True)
-        LOG.debug(f'retrieved program info for "{name}"')
-        programs.append(info)
-
-    return render_template('pages/manage.html', programs=programs)
+    return render_template('pages/manage.html',
+                           programs=catalog.programs,
+                           preview='app.stream_port' in config and
+                                   'app.screen_preview_url' in config)
@@ -1,21 +1,172 @@
 import io
+import os
 import zmq
+import time
+import utils
+import logging
+import tinyrpc.exc
 from enum import IntFlag
 from typing import List, Tuple, Union, Optional
 from tinyrpc import RPCClient
-from threading import Lock
+from threading import Lock, Condition
+from events import ReadCache, EventSubscriber, MISSING
+# utils has put the shared modules on the path, the app reaches these
+# through rpc
+from resilience import RPC_TIMEOUT_S, RPC_RETRIES, RPC_BACKOFF_MAX_S, \
+    CallProxy, DeadlineTransport, RPCUnavailableError, ResilientClient, \
+    get_rpc_metrics
 from dataclasses import dataclass
-from tinyrpc.transports.zmq import ZmqClientTransport
 from tinyrpc.protocols.msgpackrpc import MSGPACKRPCProtocol
 
 
-def rpc_get_screen(screen_url: str, context=zmq.Context()):
-    client = RPCClient(
-        MSGPACKRPCProtocol(),
-        ZmqClientTransport.create(context, screen_url)
-    )
-    proxy = client.get_proxy()
-    return Screen(proxy)
+# pluggramd calls that only read state and can be repeated safely
+PLUGGRAMD_IDEMPOTENT_METHODS = frozenset([
+    'get_names',
+    'get_info',
+    'get_options',
+    'get_running',
+    'get_catalog',
+    'get_rpc_metrics',
+    'get_runner_stats',
+    'get_profiles',
+    'get_profile'
+])
+POOL_MAX_CLIENTS = 4
+
+LOG = logging.getLogger('ledscreen.rpc')
+
+
+def rpc_get_screen(screen_url: str,
+                   timeout=RPC_TIMEOUT_S,
+                   max_clients=POOL_MAX_CLIENTS):
+    pool = ClientPool(screen_url, timeout=timeout, max_clients=max_clients)
+    return Screen(pool.get_proxy())
+
+
+def rpc_get_pluggram_proxy(pluggramd_url: str,
+                           timeout=RPC_TIMEOUT_S,
+                           max_clients=POOL_MAX_CLIENTS):
+    pool = ClientPool(pluggramd_url,
+                      PLUGGRAMD_IDEMPOTENT_METHODS,
+                      timeout,
+                      max_clients)
+    return pool.get_proxy()
+
+
+class PoolExhaustedError(RPCUnavailableError):
+    pass
+
+
+class ClientPool:
+    """
+    Connected clients of one endpoint, each lent to one call at a time so
+    that request threads can have up to max_clients calls in flight without
+    waiting on each other. A call that finds every client busy waits for
+    one, at most as long as a call could take, then fails.
+
+    ZeroMQ contexts and sockets do not survive fork(), and uWSGI imports
+    the app in its master before forking workers, so the pool creates its
+    context on first use and starts over with a fresh one whenever it is
+    used from a new process.
+    """
+
+    @property
+    def client_count(self) -> int:
+        return self._count
+
+    def __init__(self,
+                 endpoint: str,
+                 idempotent_methods=frozenset(),
+                 timeout: Optional[float] = RPC_TIMEOUT_S,
+                 max_clients=POOL_MAX_CLIENTS):
+        self.endpoint = endpoint
+        self._idempotent_methods = idempotent_methods
+        self._timeout = timeout
+        self._max_clients = max_clients
+        self._wait_timeout = None if timeout is None \
+            else timeout * (RPC_RETRIES + 1) + RPC_BACKOFF_MAX_S
+        # started by the first call, in the process that makes it
+        self._pid = None
+        self._count = 0
+        self._fork_lock = Lock()
+
+    def _start(self):
+        # the parent's sockets belong to its context, leave them alone
+        self._pid = os.getpid()
+        self._context = zmq.Context()
+        self._idle: List[ResilientClient] = []
+        self._count = 0
+        self._cond = Condition()
+
+    def _check_process(self):
+        if self._pid != os.getpid():
+            with self._fork_lock:
+                if self._pid != os.getpid():
+                    self._start()
+
+    def _connect(self) -> ResilientClient:
+        client = RPCClient(
+            MSGPACKRPCProtocol(),
+            DeadlineTransport(self._context, self.endpoint)
+        )
+        return ResilientClient(client,
+                               self.endpoint,
+                               self._idempotent_methods,
+                               self._timeout)
+
+    def _acquire(self) -> ResilientClient:
+        self._check_process()
+        deadline = None if self._wait_timeout is None \
+            else time.monotonic() + self._wait_timeout
+
+        with self._cond:
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+
+                if self._count < self._max_clients:
+                    client = self._connect()
+                    self._count += 1
+                    return client
+
+                remaining = None if deadline is None \
+                    else deadline - time.monotonic()
+
+                if remaining is not None and remaining <= 0:
+                    raise PoolExhaustedError(f'all {self._max_clients} '
+                                             f'connections to '
+                                             f'{self.endpoint} are busy')
+
+                self._cond.wait(remaining)
+
+    def _release(self, client: ResilientClient, discard=False):
+        with self._cond:
+            if discard:
+                client.client.transport.socket.close(linger=0)
+                self._count -= 1
+            else:
+                self._idle.append(client)
+
+            self._cond.notify()
+
+    def call(self, method: str, args):
+        client = self._acquire()
+
+        try:
+            rv = client.call(method, args)
+        except tinyrpc.exc.RPCError:
+            # the transport already recovered from anything it reports
+            self._release(client)
+            raise
+        except Exception:
+            self._release(client, discard=True)
+            raise
+
+        self._release(client)
+        return rv
+
+    def get_proxy(self):
+        return CallProxy(self)
 
 
 def get_key_display_name(key: str):
@@ -215,28 +366,86 @@ class PluggramInfo:
     options: Optional[List[Option]]
 
 
-class PluggramManager:
+@dataclass(frozen=True)
+class Catalog:
+    version: int
+    programs: List[PluggramInfo]
+
+    def find(self, name: str) -> Optional[PluggramInfo]:
+        for info in self.programs:
+            if info.name == name:
+                return info
+        return None
 
-    def __init__(self, rpc_proxy):
-        self._rpc = rpc_proxy
-        self._lk: Lock = Lock()
 
-    def _lock(self):
-        self._lk.acquire(timeout=2)
+@dataclass(frozen=True)
+class RunnerStats:
+    name: str
+    pid: int
+    # False for a worker waiting to take the screen over
+    on_screen: bool
+    stats: dict
 
-    def _unlock(self):
-        self._lk.release()
+
+@dataclass(frozen=True)
+class ProfileInfo:
+    id: int
+    name: str
+    # "pstats" or "collapsed"
+    format: str
+    done: bool
+
+
+class PluggramManager:
+    """
+    Typed access to pluggramd. With a subscriber to its events, names, the
+    catalog and the running pluggram are read once and then served from
+    memory until an event says they changed.
+    """
+
+    def __init__(self, rpc_proxy, subscriber: Optional[EventSubscriber] = None):
+        self._rpc = rpc_proxy
+        self._catalog: Optional[Catalog] = None
+        self._cache = ReadCache()
+        self._subscriber = subscriber
+
+        if subscriber is not None:
+            subscriber.add_listener(self._on_event)
+
+    def _on_event(self, topic: str, event: dict):
+        if topic == 'health':
+            # anything read while events may have been missed is suspect
+            if event['healthy']:
+                self._cache.enable()
+            else:
+                self._cache.disable()
+        elif topic == 'running':
+            self._cache.invalidate('running')
+        elif topic == 'options':
+            self._cache.invalidate('catalog')
+        elif topic == 'catalog':
+            self._cache.invalidate('catalog', 'names')
+        elif topic == 'heartbeat':
+            if self._cache.peek('running') not in (MISSING,
+                                                   event['running']):
+                self._cache.invalidate('running')
+
+            catalog = self._cache.peek('catalog')
+            if catalog is not MISSING and \
+                    catalog.version != event['catalog_version']:
+                self._cache.invalidate('catalog')
+
+    def _cached(self, key: str, loader):
+        if self._subscriber is not None:
+            self._subscriber.ensure_running()
+
+        return self._cache.get(key, loader)
 
     def get_names(self) -> List[str]:
-        self._lock()
-        rv = self._rpc.get_names()
-        self._unlock()
-        return rv
+        return self._cached('names', self._rpc.get_names)
 
     def get_info(self, name: str, options=False) -> Optional[PluggramInfo]:
-        self._lock()
         display_name, description, version, tick_rate = self._rpc.get_info(name)
-        self._unlock()
 
         opts = self.get_options(name) if options else None
 
@@ -248,10 +457,40 @@ class PluggramManager:
                             opts)
 
     def get_options(self, name: str) -> List[Option]:
+        return self._parse_options(self._rpc.get_options(name))
+
+    def get_catalog(self) -> Catalog:
+        """
+        Info and options of every pluggram in one call, reusing the last
+        catalog fetched by this process when pluggramd reports no change.
+        """
+        return self._cached('catalog', self._fetch_catalog)
+
+    def _fetch_catalog(self) -> Catalog:
+        cached = self._catalog
+        version, programs = self._rpc.get_catalog(
+            cached.version if cached is not None else None)
+
+        if programs is None and cached is not None:
+            return cached
+
+        infos = []
+        for program in programs:
+            infos.append(PluggramInfo(program[0],
+                                      program[1],
+                                      program[2],
+                                      program[3],
+                                      program[4],
+                                      self._parse_options(program[5])))
+
+        catalog = Catalog(version, infos)
+
+        self._catalog = catalog
+        return catalog
+
+    @staticmethod
+    def _parse_options(flat_options: list) -> List[Option]:
         options = []
-        self._lock()
-        flat_options = self._rpc.get_options(name)
-        self._unlock()
 
         for flat_option in flat_options:
             name = flat_option[0]
@@ -278,25 +517,43 @@ class PluggramManager:
 
     def save_options(self, name: str, options: dict) -> Tuple[List[str],
                                                               List[str]]:
-        self._lock()
         rv = self._rpc.save_options(name, options)
-        self._unlock()
+        self._cache.invalidate('catalog')
         return rv
 
     def get_running(self) -> Optional[str]:
-        self._lock()
-        rv = self._rpc.get_running()
-        self._unlock()
-        return rv
+        return self._cached('running', self._rpc.get_running)
 
     def start(self, name: str) -> bool:
-        self._lock()
         rv = self._rpc.start(name)
-        self._unlock()
+        self._cache.invalidate('running')
         return rv
 
     def stop(self, clear: bool) -> bool:
-        self._lock()
         rv = self._rpc.stop(clear)
-        self._unlock()
+        self._cache.invalidate('running')
+        return rv
+
+    def get_rpc_metrics(self) -> dict:
+        rv = self._rpc.get_rpc_metrics()
         return rv
+
+    def get_runner_stats(self) -> List[RunnerStats]:
+        return [RunnerStats(name, pid, on_screen, stats)
+                for name, pid, on_screen, stats
+                in self._rpc.get_runner_stats()]
+
+    def profile(self,
+                ticks: Optional[int] = None,
+                seconds: Optional[float] = None,
+                sampling=False) -> Optional[int]:
+        return self._rpc.profile(ticks, seconds, sampling)
+
+    def get_profiles(self) -> List[ProfileInfo]:
+        return [ProfileInfo(profile_id, name, fmt, done)
+                for profile_id, name, fmt, done in self._rpc.get_profiles()]
+
+    def get_profile(self,
+                    profile_id: int) -> Optional[Tuple[str, Optional[bytes]]]:
+        rv = self._rpc.get_profile(profile_id)
+        return tuple(rv) if rv is not None else None
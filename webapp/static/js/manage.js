@@ -197,6 +197,8 @@ function bgr_to_rgb(bgr)
     return r | (g << 8) | (b << 16);
 }
 
+let saved_at = {};
+
 function save_program_settings(program_name)
 {
     const modal_form = settings_forms[program_name];
@@ -230,6 +232,7 @@ function save_program_settings(program_name)
     }
 
     const path = POST_PROGRAM_OPTIONS.format(program_name);
+    saved_at[program_name] = Date.now();
     $.post(path, value_map, function(data, textStatus, jqXHR){
         filter_status_response(jqXHR, function() {
             display_name = data["display_name"];
@@ -396,5 +399,71 @@ for (const pb of play_stop_btns)
     });
 }
 
-poll_running_program();
-setInterval(poll_running_program, 5000);
+const EVENTS_ENDPOINT = "/api/events";
+let poll_timer = null;
+
+function start_polling()
+{
+    if (poll_timer == null)
+    {
+        poll_running_program();
+        poll_timer = setInterval(poll_running_program, 5000);
+    }
+}
+
+function stop_polling()
+{
+    if (poll_timer != null)
+    {
+        clearInterval(poll_timer);
+        poll_timer = null;
+    }
+}
+
+start_polling();
+
+// pushed updates replace polling while the event stream is connected
+if (window.EventSource)
+{
+    const events = new EventSource(EVENTS_ENDPOINT);
+
+    events.addEventListener("open", stop_polling);
+    events.addEventListener("error", start_polling);
+
+    events.addEventListener("running", function(e) {
+        running_program_name = JSON.parse(e.data)["name"];
+        update_play_stop_btns();
+    });
+
+    events.addEventListener("options", function(e) {
+        const program_name = JSON.parse(e.data)["name"];
+
+        // this page saved them itself
+        if (Date.now() - (saved_at[program_name] || 0) < 5000)
+        {
+            return;
+        }
+
+        iziToast.show({
+            title: "Settings changed",
+            message: `Settings of ${program_name} were saved, reload to see them.`,
+            drag: false,
+            theme: 'dark',
+            icon: 'bi bi-info-circle'
+        });
+    });
+
+    events.addEventListener("health", function(e) {
+        if (!JSON.parse(e.data)["healthy"])
+        {
+            iziToast.show({
+                title: "Not responding",
+                message: "The program service stopped responding.",
+                drag: false,
+                theme: 'dark',
+                backgroundColor: '#dd5858',
+                icon: 'bi bi-x-lg'
+            });
+        }
+    });
+}
@@ -0,0 +1,355 @@
+import os
+import time
+import socket
+import logging
+import selectors
+from http.cookies import CookieError, SimpleCookie
+from urllib.parse import parse_qs
+from typing import Callable, Dict, Optional
+from threading import Lock, Thread
+from collections import deque
+
+
+LOG = logging.getLogger('ledscreen.stream')
+KEEPALIVE_S = 15.0
+MAX_REQUEST_BYTES = 8192
+# a client this far behind is not reading and gets disconnected
+MAX_BACKLOG_BYTES = 256 * 1024
+LISTEN_BACKLOG = 128
+STREAM_HOST = '127.0.0.1'
+
+
+class Channel:
+    """
+    A path on the stream server. Everything broadcast to it is written to
+    every client connected to that path.
+    """
+
+    content_type = 'application/octet-stream'
+    # skip broadcasts for clients still sending an earlier one instead of
+    # queueing them, for streams where only the newest data matters
+    skip_when_behind = False
+
+    def clients_changed(self, count: int):
+        """
+        Called on the server thread when a client joins or leaves.
+        """
+        pass
+
+    def greeting(self) -> bytes:
+        """
+        Sent to a client right after the response headers.
+        """
+        return b''
+
+    def keepalive(self) -> bytes:
+        """
+        Sent to idle clients so proxies and dead peers notice.
+        """
+        return b''
+
+
+class _Client:
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.request = b''
+        self.path: Optional[str] = None
+        self.out = bytearray()
+        self.closing = False
+        self.idle_since = time.monotonic()
+
+
+class StreamServer:
+    """
+    Serves long-lived HTTP responses, such as server-sent events, from one
+    thread per process. Clients cost a socket and a buffer each instead of
+    a request thread, so a worker can hold hundreds of them.
+
+    Every worker process binds the same port with SO_REUSEPORT and the
+    kernel spreads connections over the workers that have started their
+    thread. It starts on first use in each process, like the RPC clients.
+
+    authorize, if given, is called with the query parameters and cookies
+    of each request, dicts of names to values, and clients it refuses get
+    403 instead of a stream.
+    """
+
+    @property
+    def client_count(self) -> int:
+        return self._client_count
+
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 keepalive_s=KEEPALIVE_S,
+                 authorize: Optional[Callable[[dict, dict], bool]] = None):
+        self._host = host
+        self._port = port
+        self._keepalive_s = keepalive_s
+        self._authorize = authorize
+        self._channels: Dict[str, Channel] = {}
+        self._pid = None
+        self._lock = Lock()
+        self._pending = deque()
+        self._wake_r: Optional[socket.socket] = None
+        self._wake_w: Optional[socket.socket] = None
+        self._client_count = 0
+        self._path_counts: Dict[str, int] = {}
+
+    def add_channel(self, path: str, channel: Channel):
+        self._channels[path] = channel
+
+    def ensure_running(self):
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pending = deque()
+                self._client_count = 0
+                self._path_counts = {}
+                self._wake_r, self._wake_w = socket.socketpair()
+                self._wake_r.setblocking(False)
+                self._wake_w.setblocking(False)
+                Thread(target=self._run,
+                       name='stream-server',
+                       daemon=True).start()
+
+    def broadcast(self, path: str, data: bytes):
+        """
+        Queue data for every client of path, safe to call from any thread.
+        """
+        if self._pid != os.getpid():
+            return
+
+        self._pending.append((path, data))
+
+        try:
+            self._wake_w.send(b'\0')
+        except BlockingIOError:
+            # the server already has a wakeup waiting
+            pass
+
+    def _listen(self) -> Optional[socket.socket]:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        try:
+            listener.bind((self._host, self._port))
+        except OSError as e:
+            LOG.error(f'stream server cannot bind {self._host}:{self._port}: '
+                      f'{str(e)}')
+            listener.close()
+            return None
+
+        listener.listen(LISTEN_BACKLOG)
+        listener.setblocking(False)
+        LOG.info(f'serving streams on {self._host}:{self._port} '
+                 f'in process {os.getpid()}')
+        return listener
+
+    def _run(self):
+        listener = self._listen()
+
+        if listener is None:
+            return
+
+        selector = selectors.DefaultSelector()
+        selector.register(listener, selectors.EVENT_READ)
+        selector.register(self._wake_r, selectors.EVENT_READ)
+        clients: Dict[socket.socket, _Client] = {}
+
+        while True:
+            for key, mask in selector.select(self._keepalive_s / 2):
+                if key.fileobj is listener:
+                    self._accept(listener, selector, clients)
+                elif key.fileobj is self._wake_r:
+                    self._drain_wakeups()
+                else:
+                    client = key.data
+
+                    if mask & selectors.EVENT_READ:
+                        self._read(client, selector, clients)
+                    if mask & selectors.EVENT_WRITE and \
+                            client.sock in clients:
+                        self._flush(client, selector, clients)
+
+            while self._pending:
+                path, data = self._pending.popleft()
+                skip = self._channels[path].skip_when_behind
+
+                for client in list(clients.values()):
+                    if client.path != path or client.closing or \
+                            (skip and client.out):
+                        continue
+
+                    self._send(client, data, selector, clients)
+
+            self._keep_alive(selector, clients)
+            self._client_count = len(clients)
+
+    def _accept(self, listener, selector, clients):
+        while True:
+            try:
+                sock, _addr = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+
+            sock.setblocking(False)
+            client = _Client(sock)
+            clients[sock] = client
+            selector.register(sock, selectors.EVENT_READ, client)
+
+    def _drain_wakeups(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _count(self, path: str, change: int):
+        count = self._path_counts.get(path, 0) + change
+        self._path_counts[path] = count
+        self._channels[path].clients_changed(count)
+
+    def _close(self, client: _Client, selector, clients):
+        selector.unregister(client.sock)
+        del clients[client.sock]
+        client.sock.close()
+
+        if client.path is not None:
+            self._count(client.path, -1)
+
+    def _read(self, client: _Client, selector, clients):
+        try:
+            data = client.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+
+        if not data:
+            self._close(client, selector, clients)
+            return
+
+        # a streaming client has nothing more to say, ignore it
+        if client.path is not None or client.closing:
+            return
+
+        client.request += data
+
+        if b'\r\n\r\n' not in client.request:
+            if len(client.request) > MAX_REQUEST_BYTES:
+                self._reject(client, '431 Request Header Fields Too Large',
+                             selector, clients)
+            return
+
+        head = client.request.split(b'\r\n\r\n', 1)[0].decode('latin-1')
+        request_line, *header_lines = head.split('\r\n')
+        parts = request_line.split(' ')
+
+        if len(parts) != 3:
+            self._reject(client, '400 Bad Request', selector, clients)
+            return
+
+        method, target, _version = parts
+        path, _, query = target.partition('?')
+        channel = self._channels.get(path)
+
+        if channel is None:
+            self._reject(client, '404 Not Found', selector, clients)
+        elif method != 'GET':
+            self._reject(client, '405 Method Not Allowed', selector, clients)
+        elif not self._allowed(query, header_lines):
+            self._reject(client, '403 Forbidden', selector, clients)
+        else:
+            client.path = path
+            client.request = b''
+            self._count(path, 1)
+            headers = (f'HTTP/1.1 200 OK\r\n'
+                       f'Content-Type: {channel.content_type}\r\n'
+                       f'Cache-Control: no-cache\r\n'
+                       f'X-Accel-Buffering: no\r\n'
+                       f'Connection: close\r\n\r\n')
+            self._send(client,
+                       headers.encode() + channel.greeting(),
+                       selector,
+                       clients)
+
+    def _allowed(self, query: str, header_lines) -> bool:
+        if self._authorize is None:
+            return True
+
+        params = {k: v[0] for k, v in parse_qs(query).items()}
+        cookies = {}
+
+        for line in header_lines:
+            name, _, value = line.partition(':')
+
+            if name.strip().lower() == 'cookie':
+                try:
+                    parsed = SimpleCookie(value.strip())
+                except CookieError:
+                    return False
+
+                cookies.update({k: m.value for k, m in parsed.items()})
+
+        return self._authorize(params, cookies)
+
+    def _reject(self, client: _Client, status: str, selector, clients):
+        client.closing = True
+        self._send(client,
+                   f'HTTP/1.1 {status}\r\nContent-Length: 0\r\n'
+                   f'Connection: close\r\n\r\n'.encode(),
+                   selector,
+                   clients)
+
+    def _send(self, client: _Client, data: bytes, selector, clients):
+        client.out += data
+        client.idle_since = time.monotonic()
+
+        if len(client.out) > MAX_BACKLOG_BYTES:
+            LOG.debug(f'dropping stream client that stopped reading')
+            self._close(client, selector, clients)
+            return
+
+        self._flush(client, selector, clients)
+
+    def _flush(self, client: _Client, selector, clients):
+        try:
+            sent = client.sock.send(client.out)
+            del client.out[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self._close(client, selector, clients)
+            return
+
+        if client.out:
+            selector.modify(client.sock,
+                            selectors.EVENT_READ | selectors.EVENT_WRITE,
+                            client)
+        elif client.closing:
+            self._close(client, selector, clients)
+        else:
+            selector.modify(client.sock, selectors.EVENT_READ, client)
+
+    def _keep_alive(self, selector, clients):
+        now = time.monotonic()
+
+        for client in list(clients.values()):
+            if now - client.idle_since < self._keepalive_s:
+                continue
+
+            if client.path is None:
+                # never finished its request
+                self._close(client, selector, clients)
+            elif not client.closing:
+                keepalive = self._channels[client.path].keepalive()
+                client.idle_since = now
+
+                if keepalive:
+                    self._send(client, keepalive, selector, clients)
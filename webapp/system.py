@@ -89,12 +89,27 @@ def is_user_authenticated() -> bool:
     LOG.info(
         f'auth check from {address} path="{request.path}" '
         f'expired={user_state.expired} token={cookie_value}')
+    return is_session_valid(cookie_value)
+
+
+def is_session_valid(cookie_value: Optional[str]) -> bool:
     if not user_state.expired:
         if user_state.validate_session(cookie_value):
             return True
     return False
 
 
+def is_stream_authorized(params: dict, cookies: dict) -> bool:
+    """
+    key_or_session() of the endpoints for the stream server, which reads
+    requests without flask.
+    """
+    if is_session_valid(cookies.get(AUTH_COOKIE_NAME)):
+        return True
+
+    return params.get('key') in config['app.api_keys']
+
+
 def _shutdown_worker(restarting: bool):
     letter = 'r' if restarting else 'P'
     # cheap trick to ensure webserver has time to send a response
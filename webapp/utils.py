@@ -1,4 +1,5 @@
 import os
+import sys
 import time
 import pytoml
 import random
@@ -12,6 +13,14 @@ DEV_FORMATTER = logging.Formatter('{levelname:>8}: {message} [{name}@{lineno}]',
                                   datefmt='%x %H:%M:%S',
                                   style='{')
 FORMATTER = logging.Formatter('{levelname:>8}: {message}', style='{')
+# modules the daemons have in common, importable once utils is imported
+SHARED_DIR = os.path.normpath(os.path.join(os.path.abspath(__file__),
+                                           os.pardir,
+                                           os.pardir,
+                                           'shared'))
+
+if SHARED_DIR not in sys.path:
+    sys.path.append(SHARED_DIR)
 
 
 def configure_logger(log):
@@ -63,7 +72,7 @@ class ConfigValidator:
         abs_key = self.getAbsoluteKey(relative_key)
         return self._data.get(abs_key)
 
-    def validate(self, relative_key: str, required_type=None):
+    def validate(self, relative_key: str, required_type=None, optional=False):
         abs_key = self.getAbsoluteKey(relative_key)
 
         if abs_key in self._data:
@@ -75,8 +84,9 @@ class ConfigValidator:
                               f'{required_type.__name__}')
                     exit(3)
         else:
-            LOG.error(f'"{abs_key}" must be defined')
-            exit(3)
+            if not optional:
+                LOG.error(f'"{abs_key}" must be defined')
+                exit(3)
 
 
 def load_config(path):
@@ -116,6 +126,14 @@ def validate_config(path: str, config: DottedDict):
     app.validate('api_keys', DottedList)
     app.validate('max_session_minutes', int)
     app.validate('pluggramd_url', str)
+    app.validate('rpc_timeout', float, optional=True)
+    app.validate('rpc_connections', int, optional=True)
+    app.validate('pluggramd_events_url', str, optional=True)
+    app.validate('stream_port', int, optional=True)
+    app.validate('stream_host', str, optional=True)
+    app.validate('screen_preview_url', str, optional=True)
+    app.validate('preview_fps', int, optional=True)
+    app.validate('preview_scale', int, optional=True)
 
     user = root.addValidator('user')
     user.validate('password', str)